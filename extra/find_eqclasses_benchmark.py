@@ -0,0 +1,71 @@
+#! /usr/bin/python2.4
+
+"""Benchmark for PdfData.FindEqclasses on a synthetic object graph.
+
+Usage: find_eqclasses_benchmark.py [<obj-count> [<chain-length>]]
+
+The graph consists of chains of objects, each object referring to the next
+one in its chain. All chains look the same except for the last object, which
+has 2 variants. Thus the split of the initial eqclass has to propagate
+backwards along the entire chains, which is the worst case for naive
+refinement (it needs as many passes over all objects as the chain length).
+"""
+
+import os
+import os.path
+import sys
+import time
+
+if os.path.isfile(os.path.join(
+    os.path.dirname(__file__), '..', 'lib', 'pdfsizeopt', 'main.py')):
+  sys.path[:0] = [os.path.join(os.path.dirname(__file__), '..', 'lib')]
+
+from pdfsizeopt import main
+
+
+def BuildObjs(obj_count, chain_length):
+  objs = {}
+  chain_count = max(1, obj_count // chain_length)
+  obj_num = 1
+  first_obj_nums = []
+  for i in xrange(chain_count):
+    first_obj_nums.append(obj_num)
+    for j in xrange(chain_length - 1):
+      obj = main.PdfObj(None)
+      obj.head = '<</Type/Node/Next %d 0 R>>' % (obj_num + 1)
+      objs[obj_num] = obj
+      obj_num += 1
+    obj = main.PdfObj(None)
+    obj.head = '<</Type/Tail/Value %d>>' % (i & 1)
+    objs[obj_num] = obj
+    obj_num += 1
+  obj = main.PdfObj(None)
+  obj.head = '<</Kids[%s]>>' % ' '.join(
+      ['%d 0 R' % first_obj_num for first_obj_num in first_obj_nums])
+  objs[obj_num] = obj
+  obj = main.PdfObj(None)
+  obj.head = '<</Root %d 0 R>>' % obj_num
+  objs['trailer'] = obj
+  return objs
+
+
+def main_(argv):
+  obj_count = 1000000
+  chain_length = 1000
+  if len(argv) > 1:
+    obj_count = int(argv[1])
+  if len(argv) > 2:
+    chain_length = int(argv[2])
+  start_time = time.time()
+  objs = BuildObjs(obj_count, chain_length)
+  print 'built %d objs in %.2fs' % (len(objs), time.time() - start_time)
+  start_time = time.time()
+  new_objs = main.PdfData.FindEqclasses(objs, do_remove_unused=True)
+  print 'FindEqclasses found %d eqclasses in %.2fs' % (
+      len(new_objs), time.time() - start_time)
+  # 2 chains + the /Kids obj + the trailer.
+  assert len(new_objs) == min(2, len(objs) // chain_length) * chain_length + 2
+
+
+if __name__ == '__main__':
+  sys.exit(main_(sys.argv))
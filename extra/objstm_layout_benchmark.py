@@ -0,0 +1,85 @@
+#! /usr/bin/python2.4
+
+"""Size benchmark for the object stream layout of PdfData.AppendSerializedPdf.
+
+Usage: objstm_layout_benchmark.py [<input.pdf> ...]
+
+For each input PDF, it serializes the PDF with and without
+do_optimize_objstm_layout, and prints the output sizes and times. Without
+arguments, it uses a synthetic PDF (generated deterministically) with pages,
+fonts and annotations in interleaved object number order, which is typical
+for merged PDFs.
+"""
+
+import os
+import os.path
+import sys
+import time
+
+if os.path.isfile(os.path.join(
+    os.path.dirname(__file__), '..', 'lib', 'pdfsizeopt', 'main.py')):
+  sys.path[:0] = [os.path.join(os.path.dirname(__file__), '..', 'lib')]
+
+from pdfsizeopt import main
+
+
+def BuildPdf(page_count):
+  pdf = main.PdfData()
+  pdf.version = '1.5'
+  objs = pdf.objs
+  page_obj_nums = []
+  obj_num = 3
+  for i in xrange(page_count):
+    font_obj_num, fd_obj_num, annot_obj_num, page_obj_num = xrange(
+        obj_num, obj_num + 4)
+    obj_num += 4
+    objs[font_obj_num] = main.PdfObj(
+        '0 0 obj<</Type/Font/Subtype/Type1/BaseFont/F%d/FirstChar 32'
+        '/LastChar %d/FontDescriptor %d 0 R/Encoding/WinAnsiEncoding>>endobj'
+        % (i % 37, 100 + i % 23, fd_obj_num))
+    objs[fd_obj_num] = main.PdfObj(
+        '0 0 obj<</Type/FontDescriptor/FontName/F%d/Flags 32/FontBBox'
+        '[-%d -250 %d 900]/ItalicAngle 0/Ascent 718/Descent -207'
+        '/CapHeight 718/StemV %d>>endobj'
+        % (i % 37, 100 + i % 7, 1000 + i % 11, 80 + i % 5))
+    objs[annot_obj_num] = main.PdfObj(
+        '0 0 obj<</Type/Annot/Subtype/Link/Rect[%d %d %d %d]/Border[0 0 0]'
+        '/A<</S/URI/URI(http://example.com/page%d)>>>>endobj'
+        % (72 + i % 13, 700 - i % 17, 300 + i % 19, 712 - i % 17, i))
+    objs[page_obj_num] = main.PdfObj(
+        '0 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]'
+        '/Resources<</Font<</F1 %d 0 R>>/ProcSet[/PDF/Text]>>'
+        '/Annots[%d 0 R]/Contents %d 0 R>>endobj'
+        % (font_obj_num, annot_obj_num, 1))
+    page_obj_nums.append(page_obj_num)
+  objs[1] = main.PdfObj('0 0 obj<</Length 0>>stream\nendstream endobj')
+  objs[2] = main.PdfObj(
+      '0 0 obj<</Type/Pages/Count %d/Kids[%s]>>endobj' %
+      (page_count, ' '.join(['%d 0 R' % n for n in page_obj_nums])))
+  objs[obj_num] = main.PdfObj('0 0 obj<</Type/Catalog/Pages 2 0 R>>endobj')
+  pdf.trailer = main.PdfObj('0 0 obj<</Size %d/Root %d 0 R>>endobj' %
+                            (obj_num + 1, obj_num))
+  return pdf
+
+
+def main_(argv):
+  if len(argv) > 1:
+    pdfs = [(file_name, main.PdfData().Load(file_name))
+            for file_name in argv[1:]]
+  else:
+    pdfs = [('synthetic', BuildPdf(2000))]
+  for name, pdf in pdfs:
+    sizes = []
+    for do_optimize_objstm_layout in (False, True):
+      start_time = time.time()
+      size = pdf.AppendSerializedPdf(
+          [], do_optimize_objstm_layout=do_optimize_objstm_layout)
+      sizes.append(size)
+      print '%s: do_optimize_objstm_layout=%r: %d bytes in %.2fs' % (
+          name, do_optimize_objstm_layout, size, time.time() - start_time)
+    print '%s: saved %d bytes (%s)' % (
+        name, sizes[0] - sizes[1], main.FormatPercent(sizes[1], sizes[0]))
+
+
+if __name__ == '__main__':
+  sys.exit(main_(sys.argv))
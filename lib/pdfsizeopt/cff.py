@@ -4,6 +4,7 @@ CFF file format documentation:
 http://www.adobe.com/devnet/font/pdfs/5176.CFF.pdf
 """
 
+import heapq
 import re
 import struct
 
@@ -558,7 +559,7 @@ def ParseCffHeader(data, do_need_single_font=True, do_parse_rest=True):
   if not (1 <= cff_off_size <= 4):
     raise ValueError('Invalid CFF off_size: %d' % cff_off_size)
   if hdr_size < 4:
-    raise ValueError('CFF header too short, got: %d' % header_size)
+    raise ValueError('CFF header too short, got: %d' % hdr_size)
   ai1, font_name_bufs = ParseCffIndex(buffer(data, hdr_size))
   if not font_name_bufs:
     raise ValueError('CFF contains no fonts.')
@@ -1278,22 +1279,22 @@ def ParseCffOp(op, op_value, op_name, op_type, op_default):
     return result
   elif op_type == 'n':  # A number.
     if len(op_value) != 1:
-      raise ValueError('Invalid size for CFF number value for op %d: %d' %
+      raise ValueError('Invalid size for CFF number value for op %d: %r' %
                        (op, op_value))
     return ParseCffNumber(op, str(op_value[0]))
   elif op_type == 'x':  # A bbox.
     if len(op_value) != 4:
-      raise ValueError('Invalid size for CFF bbox value for op %d: %d' %
+      raise ValueError('Invalid size for CFF bbox value for op %d: %r' %
                        (op, op_value))
     return [ParseCffNumber(op, number) for number in op_value]
   elif op_type == 'm':  # A matrix.
     if len(op_value) != 6:
-      raise ValueError('Invalid size for CFF matrix value for op %d: %d' %
+      raise ValueError('Invalid size for CFF matrix value for op %d: %r' %
                        (op, op_value))
     return [ParseCffNumber(op, number) for number in op_value]
   elif op_type == 'i':  # An integer.
     if len(op_value) != 1:
-      raise ValueError('Invalid size for CFF integer value for op %d: %d' %
+      raise ValueError('Invalid size for CFF integer value for op %d: %r' %
                        (op, op_value))
     op_value = op_value[0]
     if not isinstance(op_value, (int, long)):
@@ -1302,7 +1303,7 @@ def ParseCffOp(op, op_value, op_name, op_type, op_default):
     return int(op_value)
   elif op_type == 'j':  # Two integers.
     if len(op_value) != 2:
-      raise ValueError('Invalid size for CFF integer2 value for op %d: %d' %
+      raise ValueError('Invalid size for CFF integer2 value for op %d: %r' %
                        (op, op_value))
     result = []
     for number in op_value:
@@ -1313,7 +1314,7 @@ def ParseCffOp(op, op_value, op_name, op_type, op_default):
     return result
   elif op_type == 'b':  # A boolean.
     if len(op_value) != 1:
-      raise ValueError('Invalid size for CFF boolean value for op %d: %d' %
+      raise ValueError('Invalid size for CFF boolean value for op %d: %r' %
                        (op, op_value))
     op_value = op_value[0]
     if op_value == 0:
@@ -1356,7 +1357,8 @@ def ParseCff1(data, is_careful=False):
   # It's OK to have long font names. 5176.CFF.pdf says that the maximum
   # ``should be'' 127, but we don't check it.
   if CFF_NON_FONTNAME_CHAR_RE.search(cff_font_name):
-    raise ValueError('CFF font name %r contains invalid chars.' % font_name)
+    raise ValueError('CFF font name %r contains invalid chars.' %
+                     cff_font_name)
   cff_top_dict_buf = cff_font_items[0][1]
   top_dict = ParseCffDict(cff_top_dict_buf)
   if is_careful:
@@ -1405,7 +1407,7 @@ def ParseCff1(data, is_careful=False):
       if (len(op_value) != 1 or not isinstance(op_value[0], int) or
           op_value[0] <= 0):
         raise ValueError('Invalid SID value for CFF /%s: %r' %
-                         (op_name, value))
+                         (op_name, op_value))
       op_value = op_value[0]
       if op_value < string_index_limit:
         # TODO(pts): Deduplicate these values as both hex and regular strings.
@@ -1441,9 +1443,9 @@ def ParseCff1(data, is_careful=False):
       del private_dict_ser, private_dict2
     for op, op_value in sorted(private_dict.iteritems()):
       op_entry = _CFF_PRIVATE_OP_MAP.get(op)
-      op_name = op_entry[0]
       if op_entry is None:
         raise ValueError('Unknown CFF private dict op: %d' % op)
+      op_name = op_entry[0]
       parsed_private_dict[op_name] = _ParseCffOp(op, op_value, *op_entry)
     del private_dict
     if 'Subrs' in parsed_private_dict:
@@ -1526,3 +1528,785 @@ def ParseCff1(data, is_careful=False):
   #print parsed_dict
   return parsed_dict
   # !! Add unit tests for code coverage on everything cff.pgs covers.
+
+
+def ParseType1CFont(data):
+  """Parses a CFF font program to a parsed Type1C font dictionary.
+
+  The result has the same structure as the values of the dict returned by
+  main.PdfData.ParseType1CFonts (which used to be Ghostscript's
+  Type1CParser), i.e. with /FontInfo as a sub-dict, and without /FontName.
+
+  Args:
+    data: str or buffer containing the CFF font program.
+  Returns:
+    A parsed Type1C font dictionary.
+  Raises:
+    ValueError: If the font program contains an error.
+    CffUnsupportedError: If the font program uses a feature not supported by
+        this parser.
+  """
+  parsed_dict = ParseCff1(data)
+  if parsed_dict.pop('CharstringType', 2) != 2:
+    raise CffUnsupportedError('CFF CharstringType other than 2 not supported.')
+  font_matrix = parsed_dict.get('FontMatrix')
+  if (font_matrix is None or
+      _IsCffDefaultValue(font_matrix, CFF_TOP_OP_MAP[12007][2])):
+    # Make the default comparable in MergeTwoType1CFonts.
+    font_matrix = list(CFF_TOP_OP_MAP[12007][2])
+  parsed_font = {'FontType': 2, 'PaintType': 0, 'FontMatrix': font_matrix}
+  font_info = {}
+  for key, value in parsed_dict.iteritems():
+    if key in CFF_TOP_FONTINFO_KEYS:
+      font_info[key] = value
+    elif key not in ('FontName', 'FontMatrix', 'charset', 'PostScript',
+                     'ParsedPostScript'):
+      parsed_font[key] = value
+  if font_info:
+    parsed_font['FontInfo'] = font_info
+  private = parsed_font['Private']
+  for key in ('StdHW', 'StdVW'):
+    if key in private:  # Ghostscript's Type1CParser emits these as arrays.
+      private[key] = [private[key]]
+  return parsed_font
+
+
+def _IsCffDefaultValue(value, op_default):
+  """Returns bool indicating whether the parsed value is op_default."""
+  if op_default is None:
+    return False
+  if isinstance(op_default, tuple):
+    if not isinstance(value, (list, tuple)) or len(value) != len(op_default):
+      return False
+    for item, item_default in izip(value, op_default):
+      if not _IsCffDefaultValue(item, item_default):
+        return False
+    return True
+  if isinstance(value, bool) or isinstance(op_default, bool):
+    return value == op_default
+  if isinstance(value, str) and value.startswith('<'):
+    return False
+  try:
+    return float(value) == float(op_default)
+  except (TypeError, ValueError):
+    return False
+
+
+def _DecodeCffHexString(value, what):
+  """Returns the str decoded from a parsed hex string literal."""
+  if not (isinstance(value, str) and value.startswith('<') and
+          value.endswith('>')):
+    raise CffUnsupportedError('Expected hex string for %s, got: %r' %
+                              (what, value))
+  try:
+    return value[1 : -1].decode('hex')
+  except TypeError:
+    raise ValueError('Invalid hex string for %s: %r' % (what, value))
+
+
+HEX_ESCAPE_IN_NAME_RE = re.compile(r'#([0-9a-fA-F]{2})')
+"""Matches a hex escape (e.g. #2A) in a name, as emitted by CffStringToName."""
+
+
+def _GetCffOperand(number):
+  """Returns a number operand, as int if integer-valued (it's shorter)."""
+  if isinstance(number, str):
+    number = float(number)  # Can raise ValueError.
+  if (isinstance(number, float) and number == int(number) and
+      -0x80000000 <= number <= 0x7fffffff):
+    return int(number)
+  return number
+
+
+def _GetCffDictOperands(op, value, op_name, op_type, get_sid):
+  """Returns operand list to serialize, inverse of ParseCffOp."""
+  if op_type == 's':
+    return [get_sid(_DecodeCffHexString(value, '/' + op_name))]
+  elif op_type == 'b':
+    if value not in (True, False):  # Also matches 0 and 1.
+      raise ValueError('Invalid CFF boolean value for op %d: %r' % (op, value))
+    return [int(value)]
+  elif op_type in 'ni':
+    if isinstance(value, (list, tuple)):
+      # Ghostscript's Type1CParser emits e.g. /StdHW as an array.
+      if len(value) != 1:
+        raise ValueError('Invalid CFF number value for op %d: %r' %
+                         (op, value))
+      value = value[0]
+    if not isinstance(value, (str, float, int, long)):
+      raise ValueError('Invalid CFF number value for op %d: %r' % (op, value))
+    return [_GetCffOperand(value)]
+  elif op_type == 'd':  # Convert absolute values back to deltas.
+    if not isinstance(value, (list, tuple)):
+      raise ValueError('Invalid CFF delta value for op %d: %r' % (op, value))
+    result = []
+    prev_number = 0
+    for number in value:
+      number = _GetCffOperand(number)
+      result.append(_GetCffOperand(number - prev_number))
+      prev_number = number
+    return result
+  elif op_type in 'xm':
+    if not isinstance(value, (list, tuple)):
+      raise ValueError('Invalid CFF array value for op %d: %r' % (op, value))
+    return map(_GetCffOperand, value)
+  elif op_type == 'o':
+    if not isinstance(value, (list, tuple)):
+      raise ValueError('Invalid CFF array value for op %d: %r' % (op, value))
+    return list(value)
+  else:
+    raise CffUnsupportedError('Cannot serialize CFF /%s.' % op_name)
+
+
+def _SerializeCffCharset(sids):
+  """Returns the serialized CFF charset (or 0 for ISOAdobe) for the SIDs.
+
+  Args:
+    sids: List of SIDs of the glyphs, without the leading .notdef.
+  """
+  ranges = []
+  for sid in sids:
+    if ranges and ranges[-1][0] + ranges[-1][1] + 1 == sid and (
+        ranges[-1][1] < 255):
+      ranges[-1][1] += 1
+    else:
+      ranges.append([sid, 0])
+  if len(ranges) == 1 and ranges[0][0] == 1 and len(sids) <= 228:
+    return 0  # Predefined ISOAdobe charset (SIDs 1..228).
+  if len(ranges) * 3 < len(sids) * 2:
+    return '\1' + ''.join(struct.pack('>HB', sid, n_left)
+                          for sid, n_left in ranges)
+  return struct.pack('>B%dH' % len(sids), 0, *sids)
+
+
+def SerializeType1CFont(parsed_font, font_name):
+  """Serializes a parsed Type1C font dictionary to a CFF font program.
+
+  This is the inverse of ParseType1CFont. It can serialize the parsed Type1C
+  font dictionaries created by main.PdfData.ParseType1CFonts (even if created
+  by Ghostscript's Type1CParser), so it can be used instead of Ghostscript's
+  Type1CGenerator.
+
+  The built-in encoding of the font is not serialized, the callers put an
+  explicit /Encoding to the PDF /Type/Font object if needed. Glyphs are
+  emitted in SID order (to make the charset short), .notdef is added if
+  missing.
+
+  Args:
+    parsed_font: A parsed Type1C font dictionary.
+    font_name: The CFF font name to use (str without the leading '/').
+  Returns:
+    str containing the CFF font program.
+  Raises:
+    ValueError: If parsed_font contains an invalid value.
+    CffUnsupportedError: If parsed_font contains a value which can't be
+        serialized.
+  """
+  if parsed_font.get('FontType', 2) != 2:
+    raise CffUnsupportedError('Only FontType 2 is supported.')
+  if parsed_font.get('CharstringType', 2) != 2:
+    raise CffUnsupportedError('CFF CharstringType other than 2 not supported.')
+  if CFF_NON_FONTNAME_CHAR_RE.search(font_name) or not font_name:
+    raise ValueError('CFF font name %r contains invalid chars.' % font_name)
+  standard_sids = _GetCffStandardSids()
+  strings = []
+  custom_sids = {}
+
+  def GetSid(string):
+    sid = standard_sids.get(string)
+    if sid is None:
+      sid = custom_sids.get(string)
+      if sid is None:
+        sid = custom_sids[string] = len(standard_sids) + len(strings)
+        strings.append(string)
+    return sid
+
+  charstrings = parsed_font.get('CharStrings')
+  if not isinstance(charstrings, dict):
+    raise ValueError('Missing /CharStrings from Type1C font.')
+  glyphs = []  # List of (sid_key, glyph_name_str, charstring_str).
+  notdef_charstring = '\x0e'  # endchar.
+  for glyph_name in charstrings:
+    charstring = _DecodeCffHexString(
+        charstrings[glyph_name], 'glyph /' + glyph_name)
+    if not charstring:
+      raise ValueError('Empty charstring for glyph /%s.' % glyph_name)
+    glyph_name = HEX_ESCAPE_IN_NAME_RE.sub(
+        lambda match: chr(int(match.group(1), 16)), glyph_name)
+    if glyph_name == '.notdef':
+      notdef_charstring = charstring
+    else:
+      glyphs.append((standard_sids.get(glyph_name, 65536), glyph_name,
+                     charstring))
+  glyphs.sort()
+  charstring_bufs = [notdef_charstring]
+  charstring_bufs.extend(glyph[2] for glyph in glyphs)
+  charset = _SerializeCffCharset([GetSid(glyph[1]) for glyph in glyphs])
+  del glyphs
+
+  top_dict = {}
+  font_info = parsed_font.get('FontInfo') or {}
+  if not isinstance(font_info, dict):
+    raise ValueError('Invalid /FontInfo in Type1C font.')
+  for op, (op_name, op_type, op_default) in sorted(CFF_TOP_OP_MAP.iteritems()):
+    if (op in CFF_OFFSET0_OPERATORS or op in CFF_TOP_CIDFONT_OPERATORS or
+        op in CFF_TOP_SYNTHETIC_FONT_OPERATORS or
+        op_name in ('CharstringType', 'PostScript') or
+        op_name.startswith('unknown')):
+      continue
+    if op_name in CFF_TOP_FONTINFO_KEYS:
+      value = font_info.get(op_name, parsed_font.get(op_name))
+    else:
+      value = parsed_font.get(op_name)
+    if value is None or _IsCffDefaultValue(value, op_default):
+      continue
+    top_dict[op] = _GetCffDictOperands(op, value, op_name, op_type, GetSid)
+
+  private = parsed_font.get('Private') or {}
+  if not isinstance(private, dict):
+    raise ValueError('Invalid /Private in Type1C font.')
+  private_dict = {}
+  for op, (op_name, op_type, op_default) in sorted(
+      CFF_PRIVATE_OP_MAP.iteritems()):
+    value = private.get(op_name)
+    if op_name == 'Subrs' or value is None or (
+        _IsCffDefaultValue(value, op_default)):
+      continue
+    private_dict[op] = _GetCffDictOperands(
+        op, value, op_name, op_type, GetSid)
+  subr_bufs = [_DecodeCffHexString(subr, '/Subrs')
+               for subr in private.get('Subrs') or ()]
+  global_subr_bufs = [_DecodeCffHexString(subr, '/GlobalSubrs')
+                      for subr in private.get('GlobalSubrs') or ()]
+  if subr_bufs:
+    subrs_ofs = 0
+    while 1:  # Compute subrs_ofs (relative to /Private) iteratively.
+      private_dict[19] = [subrs_ofs]
+      private_data = SerializeCffDict(private_dict)
+      if len(private_data) == subrs_ofs:
+        break
+      subrs_ofs = len(private_data)
+    subrs_data = SerializeCffIndexHeader(None, subr_bufs)[1] + ''.join(
+        subr_bufs)
+  else:
+    private_data = SerializeCffDict(private_dict)
+    subrs_data = ''
+
+  # The rest (after the global subr index): charset, CharStrings, Private,
+  # Subrs.
+  if isinstance(charset, str):
+    charstrings_rel_ofs = len(charset)
+  else:
+    charstrings_rel_ofs, charset = 0, ''
+  charstrings_data = SerializeCffIndexHeader(None, charstring_bufs)[1] + (
+      ''.join(charstring_bufs))
+  private_rel_ofs = charstrings_rel_ofs + len(charstrings_data)
+  string_data = SerializeCffIndexHeader(None, strings)[1] + ''.join(strings)
+  global_subrs_data = SerializeCffIndexHeader(None, global_subr_bufs)[1] + (
+      ''.join(global_subr_bufs))
+  name_data = SerializeCffIndexHeader(None, (font_name,))[1] + font_name
+  base_ofs = 4 + len(name_data)
+  rest_ofs = 0
+  while 1:  # Compute rest_ofs iteratively, like in FixFontNameInCff.
+    if charset:
+      top_dict[15] = [rest_ofs]
+    top_dict[17] = [rest_ofs + charstrings_rel_ofs]
+    top_dict[18] = [len(private_data), rest_ofs + private_rel_ofs]
+    top_dict_data = SerializeCffDict(top_dict)
+    top_dict_header = SerializeCffIndexHeader(None, (top_dict_data,))[1]
+    new_rest_ofs = (base_ofs + len(top_dict_header) + len(top_dict_data) +
+                    len(string_data) + len(global_subrs_data))
+    if new_rest_ofs == rest_ofs:
+      break
+    rest_ofs = new_rest_ofs
+  size = rest_ofs + private_rel_ofs + len(private_data) + len(subrs_data)
+  off_size = 1
+  while size >> (off_size << 3) and off_size < 4:
+    off_size += 1
+  return ''.join((
+      '\1\0\4%c' % off_size,  # CFF header.
+      name_data, top_dict_header, top_dict_data, string_data,
+      global_subrs_data, charset, charstrings_data, private_data, subrs_data))
+
+
+def _GetCffStandardSids(_cache=[]):
+  """Returns a dict mapping CFF standard strings to their SIDs."""
+  if not _cache:
+    _cache.append(dict((string, sid) for sid, string in
+                       enumerate(CFF_STANDARD_STRINGS)))
+  return _cache[0]
+
+
+def GetCffSubrBias(subr_count):
+  """Returns the number to add to the callsubr operand to get the index."""
+  if subr_count < 1240:
+    return 107
+  elif subr_count < 33900:
+    return 1131
+  else:
+    return 32768
+
+
+def DecodeCharStringNumber(data):
+  """Decodes a single Type 2 charstring integer operand."""
+  b0 = ord(data[0])
+  if 32 <= b0 <= 246:
+    return b0 - 139
+  elif 247 <= b0 <= 250:
+    return ((b0 - 247) << 8) + ord(data[1]) + 108
+  elif 251 <= b0 <= 254:
+    return -((b0 - 251) << 8) - ord(data[1]) - 108
+  elif b0 == 28:
+    return struct.unpack('>h', data[1 : 3])[0]
+  elif b0 == 255:
+    value = struct.unpack('>l', data[1 : 5])[0]
+    if value & 0xffff:
+      raise CffUnsupportedError('Fractional Type 2 charstring subr number.')
+    return value >> 16
+  else:
+    raise ValueError('Not a Type 2 charstring number: %r' % data)
+
+
+def EncodeCharStringNumber(value):
+  """Encodes a Type 2 charstring integer operand, inverse of the above."""
+  if -107 <= value <= 107:
+    return chr(value + 139)
+  elif 108 <= value <= 1131:
+    value -= 108
+    return '%c%c' % ((value >> 8) + 247, value & 255)
+  elif -1131 <= value <= -108:
+    value = -value - 108
+    return '%c%c' % ((value >> 8) + 251, value & 255)
+  elif -32768 <= value <= 32767:
+    return '\x1c' + struct.pack('>h', value)
+  else:
+    raise ValueError('Type 2 charstring integer out of range: %d' % value)
+
+
+CHARSTRING_STEM_OPERATORS = (
+    1,  # hstem
+    3,  # vstem
+    18,  # hstemhm
+    23,  # vstemhm
+    19,  # hintmask (with implicit vstem)
+    20,  # cntrmask (with implicit vstem)
+)
+"""Contains Type 2 charstring operators which can declare stem hints."""
+
+CHARSTRING_ESCAPE_OPERATORS = (
+    0,  # dotsection
+    34,  # hflex
+    35,  # flex
+    36,  # hflex1
+    37,  # flex1
+)
+"""Contains Type 2 charstring escape operators clearing the stack."""
+
+
+def _SplitCharStringTo(data, subr_bufs, global_subr_bufs, commands, state,
+                       depth):
+  """Appends the commands in data to commands, inlining subr calls.
+
+  Args:
+    data: str containing the Type 2 charstring or subr.
+    subr_bufs: List of str or buffer containing the local subrs.
+    global_subr_bufs: List of str or buffer containing the global subrs.
+    commands: The list to append the commands (str) to.
+    state: [stem_count, operand_tokens], modified in place.
+    depth: Subr nesting depth of data.
+  Returns:
+    bool indicating whether endchar was found.
+  Raises:
+    ValueError: .
+    CffUnsupportedError: .
+  """
+  if depth > 10:
+    raise ValueError('Type 2 charstring subr nesting too deep.')
+  operands = state[1]
+  i, size = 0, len(data)
+  while i < size:
+    b0 = ord(data[i])
+    if b0 >= 32 or b0 == 28:
+      if b0 <= 246:
+        j = i + 1 + (b0 == 28) * 2
+      elif b0 <= 254:
+        j = i + 2
+      else:
+        j = i + 5
+      if j > size:
+        raise ValueError('Truncated Type 2 charstring number.')
+      operands.append(data[i : j])
+      i = j
+      continue
+    if b0 == 10 or b0 == 29:  # callsubr or callgsubr.
+      if not operands:
+        raise ValueError('Missing Type 2 charstring subr number.')
+      if b0 == 10:
+        bufs = subr_bufs
+      else:
+        bufs = global_subr_bufs
+      index = DecodeCharStringNumber(operands.pop()) + GetCffSubrBias(
+          len(bufs))
+      if not 0 <= index < len(bufs):
+        raise ValueError('Type 2 charstring subr index out of range: %d' %
+                         index)
+      i += 1
+      if _SplitCharStringTo(str(bufs[index]), subr_bufs, global_subr_bufs,
+                            commands, state, depth + 1):
+        return True
+      continue
+    if b0 == 11:  # return.
+      if not depth:
+        raise ValueError('Type 2 charstring return outside subr.')
+      return False
+    if b0 == 12:
+      if i + 1 >= size:
+        raise ValueError('Truncated Type 2 charstring escape operator.')
+      if ord(data[i + 1]) not in CHARSTRING_ESCAPE_OPERATORS:
+        raise CffUnsupportedError(
+            'Type 2 charstring operator 12 %d not supported.' %
+            ord(data[i + 1]))
+      j = i + 2
+    elif b0 in (0, 2, 9, 13, 15, 16, 17):
+      raise CffUnsupportedError(
+          'Reserved Type 2 charstring operator: %d' % b0)
+    else:
+      j = i + 1
+      if b0 in CHARSTRING_STEM_OPERATORS:
+        # An odd number of operands means that the first one is the width.
+        state[0] += len(operands) >> 1
+        if b0 >= 19:  # hintmask or cntrmask, followed by the mask bytes.
+          j += (state[0] + 7) >> 3
+          if j > size:
+            raise ValueError('Truncated Type 2 charstring hint mask.')
+    operands.append(data[i : j])
+    commands.append(''.join(operands))
+    del operands[:]
+    i = j
+    if b0 == 14:  # endchar. Ignore the rest.
+      return True
+  return False
+
+
+def SplitCharString(charstring, subr_bufs=(), global_subr_bufs=()):
+  """Splits a Type 2 charstring to commands, inlining subr calls.
+
+  Each command consists of the operands and the operator (and the mask bytes
+  for hintmask and cntrmask). Executing the concatenation of the commands
+  is equivalent to executing the original charstring.
+
+  Args:
+    charstring: str or buffer containing the Type 2 charstring.
+    subr_bufs: List of str or buffer containing the local subrs.
+    global_subr_bufs: List of str or buffer containing the global subrs.
+  Returns:
+    List of str, the commands.
+  Raises:
+    ValueError: If the charstring is invalid.
+    CffUnsupportedError: If the charstring uses operators (e.g. arithmetic)
+        which make splitting unsafe.
+  """
+  commands = []
+  state = [0, []]
+  _SplitCharStringTo(str(charstring), subr_bufs, global_subr_bufs, commands,
+                     state, 0)
+  if state[1]:  # Operands without an operator at the end.
+    commands.append(''.join(state[1]))
+  return commands
+
+
+def _GetCharStringCommandOperator(command):
+  """Returns the first byte of the operator in a SplitCharString command."""
+  i = 0
+  while 1:
+    b0 = ord(command[i])
+    if b0 < 28 or 28 < b0 < 32:
+      return command[i]
+    if b0 == 28:
+      i += 3
+    elif b0 <= 246:
+      i += 1
+    elif b0 <= 254:
+      i += 2
+    else:
+      i += 5
+    if i >= len(command):
+      return ''
+
+
+def _BuildSuffixArray(seq, alphabet_size):
+  """Returns the suffix array of seq, using prefix doubling.
+
+  Args:
+    seq: List of nonnegative integers smaller than alphabet_size.
+    alphabet_size: Upper bound for the values in seq.
+  Returns:
+    List of suffix start indexes in lexicographic order of the suffixes.
+  """
+  size = len(seq)
+  rank = list(seq)
+  limit = alphabet_size
+  suffixes = range(size)
+  k = 1
+  while 1:
+    m = limit + 1
+    keys = [a * m + b + 1 for a, b in izip(rank, rank[k:])]
+    keys.extend([a * m for a in rank[len(keys):]])
+    suffixes.sort(key=keys.__getitem__)
+    limit, prev_key = -1, None
+    for i in suffixes:
+      key = keys[i]
+      if key != prev_key:
+        limit += 1
+        prev_key = key
+      rank[i] = limit
+    limit += 1
+    if limit >= size or k >= size:
+      return suffixes
+    k <<= 1
+
+
+def _BuildLcpArray(seq, suffixes):
+  """Returns lcp, lcp[i] is the common prefix size of suffix i - 1 and i.
+
+  Uses Kasai's algorithm.
+  """
+  size = len(seq)
+  rank = [0] * size
+  for i, j in enumerate(suffixes):
+    rank[j] = i
+  lcp = [0] * size
+  h = 0
+  for i in xrange(size):
+    r = rank[i]
+    if r:
+      j = suffixes[r - 1]
+      while i + h < size and j + h < size and seq[i + h] == seq[j + h]:
+        h += 1
+      lcp[r] = h
+      if h:
+        h -= 1
+    else:
+      h = 0
+  return lcp
+
+
+def SubroutinizeCharStrings(glyph_commands, max_subr_count=65535):
+  """Factors out repeated command sequences of glyphs to local subrs.
+
+  Repeated command sequences are found using a suffix array (and the LCP
+  array) built on the concatenation of all glyphs. The candidate subrs are
+  the LCP intervals, and they are selected greedily by the number of bytes
+  saved, reevaluating a candidate if some of its occurrences have been used
+  by previously selected subrs. The subrs don't call other subrs, so the
+  nesting depth is 1, well below the limit 10 of CFF.
+
+  Args:
+    glyph_commands: List of command lists (as returned by SplitCharString),
+        one for each glyph.
+    max_subr_count: Maximum number of subrs to generate.
+  Returns:
+    (charstring_bufs, subr_bufs), where charstring_bufs is a list of str
+    containing the new charstrings (in the order of glyph_commands), and
+    subr_bufs is a list of str containing the local subrs.
+  """
+  command_ids = {}
+  command_sizes = []
+  ids = []
+  for commands in glyph_commands:
+    for command in commands:
+      command_id = command_ids.get(command)
+      if command_id is None:
+        command_id = command_ids[command] = len(command_sizes)
+        command_sizes.append(len(command))
+      ids.append(command_id)
+    ids.append(-1)  # Glyph separator, will be made unique below.
+  # Make glyph separators unique (and smaller than the command IDs), so that
+  # no repeat spans multiple glyphs.
+  glyph_count = len(glyph_commands)
+  seq = []
+  separator = glyph_count
+  prefix_sizes = [0]  # prefix_sizes[i] is the byte size of seq[:i].
+  total_size = 0
+  for command_id in ids:
+    if command_id < 0:
+      separator -= 1
+      seq.append(separator)
+    else:
+      seq.append(command_id + glyph_count)
+      total_size += command_sizes[command_id]
+    prefix_sizes.append(total_size)
+  del ids
+  size = len(seq)
+  suffixes = _BuildSuffixArray(seq, len(command_sizes) + glyph_count)
+  lcp = _BuildLcpArray(seq, suffixes)
+
+  # Estimated byte cost of calling a subr (number + callsubr), and of
+  # storing a subr (return + CFF index offset).
+  call_cost, subr_cost = 3, 3
+  heap = []
+  stack = [(0, 0)]  # (lcp, left).
+  for i in xrange(1, size + 1):
+    if i < size:
+      h = lcp[i]
+    else:
+      h = 0
+    left = i - 1
+    while h < stack[-1][0]:
+      length, left = stack.pop()
+      count = i - left
+      start = suffixes[left]
+      body_size = prefix_sizes[start + length] - prefix_sizes[start]
+      saving = count * (body_size - call_cost) - body_size - subr_cost
+      if saving > 0:
+        heap.append((-saving, length, left, i))
+    if h > stack[-1][0]:
+      stack.append((h, left))
+  del lcp
+  heapq.heapify(heap)
+
+  covered = [False] * size
+  subrs = []  # List of (length, starts).
+  while heap and len(subrs) < max_subr_count:
+    saving, length, left, right = heapq.heappop(heap)
+    starts = []
+    prev_end = 0
+    for start in sorted(suffixes[left : right]):
+      if start >= prev_end and True not in covered[start : start + length]:
+        starts.append(start)
+        prev_end = start + length
+    if not starts:
+      continue
+    body_size = prefix_sizes[starts[0] + length] - prefix_sizes[starts[0]]
+    saving = len(starts) * (body_size - call_cost) - body_size - subr_cost
+    if saving <= 0:
+      continue
+    if heap and -saving > heap[0][0]:  # Not the best anymore, reevaluate.
+      heapq.heappush(heap, (-saving, length, left, right))
+      continue
+    for start in starts:
+      covered[start : start + length] = [True] * length
+    subrs.append((length, starts))
+  del covered, heap, prefix_sizes
+
+  # The most frequently called subrs get the shortest subr numbers.
+  subrs.sort(key=lambda subr: -len(subr[1]))
+  bias = GetCffSubrBias(len(subrs))
+  commands = [None] * len(command_sizes)
+  for command, command_id in command_ids.iteritems():
+    commands[command_id] = command
+  del command_ids
+  calls = {}  # Maps start index in seq to (length, call_str).
+  subr_bufs = []
+  for length, starts in subrs:
+    start = starts[0]
+    body = [commands[command_id - glyph_count]
+            for command_id in seq[start : start + length]]
+    if _GetCharStringCommandOperator(body[-1]) != '\x0e':  # Not endchar.
+      body.append('\x0b')  # return.
+    call = EncodeCharStringNumber(len(subr_bufs) - bias) + '\x0a'
+    subr_bufs.append(''.join(body))
+    for start in starts:
+      calls[start] = (length, call)
+  charstring_bufs = []
+  output = []
+  i = 0
+  while i < size:
+    command_id = seq[i]
+    if command_id < glyph_count:  # Separator.
+      charstring_bufs.append(''.join(output))
+      del output[:]
+      i += 1
+    elif i in calls:
+      length, call = calls[i]
+      output.append(call)
+      i += length
+    else:
+      output.append(commands[command_id - glyph_count])
+      i += 1
+  return charstring_bufs, subr_bufs
+
+
+def DesubroutinizeType1CFont(parsed_font):
+  """Returns a parsed Type1C font dictionary with the subrs inlined.
+
+  The resulting charstrings are normalized: equivalent glyph programs are
+  equal even if they were subroutinized differently in the original fonts.
+
+  Args:
+    parsed_font: A parsed Type1C font dictionary. Not modified.
+  Returns:
+    A new parsed Type1C font dictionary without /Subrs and /GlobalSubrs.
+  Raises:
+    ValueError: .
+    CffUnsupportedError: .
+  """
+  charstrings = parsed_font.get('CharStrings')
+  if not isinstance(charstrings, dict):
+    raise ValueError('Missing /CharStrings from Type1C font.')
+  private = parsed_font.get('Private') or {}
+  subr_bufs = [_DecodeCffHexString(subr, '/Subrs')
+               for subr in private.get('Subrs') or ()]
+  global_subr_bufs = [_DecodeCffHexString(subr, '/GlobalSubrs')
+                      for subr in private.get('GlobalSubrs') or ()]
+  new_charstrings = {}
+  for glyph_name, charstring in charstrings.iteritems():
+    new_charstrings[glyph_name] = '<%s>' % ''.join(SplitCharString(
+        _DecodeCffHexString(charstring, 'glyph /' + glyph_name),
+        subr_bufs, global_subr_bufs)).encode('hex')
+  parsed_font = dict(parsed_font)
+  parsed_font['CharStrings'] = new_charstrings
+  private = parsed_font['Private'] = dict(private)
+  private.pop('Subrs', None)
+  private.pop('GlobalSubrs', None)
+  return parsed_font
+
+
+def SubroutinizeType1CFont(parsed_font):
+  """Returns a parsed Type1C font dictionary with subroutinized glyphs.
+
+  Existing /Subrs and /GlobalSubrs are inlined first, then
+  SubroutinizeCharStrings generates new local /Subrs.
+
+  Args:
+    parsed_font: A parsed Type1C font dictionary. Not modified.
+  Returns:
+    A new parsed Type1C font dictionary, or parsed_font if subroutinization
+    doesn't make the font smaller.
+  Raises:
+    ValueError: .
+    CffUnsupportedError: .
+  """
+  charstrings = parsed_font.get('CharStrings')
+  if not isinstance(charstrings, dict):
+    raise ValueError('Missing /CharStrings from Type1C font.')
+  private = parsed_font.get('Private') or {}
+  subr_bufs = [_DecodeCffHexString(subr, '/Subrs')
+               for subr in private.get('Subrs') or ()]
+  global_subr_bufs = [_DecodeCffHexString(subr, '/GlobalSubrs')
+                      for subr in private.get('GlobalSubrs') or ()]
+  old_size = sum(map(len, subr_bufs)) + sum(map(len, global_subr_bufs))
+  glyph_names = sorted(charstrings)
+  glyph_commands = []
+  for glyph_name in glyph_names:
+    charstring = _DecodeCffHexString(
+        charstrings[glyph_name], 'glyph /' + glyph_name)
+    old_size += len(charstring)
+    glyph_commands.append(SplitCharString(
+        charstring, subr_bufs, global_subr_bufs))
+  charstring_bufs, subr_bufs = SubroutinizeCharStrings(glyph_commands)
+  del glyph_commands
+  new_size = sum(map(len, subr_bufs)) + sum(map(len, charstring_bufs)) + (
+      len(subr_bufs) * 2)
+  if new_size >= old_size:
+    return parsed_font
+  parsed_font = dict(parsed_font)
+  parsed_font['CharStrings'] = dict(izip(glyph_names, (
+      '<%s>' % buf.encode('hex') for buf in charstring_bufs)))
+  private = parsed_font['Private'] = dict(private)
+  private.pop('GlobalSubrs', None)
+  if subr_bufs:
+    private['Subrs'] = ['<%s>' % buf.encode('hex') for buf in subr_bufs]
+  else:
+    private.pop('Subrs', None)
+  return parsed_font
@@ -0,0 +1,139 @@
+"""Pluggable Flate (ZIP, zlib) compression backends.
+
+A backend is a function which takes the uncompressed data and an effort
+level, and returns the data in zlib format (as expected by /FlateDecode), or
+None if it doesn't want to compress at that effort level. Backends are
+registered with RegisterBackend. FlateCompressor tries all backends suitable
+for the requested effort and keeps the shortest output.
+
+Effort levels:
+
+* 1: zlib.compress(data, 9), the fastest.
+* 2: also zlib with other strategies and memory levels.
+* 3 and above: also Zopfli (an optimal, but slow Flate encoder), with more
+  iterations at higher effort levels, if the zopfli Python module is
+  installed (pip install zopfli).
+"""
+
+import zlib
+
+try:
+  import zopfli.zlib  # Optional dependency, not in the standard library.
+except ImportError:
+  zopfli = None
+
+
+class Error(Exception):
+  """Common base class for exceptions defined in this module."""
+
+
+class UnknownBackendError(Error):
+  """Raised if a backend with an unknown name is requested."""
+
+
+def CompressZlib(data, effort):
+  """Compresses with the zlib module, trying more settings if effort >= 2."""
+  if effort < 2:
+    return zlib.compress(data, 9)
+  best = None
+  for mem_level, strategy in ((8, zlib.Z_DEFAULT_STRATEGY),
+                              (9, zlib.Z_DEFAULT_STRATEGY),
+                              (9, zlib.Z_FILTERED)):
+    compressobj = zlib.compressobj(9, zlib.DEFLATED, 15, mem_level, strategy)
+    output = compressobj.compress(data) + compressobj.flush()
+    if best is None or len(output) < len(best):
+      best = output
+  return best
+
+
+ZOPFLI_ITERATIONS = {3: 15, 4: 50}
+"""Maps effort levels to the number of Zopfli iterations."""
+
+ZOPFLI_MAX_ITERATIONS = 200
+"""Number of Zopfli iterations above the effort levels in ZOPFLI_ITERATIONS."""
+
+
+def CompressZopfli(data, effort):
+  """Compresses with Zopfli if effort >= 3, otherwise returns None."""
+  if effort < 3:
+    return None
+  return zopfli.zlib.compress(
+      data, numiterations=ZOPFLI_ITERATIONS.get(effort, ZOPFLI_MAX_ITERATIONS))
+
+
+# List of [name, compress_func], in the order they are tried.
+BACKENDS = []
+
+
+def RegisterBackend(name, compress_func):
+  """Registers (or replaces) a Flate compression backend.
+
+  Args:
+    name: str, name of the backend, e.g. 'zlib'.
+    compress_func: Function taking (data, effort) and returning a str
+      containing data in zlib format, or None if the backend is not to be
+      used at that effort level. It must be deterministic.
+  """
+  for item in BACKENDS:
+    if item[0] == name:
+      item[1] = compress_func
+      break
+  else:
+    BACKENDS.append([name, compress_func])
+
+
+def GetBackendNames():
+  """Returns the list of names of the registered backends."""
+  return [item[0] for item in BACKENDS]
+
+
+RegisterBackend('zlib', CompressZlib)
+if zopfli is not None:
+  RegisterBackend('zopfli', CompressZopfli)
+
+
+class FlateCompressor(object):
+  """Compresses data with the best of some backends, depending on its size.
+
+  Attributes:
+    effort: int, effort level (see the module docstring) for data at least
+      min_size bytes long. For shorter data, 1 is used.
+    min_size: int, minimum size (in bytes) of uncompressed data to use the
+      effort level for. For short data, higher effort levels rarely pay off.
+    backends: List of (name, compress_func) pairs to try.
+  """
+
+  def __init__(self, effort=1, min_size=0, backend_names=None):
+    """Creates the compressor.
+
+    Args:
+      effort: int, the effort level.
+      min_size: int, the minimum data size for the effort level.
+      backend_names: Sequence of backend names to try, or None to try all
+        registered backends.
+    Raises:
+      UnknownBackendError: If a backend in backend_names is not registered.
+    """
+    self.effort = int(effort)
+    self.min_size = int(min_size)
+    if backend_names is None:
+      backend_names = GetBackendNames()
+    backends_by_name = dict(BACKENDS)
+    self.backends = []
+    for name in backend_names:
+      if name not in backends_by_name:
+        raise UnknownBackendError('unknown Flate backend: %s' % name)
+      self.backends.append((name, backends_by_name[name]))
+
+  def Compress(self, data):
+    """Returns data compressed in zlib format, as short as possible."""
+    if self.effort <= 1 or len(data) < self.min_size:
+      return zlib.compress(data, 9)
+    best = None
+    for name, compress_func in self.backends:
+      output = compress_func(data, self.effort)
+      if output is not None and (best is None or len(output) < len(best)):
+        best = output
+    if best is None:  # No backend was willing to compress.
+      best = zlib.compress(data, 9)
+    return best
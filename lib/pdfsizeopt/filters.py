@@ -0,0 +1,484 @@
+"""PDF stream filter decoders (except for Flate) in pure Python.
+
+Also PNG and TIFF predictor encoders, for compressing.
+
+PDF filter documentation: section 7.4 (Filters) of
+http://www.adobe.com/content/dam/Adobe/en/devnet/acrobat/pdfs/PDF32000_2008.pdf
+
+Row un-prediction (for the PNG and TIFF predictors) is vectorized: a row
+is converted to a Python long, and the bytes (or 16-bit components) are
+added as lanes of the long (SIMD within a register), so there is no Python
+loop over the bytes in a row, except for PNG Average and Paeth rows.
+Prediction (encoding) is vectorized the same way, with lanes subtracted,
+except for PNG Paeth rows.
+"""
+
+import re
+import struct
+
+try:
+  bytearray_tostring = bytearray.__str__  # Python 2.6 and 2.7.
+except NameError:  # Python 2.4 and Python 2.5
+  import array
+  bytearray = lambda data: array.array('B', data)
+  bytearray_tostring = array.array.tostring
+
+
+class Error(Exception):
+  """Comon base class for exceptions defined in this module."""
+
+
+class FilterDecodeError(Error):
+  """Raised if the compressed data is invalid."""
+
+
+FILTER_NAMES = {
+    '/FlateDecode': '/FlateDecode',
+    '/Fl': '/FlateDecode',
+    '/LZWDecode': '/LZWDecode',
+    '/LZW': '/LZWDecode',
+    '/ASCII85Decode': '/ASCII85Decode',
+    '/A85': '/ASCII85Decode',
+    '/ASCIIHexDecode': '/ASCIIHexDecode',
+    '/AHx': '/ASCIIHexDecode',
+    '/RunLengthDecode': '/RunLengthDecode',
+    '/RL': '/RunLengthDecode',
+}
+"""Maps the filter names (and abbreviations) supported to canonical names."""
+
+PREDICTOR_FILTER_NAMES = ('/FlateDecode', '/LZWDecode')
+"""Canonical names of filters which support /Predictor in /DecodeParms."""
+
+WHITESPACE_RE = re.compile(r'[\0\t\n\r\f ]+')
+
+ASCII_HEX_RE = re.compile(r'[0-9a-fA-F]*\Z')
+
+
+def IsPredictorSupported(parms):
+  """Returns bool indicating whether Unpredict supports the /DecodeParms.
+
+  Args:
+    parms: dict mapping /DecodeParms keys (without the slash) to values, or
+      None.
+  """
+  if not parms:
+    return True
+  predictor = parms.get('Predictor', 1)
+  if predictor == 1:
+    return True
+  colors = parms.get('Colors', 1)
+  bpc = parms.get('BitsPerComponent', 8)
+  columns = parms.get('Columns', 1)
+  if not (isinstance(colors, int) and isinstance(bpc, int) and
+          isinstance(columns, int) and colors > 0 and columns > 0):
+    return False
+  if predictor == 2:
+    return bpc in (8, 16)
+  return 10 <= predictor <= 15 and bpc in (1, 2, 4, 8, 16)
+
+
+def DecodeAsciiHex(data):
+  """Decodes /ASCIIHexDecode data."""
+  i = data.find('>')
+  if i >= 0:
+    data = data[:i]
+  data = WHITESPACE_RE.sub('', data)
+  if not ASCII_HEX_RE.match(data):
+    raise FilterDecodeError('bad /ASCIIHexDecode data')
+  if len(data) & 1:
+    data += '0'
+  return data.decode('hex')
+
+
+def DecodeAscii85(data):
+  """Decodes /ASCII85Decode data."""
+  i = data.find('~>')
+  if i >= 0:
+    data = data[:i]
+  data = WHITESPACE_RE.sub('', data)
+  if data.startswith('<~'):
+    data = data[2:]
+  data = data.replace('z', '!!!!!')
+  padding_size = -len(data) % 5
+  if padding_size == 4:
+    raise FilterDecodeError('bad /ASCII85Decode data length')
+  data += 'u' * padding_size
+  values = []
+  for i in xrange(0, len(data), 5):
+    c0, c1, c2, c3, c4 = struct.unpack('5B', data[i : i + 5])
+    value = ((((c0 * 85 + c1) * 85 + c2) * 85 + c3) * 85 + c4 -
+             33 * (85 * 85 * 85 * 85 + 85 * 85 * 85 + 85 * 85 + 85 + 1))
+    if (value >> 32 or
+        not (33 <= c0 <= 117 and 33 <= c1 <= 117 and 33 <= c2 <= 117 and
+             33 <= c3 <= 117 and 33 <= c4 <= 117)):
+      raise FilterDecodeError('bad /ASCII85Decode data')
+    values.append(value)
+  output = struct.pack('>%dL' % len(values), *values)
+  if padding_size:
+    output = output[:-padding_size]
+  return output
+
+
+def DecodeRunLength(data):
+  """Decodes /RunLengthDecode data."""
+  output = []
+  i = 0
+  data_size = len(data)
+  while i < data_size:
+    b = ord(data[i])
+    if b < 128:
+      output.append(data[i + 1 : i + b + 2])
+      i += b + 2
+    elif b > 128:
+      output.append(data[i + 1 : i + 2] * (257 - b))
+      i += 2
+    else:  # EOD.
+      break
+  return ''.join(output)
+
+
+def DecodeLzw(data, early_change=1):
+  """Decodes /LZWDecode data (without the predictor).
+
+  Args:
+    data: str containing the compressed data.
+    early_change: The /EarlyChange value in /DecodeParms.
+  Returns:
+    str containing the uncompressed data.
+  Raises:
+    FilterDecodeError: .
+  """
+  output = []
+  table = [chr(i) for i in xrange(256)]
+  table.extend((None, None))  # Clear-table and EOD codes.
+  code_size = 9
+  code_mask = 511
+  buf = buf_size = 0
+  prev = None
+  for c in data:
+    buf = buf << 8 | ord(c)
+    buf_size += 8
+    while buf_size >= code_size:
+      buf_size -= code_size
+      code = buf >> buf_size & code_mask
+      buf &= (1 << buf_size) - 1
+      if code == 256:
+        del table[258:]
+        code_size, code_mask, prev = 9, 511, None
+        continue
+      if code == 257:
+        return ''.join(output)
+      if code < len(table):
+        entry = table[code]
+        if prev is not None and len(table) < 4096:
+          table.append(prev + entry[0])
+      elif code == len(table) and prev is not None:
+        entry = prev + prev[0]
+        table.append(entry)
+      else:
+        raise FilterDecodeError('bad /LZWDecode code: %d' % code)
+      output.append(entry)
+      prev = entry
+      if len(table) + early_change > code_mask and code_size < 12:
+        code_size += 1
+        code_mask = code_mask << 1 | 1
+  return ''.join(output)
+
+
+def _GetLaneMasks(size, lane_size, _cache={}):
+  """Returns (low_mask, high_mask) for the SIMD within a long."""
+  key = (size, lane_size)
+  masks = _cache.get(key)
+  if masks is None:
+    lane_count = size // lane_size
+    if not lane_count:
+      masks = _cache[key] = (0, 0)
+    else:
+      masks = _cache[key] = (
+          int(('7f' + 'ff' * (lane_size - 1)) * lane_count, 16),
+          int(('80' + '00' * (lane_size - 1)) * lane_count, 16))
+  return masks
+
+
+def _StrToLong(data):
+  if not data:
+    return 0
+  return int(data.encode('hex'), 16)
+
+
+def _LongToStr(value, size):
+  if not size:
+    return ''
+  return ('%0*x' % (size << 1, value)).decode('hex')
+
+
+def _AddLanes(a, b, masks):
+  """Adds the lanes of a and b (modulo the lane size), without carry."""
+  low_mask, high_mask = masks
+  return ((a & low_mask) + (b & low_mask)) ^ ((a ^ b) & high_mask)
+
+
+def _SubLanes(a, b, masks):
+  """Subtracts the lanes of b from a (modulo the lane size), without borrow."""
+  low_mask, high_mask = masks
+  return ((a | high_mask) - (b & low_mask)) ^ ((a ^ ~b) & high_mask)
+
+
+def _AverageLanes(a, b, masks):
+  """Returns the average of the lanes of a and b, rounded down."""
+  return (a & b) + (((a ^ b) >> 1) & masks[0])
+
+
+def _PrefixSumLanes(a, size, stride, masks):
+  """Computes the prefix sum of lanes of the long a, with the given stride.
+
+  After this, byte i (counting from the most significant byte) of the result
+  will contain the sum of bytes i, i - stride, i - 2 * stride ... of a.
+  """
+  while stride < size:
+    a = _AddLanes(a, a >> (stride << 3), masks)
+    stride <<= 1
+  return a
+
+
+def UnpredictPng(data, columns, colors=1, bpc=8):
+  """Undoes the PNG predictors (/Predictor 10 ... 15).
+
+  Args:
+    data: str containing the rows, each starting with a PNG filter type byte.
+    columns: Number of pixels in a row.
+    colors: Number of color components per pixel.
+    bpc: Number of bits per color component.
+  Returns:
+    str containing the rows without the filter type bytes. A truncated last
+    row is kept truncated.
+  Raises:
+    FilterDecodeError: .
+  """
+  row_size = (colors * bpc * columns + 7) >> 3
+  bpp = max(1, (colors * bpc) >> 3)  # Bytes per pixel.
+  output = []
+  prev = '\0' * row_size
+  for i in xrange(0, len(data), row_size + 1):
+    filter_type = data[i]
+    row = data[i + 1 : i + 1 + row_size]
+    size = len(row)
+    if size < row_size:
+      prev = prev[:size]
+    if filter_type == '\0':  # None.
+      pass
+    elif filter_type == '\2':  # Up.
+      row = _LongToStr(_AddLanes(
+          _StrToLong(row), _StrToLong(prev), _GetLaneMasks(size, 1)), size)
+    elif filter_type == '\1':  # Sub.
+      row = _LongToStr(_PrefixSumLanes(
+          _StrToLong(row), size, bpp, _GetLaneMasks(size, 1)), size)
+    elif filter_type == '\3':  # Average.
+      b = bytearray(row)
+      p = bytearray(prev)
+      for j in xrange(min(bpp, size)):
+        b[j] = (b[j] + (p[j] >> 1)) & 255
+      for j in xrange(bpp, size):
+        b[j] = (b[j] + ((b[j - bpp] + p[j]) >> 1)) & 255
+      row = bytearray_tostring(b)
+    elif filter_type == '\4':  # Paeth.
+      b = bytearray(row)
+      p = bytearray(prev)
+      for j in xrange(min(bpp, size)):
+        b[j] = (b[j] + p[j]) & 255
+      for j in xrange(bpp, size):
+        left, up, up_left = b[j - bpp], p[j], p[j - bpp]
+        pa = abs(up - up_left)
+        pb = abs(left - up_left)
+        pc = abs(left + up - up_left - up_left)
+        if pa <= pb and pa <= pc:
+          b[j] = (b[j] + left) & 255
+        elif pb <= pc:
+          b[j] = (b[j] + up) & 255
+        else:
+          b[j] = (b[j] + up_left) & 255
+      row = bytearray_tostring(b)
+    else:
+      raise FilterDecodeError('bad PNG filter type: %d' % ord(filter_type))
+    output.append(row)
+    prev = row
+  return ''.join(output)
+
+
+PNG_FILTER_TYPES = (0, 1, 2, 3, 4)
+"""PNG filter types: None, Sub, Up, Average and Paeth."""
+
+_ABS_TABLE = ''.join([chr(min(i, 256 - i)) for i in xrange(256)])
+"""Maps bytes to their absolute value (as signed bytes) for MSAD."""
+
+
+def _PredictPngRows(filter_type, data, row_size, bpp):
+  """Applies a PNG filter to all rows.
+
+  Args:
+    filter_type: int in PNG_FILTER_TYPES.
+    data: str containing the rows. The last row may be truncated.
+    row_size: Number of bytes in a row.
+    bpp: Number of bytes per pixel, at least 1.
+  Returns:
+    str of the same size as data, containing the filtered rows, without the
+    filter type bytes.
+  """
+  size = len(data)
+  if filter_type == 0 or not size:  # None.
+    return data
+  if filter_type not in PNG_FILTER_TYPES:
+    raise ValueError('bad PNG filter type: %r' % (filter_type,))
+  masks = _GetLaneMasks(size, 1)
+  a = _StrToLong(data)
+  up = a >> (row_size << 3)
+  if filter_type == 2:  # Up.
+    return _LongToStr(_SubLanes(a, up, masks), size)
+  # Bytes of the pixel to the left, 0 in the first pixel of each row.
+  bpp = min(bpp, row_size)
+  row_mask = int(
+      (('00' * bpp + 'ff' * (row_size - bpp)) *
+       (size // row_size + 1))[:size << 1], 16)
+  left = (a >> (bpp << 3)) & row_mask
+  if filter_type == 1:  # Sub.
+    return _LongToStr(_SubLanes(a, left, masks), size)
+  if filter_type == 3:  # Average.
+    return _LongToStr(_SubLanes(a, _AverageLanes(left, up, masks), masks),
+                      size)
+  # Paeth.
+  up_left = (up >> (bpp << 3)) & row_mask
+  b = bytearray(data)
+  p_left = bytearray(_LongToStr(left, size))
+  p_up = bytearray(_LongToStr(up, size))
+  p_up_left = bytearray(_LongToStr(up_left, size))
+  for j in xrange(size):
+    left, up, up_left = p_left[j], p_up[j], p_up_left[j]
+    pa = abs(up - up_left)
+    pb = abs(left - up_left)
+    pc = abs(left + up - up_left - up_left)
+    if pa <= pb and pa <= pc:
+      b[j] = (b[j] - left) & 255
+    elif pb <= pc:
+      b[j] = (b[j] - up) & 255
+    else:
+      b[j] = (b[j] - up_left) & 255
+  return bytearray_tostring(b)
+
+
+def PredictPng(data, columns, colors=1, bpc=8, filter_type=None):
+  """Applies a PNG predictor (/Predictor 10 ... 15) to data.
+
+  Args:
+    data: str containing the rows.
+    columns: Number of pixels in a row.
+    colors: Number of color components per pixel.
+    bpc: Number of bits per color component.
+    filter_type: int in PNG_FILTER_TYPES to use for all rows, or None to
+      pick the filter type for each row adaptively, using the minimum sum of
+      absolute differences (MSAD) heuristic of libpng.
+  Returns:
+    str containing the filtered rows, each starting with a PNG filter type
+    byte. A truncated last row is kept truncated. UnpredictPng undoes this.
+  """
+  row_size = (colors * bpc * columns + 7) >> 3
+  bpp = max(1, (colors * bpc) >> 3)  # Bytes per pixel.
+  output = []
+  if filter_type is not None:
+    filtered = _PredictPngRows(filter_type, data, row_size, bpp)
+    filter_type = chr(filter_type)
+    for i in xrange(0, len(data), row_size):
+      output.append(filter_type)
+      output.append(filtered[i : i + row_size])
+    return ''.join(output)
+  # List of (filter_type_char, filtered, abs_filtered).
+  candidates = []
+  for filter_type in PNG_FILTER_TYPES:
+    filtered = _PredictPngRows(filter_type, data, row_size, bpp)
+    candidates.append(
+        (chr(filter_type), filtered, filtered.translate(_ABS_TABLE)))
+  for i in xrange(0, len(data), row_size):
+    best = None
+    for filter_type, filtered, abs_filtered in candidates:
+      cost = sum(bytearray(abs_filtered[i : i + row_size]))
+      if best is None or cost < best[0]:
+        best = (cost, filter_type, filtered)
+    output.append(best[1])
+    output.append(best[2][i : i + row_size])
+  return ''.join(output)
+
+
+def PredictTiff(data, columns, colors=1, bpc=8):
+  """Applies the TIFF predictor (/Predictor 2) to data, for bpc 8 and 16.
+
+  Args:
+    data: str containing the rows.
+    columns: Number of pixels in a row.
+    colors: Number of color components per pixel.
+    bpc: Number of bits per color component, 8 or 16.
+  Returns:
+    str containing the predicted rows. A truncated last row is kept
+    truncated. UnpredictTiff undoes this.
+  """
+  assert bpc in (8, 16), bpc
+  lane_size = bpc >> 3
+  row_size = colors * columns * lane_size
+  shift = (colors * lane_size) << 3
+  output = []
+  for i in xrange(0, len(data), row_size):
+    row = data[i : i + row_size]
+    size = len(row) - len(row) % lane_size
+    a = _StrToLong(row[:size])
+    output.append(_LongToStr(_SubLanes(
+        a, a >> shift, _GetLaneMasks(size, lane_size)), size))
+    output.append(row[size:])
+  return ''.join(output)
+
+
+def UnpredictTiff(data, columns, colors=1, bpc=8):
+  """Undoes the TIFF predictor (/Predictor 2), for bpc 8 and 16.
+
+  Args:
+    data: str containing the rows.
+    columns: Number of pixels in a row.
+    colors: Number of color components per pixel.
+    bpc: Number of bits per color component, 8 or 16.
+  Returns:
+    str containing the rows. A truncated last row is kept truncated.
+  """
+  assert bpc in (8, 16), bpc
+  lane_size = bpc >> 3
+  row_size = colors * columns * lane_size
+  output = []
+  for i in xrange(0, len(data), row_size):
+    row = data[i : i + row_size]
+    size = len(row) - len(row) % lane_size
+    output.append(_LongToStr(_PrefixSumLanes(
+        _StrToLong(row[:size]), size, colors * lane_size,
+        _GetLaneMasks(size, lane_size)), size))
+    output.append(row[size:])
+  return ''.join(output)
+
+
+def Unpredict(data, parms):
+  """Undoes the predictor specified in parms.
+
+  Args:
+    data: str containing the predicted data.
+    parms: dict mapping /DecodeParms keys (without the slash) to values, or
+      None. IsPredictorSupported(parms) must be true.
+  Returns:
+    str containing the data with the predictor undone.
+  Raises:
+    FilterDecodeError: .
+  """
+  if not parms:
+    return data
+  predictor = parms.get('Predictor', 1)
+  if predictor == 1:
+    return data
+  columns = parms.get('Columns', 1)
+  colors = parms.get('Colors', 1)
+  bpc = parms.get('BitsPerComponent', 8)
+  if predictor == 2:
+    return UnpredictTiff(data, columns, colors, bpc)
+  return UnpredictPng(data, columns, colors, bpc)
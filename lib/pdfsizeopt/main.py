@@ -103,8 +103,9 @@ FLAGS_HELP = r"""
   Parse and serialize all fonts? Currently it applies only to Type1 an Type1C
   fonts. It makes the output consistent, and it also makes some fonts a bit
   smaller. Doing it is not much slower (and it's actually faster if some fonts
-  need /LZWDecode). However, Ghostscript is used for both parsing and
-  serialization, and it may breaks some fonts (but it seldom happens nowadays).
+  need /LZWDecode). However, Ghostscript may be used for both parsing and
+  serialization (see --do-use-python-cff), and it may breaks some fonts (but
+  it seldom happens nowadays).
   So in case of font problems, specify
   --do-unify-fonts=no --do-regenerate-all-fonts=no.
 --do-double-check-type1c-output=YES_NO; default: no
@@ -112,9 +113,32 @@ FLAGS_HELP = r"""
   After Type1C font serialization, parse it again, and check that the glyphs
   and most other fields are still there? It is slow, but it can reveal some
   bugs in Ghostscript.
+--do-use-python-cff=YES_NO; default: yes
+  Parse and serialize Type1C (CFF) fonts in Python? If enabled, Ghostscript
+  is used only for the Type1C fonts which can't be handled this way.
+  Specify no to use Ghostscript for all Type1C fonts.
+--do-subroutinize-fonts=YES_NO; default: yes
+  Factor out repeated glyph drawing command sequences of the regenerated
+  Type1C fonts to subroutines? It makes large fonts smaller. It needs
+  --do-use-python-cff=yes.
 --do-optimize-streams=YES_NO; default: yes
   Recompress all non-image streams, keep the smallest value. To optimize image
   streams, please use --do-optimize-images=yes.
+--flate-effort=LEVEL; default: 1
+  How hard to try to make Flate (ZIP) compressed streams (content streams,
+  fonts, object streams, xref streams) in the output PDF smaller.
+  1: zlib level 9. 2: also try other zlib settings. 3 and above: also try
+  Zopfli, with more iterations for higher levels (needs the zopfli Python
+  module, pip install zopfli). Zopfli is about 100 times slower than zlib,
+  and it usually makes the streams a few percent smaller.
+--flate-min-size=BYTES; default: 4096
+  Use --flate-effort=... only for streams of at least this many bytes
+  (uncompressed), compress shorter streams with zlib level 9. It doesn't
+  pay off to spend much time on short streams.
+--flate-backends=NAME,...
+  Comma-separated list of Flate compression backends to try at the effort
+  level of --flate-effort=... . Available backends: zlib, zopfli (if
+  installed). The default is to try all available backends.
 --do-optimize-objs=YES_NO; default: yes
   Optimize all objects in a PDF in a generic way? It removes unused objects,
   it deduplicates objects, it reserialize object headers etc. These
@@ -136,6 +160,11 @@ FLAGS_HELP = r"""
   Unify duplicate /Type /Page objects? It makes the PDF with duplicate pages
   a bit smaller. Disabling it increases compatibility with some old PDF
   viewers.
+--do-canonicalize-dicts=YES_NO; default: yes
+  Compare objects with the keys of their dicts sorted? It makes duplicate
+  objects which differ only in the order of dict keys (common in merged PDFs)
+  unified. The output keeps the original key order. Only relevant if
+  --do-optimize-objs=yes.
 --do-generate-xref-stream=YES_NO; default: yes
   Generate the output PDF file with an xref stream (rather than an xref)?
   It produces smaller output. It should only be turned off for debugging.
@@ -170,6 +199,29 @@ FLAGS_HELP = r"""
   It's useful to enable it by default, because Multivalent has some image
   processing bugs (including some compression predictor handling), thus it
   would garble the image with a /Predictor.
+--do-mmap-input=YES_NO; default: yes
+  Map the input PDF to memory (with mmap) rather than reading it to a string?
+  The objects are parsed from zero-copy views into the mapping, thus huge PDFs
+  can be loaded with much less resident memory. If the input file cannot be
+  mapped, it is read instead.
+--do-lazy-load=YES_NO; default: no
+  Parse PDF objects only when they are first used, rather than all of them
+  when the input PDF is loaded? Objects not used by any of the optimizations
+  are copied to the output PDF without keeping their parsed form in memory.
+  Objects only read by some passes (e.g. when removing unused objects) are
+  parsed again for each such pass, thus it saves memory at the cost of some
+  CPU time. Works best with --do-mmap-input=yes.
+--do-use-gs-worker=YES_NO; default: yes
+  Run Ghostscript jobs (stream decompression and Type1C font parsing) in
+  long-lived Ghostscript processes rather than starting a new Ghostscript for
+  each job? It saves the Ghostscript startup time. Only has an effect on
+  systems other than Windows. If the worker cannot be started, pdfsizeopt
+  falls back to starting a new Ghostscript for each job.
+--gs-job-timeout=SECONDS; default: 0
+  Maximum number of seconds to wait for a job in a long-lived Ghostscript
+  process (see --do-use-gs-worker=yes). The Ghostscript process of the timed
+  out job is killed, and a new one will be started for the next job. 0 means
+  no timeout.
 --do-debug-gs=YES_NO; default: no
   Display debug info about where pdfsizeopt is trying to find Ghostscript,
   whether the found Ghostscripts work, and which one was chosen? All this
@@ -192,6 +244,80 @@ FLAGS_HELP = r"""
   999: Everything.
 --quiet
   Equivalent to --v=20 : print only errors, fatal errors, unhandled exceptions.
+--jobs=N; default: 1
+  Number of worker processes or threads to use for the parallelizable parts
+  of the optimization (currently: parsing the objects of large PDFs in
+  processes, running the external image optimizers for different images
+  concurrently and recompressing streams in threads). 0 means the number of
+  CPUs. Parsing in processes only has an effect on systems with fork() (i.e.
+  not on Windows) and with Python 2.6 or later.
+--batch=FILE
+  Optimize many PDFs in a single pdfsizeopt process, thus doing the setup
+  (e.g. finding Ghostscript and the image optimizers) only once. FILE (or
+  stdin if FILE is -) contains one PDF per line: the input filename, or
+  the input and output filenames separated by a tab. The default output
+  filename is the same as without --batch. Empty lines and lines starting
+  with # are ignored. No filenames are allowed in the command-line. A
+  failure in one PDF doesn't stop the batch, but the exit code will be
+  nonzero.
+--batch-jobs=N; default: 1
+  Number of PDFs in --batch=... to optimize concurrently, in worker
+  processes. 0 means the number of CPUs. If more than 1, then --jobs=... is
+  ignored (treated as 1). Only has an effect on systems with fork() (i.e.
+  not on Windows) and with Python 2.6 or later.
+--parse-cache-dir=DIR
+  Directory to save parsed objects of input PDFs to, and load them from when
+  the same input PDF is processed again (e.g. with different flags). The cache
+  files are named after the SHA-256 of the input PDF and the parser code, so
+  they are never reused after a change in the input or in pdfsizeopt. Stale
+  cache files are not removed automatically. If not specified or empty, the
+  parse cache is not used. Needs Python 2.5 or later.
+--image-time-budget=SECONDS; default: 0
+  Maximum number of seconds the optional image optimizers (e.g. pngout,
+  optipng and jbig2, but not sam2p and imgdataopt) may run for a single image.
+  The optimizers are tried in decreasing order of expected size reduction per
+  second (predicted from the number of pixels and bits per pixel, and the
+  running times measured so far), optimizers predicted to exceed the remaining
+  budget are skipped, and the running one is killed when the budget runs out
+  (except on Windows). 0 means unlimited. With a budget, the output PDF
+  depends on the running times, thus on the system load and on --jobs=...
+--total-image-time-budget=SECONDS; default: 0
+  Like --image-time-budget, but the budget is shared by all images in the
+  input PDF. 0 means unlimited.
+--image-stats-file=FILE
+  File to record statistics about the outcome of the image optimizers (size
+  reduction, running time, whether they have produced the smallest image) to,
+  grouped by image class (color type, bits per component and size). If not
+  specified or empty, no statistics are recorded.
+--do-skip-losing-image-optimizers=YES_NO; default: no
+  Skip the image optimizers which have never produced the smallest image in
+  10 or more runs on images of the same class, as recorded in
+  --image-stats-file=...? Such an optimizer is still run on every 20th image
+  of the class, so it can recover.
+--image-cache-dir=DIR
+  Directory to save the output of the external image optimizers (e.g. sam2p,
+  pngout, optipng and jbig2) to, and load it from when the same optimizer is
+  run on the same input image again (e.g. the same logo in another PDF). The
+  cache files are named after the SHA-256 of the input image, the command
+  and the size and mtime of the command's executable. If not specified or
+  empty, the image cache is not used. Needs Python 2.5 or later.
+--image-cache-max-size=MB; default: 256
+  Maximum total size of the files in --image-cache-dir, in megabytes. When
+  pdfsizeopt has finished optimizing the images, it removes the least
+  recently used cache files above this size.
+--fingerprints-file=FILE
+  File containing the fingerprints of the stream objects (e.g. images, fonts
+  and content streams) in PDFs written by pdfsizeopt. The stream objects of
+  the input PDF which have a fingerprint in this file are kept intact: the
+  image, font and stream optimizations skip them. After writing the output
+  PDF, the fingerprints of its stream objects are added to this file, except
+  for those not fully optimized (e.g. because of a time budget). This
+  is useful for re-optimizing a PDF which has been optimized by pdfsizeopt
+  and then edited (e.g. pages appended, annotations added as incremental
+  updates), so that only the new objects are optimized. Fingerprints only
+  match if the same optimizations (--do-optimize-*=... flags and image
+  optimizers) are enabled. If not specified or empty, all objects are
+  optimized. Needs Python 2.5 or later.
 --tmp-dir=DIR
   Directory to save temporary files to. pdfsizeopt will delete these files unless
   an uncaught exception is raised. If not specified or empty,
@@ -213,16 +339,26 @@ __pychecker__ = (
     'maxlines=999 maxlocals=99 unusednames=self,cls maxreturns=99 '
     'maxbranches=9999')
 
+import Queue
 import getopt
+import marshal
+import mmap
 import os
 import os.path
+import random
 import re
+import select
+import signal
 import struct
+import subprocess
 import sys
+import threading
 import time
 import zlib
 
 from pdfsizeopt import cff
+from pdfsizeopt import deflate
+from pdfsizeopt import filters
 from pdfsizeopt import psproc
 
 
@@ -236,16 +372,48 @@ except NameError:  # Python 2.4 and Python 2.5
   bytearray = lambda data: array.array('B', data)
   bytearray_tostring = array.array.tostring
 
+try:
+  import multiprocessing  # Python 2.6 and 2.7.
+except ImportError:  # Python 2.4 and Python 2.5
+  multiprocessing = None
+
+try:
+  import hashlib  # Python 2.5, 2.6 and 2.7.
+except ImportError:  # Python 2.4
+  hashlib = None
+
+try:
+  import fcntl
+except ImportError:  # Windows.
+  fcntl = None
+
 TMP_PREFIX = '///dev/null/psotmp..'  # Will be overridden in main.
 
+# None or a GsWorkerPool. Will be overridden in main.
+GS_WORKER_POOL = None
+
+# None or an ImageCache. Will be overridden in main.
+IMAGE_CACHE = None
+
+# None or a deflate.FlateCompressor. Will be overridden in main.
+FLATE_COMPRESSOR = None
+
 # Log everything by default. Will be overridden in main.
 VERBOSITY = 999
 
 
+class FatalError(SystemExit):
+  """Raised by LogFatal. The message is in .msg, the exit code in .code."""
+
+  def __init__(self, msg, exit_code):
+    SystemExit.__init__(self, exit_code)
+    self.msg = msg
+
+
 def LogFatal(msg, exit_code=2):
   sys.stderr.write('fatal: %s\n' % (msg,))
   sys.stderr.flush()  # Not needed.
-  sys.exit(exit_code)
+  raise FatalError(msg, exit_code)
 
 
 def LogError(msg):
@@ -419,6 +587,851 @@ def GetGsCommand(is_verbose=False, _cache=[]):
   return gs_cmd
 
 
+class GsWorkerError(Error):
+  """Raised if a Ghostscript worker has failed (e.g. crashed)."""
+
+
+class GsWorkerStartError(GsWorkerError):
+  """Raised if a Ghostscript worker couldn't be started."""
+
+
+class GsJobTimeoutError(GsWorkerError):
+  """Raised if a Ghostscript worker job has timed out."""
+
+
+class GsWorker(object):
+  """A long-lived Ghostscript process running PostScript files as jobs.
+
+  The PostScript request loop is psproc.GS_WORKER. Jobs can use the
+  procedures defined in psproc.GENERIC without loading it.
+  """
+
+  __slots__ = ['_proc', 'pid']
+
+  READY_MARKER = '\n:GsWorkerReady:\n'
+
+  def __init__(self, timeout=None):
+    """Starts the Ghostscript worker process.
+
+    Args:
+      timeout: None or the maximum number of seconds to wait for the startup.
+    Raises:
+      GsWorkerStartError: .
+    """
+    self._proc = None
+    self.pid = os.getpid()  # Of the process which has started the worker.
+    ps_file_name = TMP_PREFIX + 'gsworker.tmp.ps'
+    f = open(ps_file_name, 'wb')
+    try:
+      f.write('%!PS-Adobe-3.0\n')
+      f.write(psproc.GENERIC)
+      f.write(psproc.GS_WORKER)
+    finally:
+      f.close()
+    # We need -dNOSAFER (which is the default before Ghostscript 9.50),
+    # because the jobs read and write temporary files which are not
+    # specified on the command line.
+    gs_cmd = (
+        '%s -q -P- -dNOPAUSE -dBATCH -dNOSAFER -sDEVICE=nullpage -f %s' %
+        (GetGsCommand(), ShellQuoteFileName(ps_file_name, is_gs=True)))
+    LogInfo('starting Ghostscript worker: %s' % gs_cmd)
+    if NeedToolLogOutput():
+      stderr = None
+    else:
+      stderr = open(os.devnull, 'wb')
+    try:
+      try:
+        self._proc = subprocess.Popen(
+            gs_cmd, shell=True, bufsize=0, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=stderr, close_fds=True,
+            preexec_fn=os.setsid)  # For killing gs with the shell.
+        self._ReadUntil(self.READY_MARKER, 0, timeout)
+      except (OSError, GsWorkerError), e:
+        self.Kill()
+        raise GsWorkerStartError('cannot start Ghostscript worker: %s' % e)
+    finally:
+      if stderr is not None:
+        stderr.close()
+      # Ghostscript keeps it open, but it won't read it again.
+      os.remove(ps_file_name)
+
+  def IsRunning(self):
+    return self._proc is not None and self._proc.poll() is None
+
+  def Kill(self):
+    """Kills the worker process (if running), without waiting for jobs."""
+    proc = self._proc
+    if proc is None:
+      return
+    self._proc = None
+    try:
+      os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:  # Already exited.
+      pass
+    proc.stdin.close()
+    proc.stdout.close()
+    proc.wait()
+
+  def Close(self):
+    """Makes the worker process exit, and waits for it."""
+    proc = self._proc
+    if proc is None:
+      return
+    self._proc = None
+    try:
+      proc.stdin.close()  # The request loop exits at EOF.
+    except IOError:
+      pass
+    proc.stdout.close()
+    proc.wait()
+
+  def _ReadUntil(self, marker, extra_size, timeout):
+    """Reads the output of the worker until marker and extra_size bytes.
+
+    Args:
+      marker: str to wait for on the output.
+      extra_size: Number of bytes to read after marker.
+      timeout: None or the maximum number of seconds to wait for marker.
+    Returns:
+      A tuple (output, extra), where output is the output before marker,
+      and extra is the str of extra_size bytes after marker.
+    Raises:
+      GsJobTimeoutError: The worker is killed.
+      GsWorkerError: The worker has exited. The worker is killed.
+    """
+    fd = self._proc.stdout.fileno()
+    if timeout:
+      deadline = time.time() + timeout
+    keep_size = len(marker) + extra_size
+    chunks = []
+    size = 0
+    tail = ''
+    while 1:
+      if timeout:
+        wait = deadline - time.time()
+        if wait <= 0 or not select.select((fd,), (), (), wait)[0]:
+          self.Kill()
+          raise GsJobTimeoutError(
+              'Ghostscript worker job has timed out after %s seconds' %
+              timeout)
+      chunk = os.read(fd, 65536)
+      if not chunk:
+        self.Kill()
+        raise GsWorkerError('Ghostscript worker has exited')
+      chunks.append(chunk)
+      size += len(chunk)
+      window = tail + chunk
+      i = window.find(marker)
+      if i >= 0 and i + keep_size <= len(window):
+        i += size - len(window)
+        data = ''.join(chunks)
+        return data[:i], data[i + len(marker) : i + keep_size]
+      tail = window[-keep_size:]
+
+  def RunJob(self, ps_file_name, params, timeout=None):
+    """Runs a PostScript file in the worker.
+
+    Args:
+      ps_file_name: Name of the PostScript file to run.
+      params: dict mapping names to str values, to be defined in userdict
+        during the job (like -s...=... on the Ghostscript command line).
+      timeout: None or the maximum number of seconds to wait for the job.
+    Returns:
+      A tuple (status, output), where status is 0 on success and 1 if there
+      was a PostScript error, and output is the stdout of the job.
+    Raises:
+      GsWorkerError: The worker is killed.
+    """
+    if self._proc is None:
+      raise GsWorkerError('Ghostscript worker is not running')
+    # The random nonce makes sure that the job output can't fake the end
+    # of the job.
+    nonce = '%016x' % random.getrandbits(64)
+    request = ['<%s> <%s>' % (nonce.encode('hex'),
+                              ps_file_name.encode('hex'))]
+    for key in sorted(params):
+      request.append(' /%s <%s>' % (key, params[key].encode('hex')))
+    request.append('\n')
+    try:
+      self._proc.stdin.write(''.join(request))
+      self._proc.stdin.flush()
+    except (IOError, OSError), e:
+      self.Kill()
+      raise GsWorkerError('cannot send job to Ghostscript worker: %s' % e)
+    output, status = self._ReadUntil(
+        '\n:GsJobDone:%s:' % nonce, 2, timeout)
+    if status not in ('0\n', '1\n'):
+      self.Kill()
+      raise GsWorkerError('bad job status from Ghostscript worker: %r' %
+                          status)
+    return int(status[0]), output
+
+
+class GsWorkerPool(object):
+  """A pool of long-lived Ghostscript worker processes.
+
+  Workers are started on demand, and they are restarted after a crash or a
+  timeout.
+  """
+
+  __slots__ = ['timeout', '_idle_workers']
+
+  def __init__(self, timeout=None):
+    """Initializes the pool.
+
+    Args:
+      timeout: None or the maximum number of seconds to wait for a job.
+    """
+    self.timeout = timeout
+    self._idle_workers = []
+
+  @classmethod
+  def IsSupported(cls):
+    """Returns bool indicating whether workers can run on this system."""
+    return (not sys.platform.startswith('win') and hasattr(os, 'setsid') and
+            hasattr(os, 'killpg'))
+
+  def RunJob(self, ps_file_name, params):
+    """Runs a PostScript file in an idle worker, see GsWorker.RunJob."""
+    idle_workers = self._idle_workers
+    pid = os.getpid()
+    worker = None
+    while idle_workers:
+      worker = idle_workers.pop()
+      if worker.pid == pid and worker.IsRunning():
+        break
+      if worker.pid == pid:
+        worker.Kill()  # Crashed while idle.
+      worker = None  # Don't use workers inherited from the parent process.
+    if worker is None:
+      worker = GsWorker(timeout=self.timeout)
+    result = worker.RunJob(ps_file_name, params, timeout=self.timeout)
+    idle_workers.append(worker)
+    return result
+
+  def Close(self):
+    """Makes all idle workers exit."""
+    pid = os.getpid()
+    for worker in self._idle_workers:
+      if worker.pid == pid:
+        worker.Close()
+    del self._idle_workers[:]
+
+
+def RunGsJob(ps_file_name, params):
+  """Runs a PostScript file in a Ghostscript worker of GS_WORKER_POOL.
+
+  Args:
+    ps_file_name: Name of the PostScript file to run.
+    params: dict mapping names to str values, to be defined during the job
+      (like -s...=... on the Ghostscript command line).
+  Returns:
+    None if there is no usable worker pool or the worker has failed (then the
+    caller should run Ghostscript directly), otherwise a tuple (status,
+    output), where status is nonzero on failure, and output is the stdout of
+    the job.
+  """
+  global GS_WORKER_POOL
+  pool = GS_WORKER_POOL
+  if pool is None:
+    return None
+  try:
+    return pool.RunJob(ps_file_name, params)
+  except GsWorkerStartError, e:
+    LogWarning('%s, not using Ghostscript workers' % e)
+    pool.Close()
+    GS_WORKER_POOL = None
+    return None
+  except GsJobTimeoutError, e:
+    # Running it again without a worker would take even longer.
+    LogError(str(e))
+    return 2, ''
+  except GsWorkerError, e:
+    LogWarning('%s, retrying the job without a worker' % e)
+    return None
+
+
+class ImageCache(object):
+  """An on-disk cache of the output files of image optimizers.
+
+  Each cache entry is a file in dir_name, named after the SHA-256 of the
+  input file, the command (without the file names) and the fingerprint of
+  the executable of the command. The mtime of the entry files is updated
+  on each use, and Prune removes the least recently used ones.
+
+  It's OK for multiple threads and processes to use the same directory.
+  """
+
+  __slots__ = ['dir_name', 'max_size', 'hit_count', 'miss_count',
+               '_tool_fingerprints']
+
+  IMAGE_CACHE_FORMAT = 'pdfsizeopt-image-cache-1'
+  """Format version of the entry files."""
+
+  ENTRY_SUFFIX = '.image.cache'
+
+  def __init__(self, dir_name, max_size):
+    """Initializes the cache.
+
+    Args:
+      dir_name: Name of the directory to keep the entries in. Will be
+        created on demand.
+      max_size: Maximum total size of the entry files (in bytes) to be kept
+        by Prune.
+    """
+    self.dir_name = dir_name
+    self.max_size = max_size
+    self.hit_count = self.miss_count = 0
+    # Maps executable names to fingerprint strs.
+    self._tool_fingerprints = {}
+
+  def GetToolFingerprint(self, cmd):
+    """Returns a str which changes when the executable of cmd is upgraded.
+
+    Asking the tool for its version would be slow and tool-specific, so the
+    size and mtime of the executable file is used instead.
+    """
+    words = cmd.split(None, 1)
+    if not words:
+      return ''
+    prog = words[0]
+    fingerprint = self._tool_fingerprints.get(prog)
+    if fingerprint is None:
+      path_name = FindExeOnPath(prog)
+      fingerprint = ''
+      if path_name is not None:
+        try:
+          st = os.stat(path_name)
+          fingerprint = '%s:%d:%d' % (
+              os.path.abspath(path_name), st.st_size, int(st.st_mtime))
+        except OSError:
+          pass
+      self._tool_fingerprints[prog] = fingerprint
+    return fingerprint
+
+  def GetKey(self, sourcefn, cmd):
+    """Returns a hex str identifying the output of cmd run on sourcefn.
+
+    Args:
+      sourcefn: Name of the input file.
+      cmd: The command to run, with the file names replaced by placeholders
+        (keeping the extensions, because some tools use them to detect the
+        file format).
+    """
+    data_hash = hashlib.sha256()
+    f = open(sourcefn, 'rb')
+    try:
+      while 1:
+        data = f.read(65536)
+        if not data:
+          break
+        data_hash.update(data)
+    finally:
+      f.close()
+    key_hash = hashlib.sha256()
+    key_hash.update('%s\0%s\0%s\0' % (
+        self.IMAGE_CACHE_FORMAT, cmd, self.GetToolFingerprint(cmd)))
+    key_hash.update(data_hash.digest())
+    return key_hash.hexdigest()
+
+  def Get(self, key):
+    """Returns None or a tuple (status, data) saved by Put."""
+    file_name = os.path.join(self.dir_name, key + self.ENTRY_SUFFIX)
+    try:
+      f = open(file_name, 'rb')
+    except IOError:
+      self.miss_count += 1
+      return None
+    try:
+      entry_data = f.read()
+    finally:
+      f.close()
+    try:
+      cache_format, status, data = marshal.loads(entry_data)
+    except (ValueError, EOFError, TypeError):
+      LogWarning('ignoring corrupt image cache entry: %s' % file_name)
+      self.miss_count += 1
+      return None
+    if cache_format != self.IMAGE_CACHE_FORMAT:
+      self.miss_count += 1
+      return None
+    try:
+      os.utime(file_name, None)  # Mark it as recently used.
+    except OSError:
+      pass
+    self.hit_count += 1
+    return status, data
+
+  def Put(self, key, status, data):
+    """Saves the exit status and the output file data of a command."""
+    file_name = os.path.join(self.dir_name, key + self.ENTRY_SUFFIX)
+    tmp_file_name = '%s.%d.%08x.tmp' % (
+        file_name, os.getpid(), random.getrandbits(32))
+    try:
+      if not os.path.isdir(self.dir_name):
+        try:
+          os.makedirs(self.dir_name)
+        except OSError:
+          if not os.path.isdir(self.dir_name):  # Not created by others.
+            raise
+      f = open(tmp_file_name, 'wb')
+      try:
+        f.write(marshal.dumps((self.IMAGE_CACHE_FORMAT, status, data)))
+      finally:
+        f.close()
+      Rename(tmp_file_name, file_name)
+    except (IOError, OSError), e:
+      LogWarning('could not write image cache entry %s: %s' % (file_name, e))
+
+  def Prune(self):
+    """Removes the least recently used entries above self.max_size.
+
+    Returns:
+      The number of entries removed.
+    """
+    try:
+      entry_names = os.listdir(self.dir_name)
+    except OSError:
+      return 0
+    entries = []
+    for entry_name in entry_names:
+      if entry_name.endswith(self.ENTRY_SUFFIX):
+        file_name = os.path.join(self.dir_name, entry_name)
+        try:
+          st = os.stat(file_name)
+        except OSError:
+          continue  # Removed by another process.
+        entries.append((-st.st_mtime, entry_name, st.st_size))
+    entries.sort()
+    total_size = 0
+    removed_count = 0
+    for _, entry_name, size in entries:
+      total_size += size
+      if total_size > self.max_size:
+        try:
+          os.remove(os.path.join(self.dir_name, entry_name))
+          removed_count += 1
+        except OSError:
+          pass
+    return removed_count
+
+
+class ImageTimeBudget(object):
+  """Per-image and per-document time budget for optional image optimizers.
+
+  The running time of an image optimizer is predicted from the number of
+  bits in the uncompressed image. Initially built-in rates (seconds per
+  megabit) are used for the prediction, and they are updated with the rates
+  measured while running the optimizers. Optimizers predicted not to finish
+  within the remaining budget are skipped, and the others are killed when
+  the budget runs out.
+  """
+
+  __slots__ = ['image_budget', 'doc_deadline', '_rates']
+
+  DEFAULT_SECONDS_PER_MEGABIT = {
+      'pngout': 2.0,
+      'zopflipng': 3.0,
+      'pngwolf': 3.0,
+      'ect': 1.0,
+      'advpng': 1.0,
+      'optipng': 0.5,
+      'jbig2': 0.05,
+  }
+  """Rough running time of the optimizers on a typical CPU."""
+
+  EXPECTED_GAINS = {
+      'pngout': 0.08,
+      'zopflipng': 0.08,
+      'pngwolf': 0.08,
+      'ect': 0.08,
+      'advpng': 0.04,
+      'optipng': 0.03,
+      'jbig2': 0.5,
+  }
+  """Rough expected size reduction ratio after sam2p or imgdataopt."""
+
+  def __init__(self, image_budget=None, doc_budget=None):
+    """Initializes the budget, starting the per-document time now.
+
+    Args:
+      image_budget: None or the number of seconds the optional optimizers
+        may run for a single image.
+      doc_budget: None or the number of seconds the optional optimizers may
+        run for all images in the document.
+    """
+    self.image_budget = image_budget
+    self.doc_deadline = None
+    if doc_budget is not None:
+      self.doc_deadline = time.time() + doc_budget
+    # Maps tool names to measured seconds per megabit.
+    self._rates = {}
+
+  @classmethod
+  def GetToolName(cls, cmd_name):
+    """Returns the tool name (key of DEFAULT_SECONDS_PER_MEGABIT) or None."""
+    for tool_name in cls.DEFAULT_SECONDS_PER_MEGABIT:
+      if tool_name in cmd_name:
+        return tool_name
+    return None
+
+  def Predict(self, cmd_name, bit_count):
+    """Returns the predicted running time of cmd_name in seconds."""
+    tool_name = self.GetToolName(cmd_name)
+    rate = self._rates.get(tool_name)
+    if rate is None:
+      rate = self.DEFAULT_SECONDS_PER_MEGABIT.get(tool_name, 0.5)
+    return rate * bit_count / 1e6
+
+  def Record(self, cmd_name, bit_count, seconds):
+    """Updates the rate of cmd_name with a measured running time."""
+    if bit_count <= 0:
+      return
+    tool_name = self.GetToolName(cmd_name)
+    rate = seconds * 1e6 / bit_count
+    old_rate = self._rates.get(tool_name)
+    if old_rate is not None:
+      rate = (rate + old_rate) / 2.0
+    self._rates[tool_name] = rate
+
+  def SortCmdItems(self, cmd_items, bit_count):
+    """Sorts cmd_items by decreasing expected gain per second.
+
+    Args:
+      cmd_items: List of (cmd_name, cmd_pattern) pairs.
+      bit_count: Number of bits in the uncompressed image.
+    Returns:
+      A new, sorted list. The sort is stable.
+    """
+    items = []
+    for i in xrange(len(cmd_items)):
+      cmd_name = cmd_items[i][0]
+      gain = self.EXPECTED_GAINS.get(self.GetToolName(cmd_name), 0.05)
+      items.append(
+          (-gain / max(self.Predict(cmd_name, bit_count), 1e-3), i))
+    items.sort()
+    return [cmd_items[i] for _, i in items]
+
+  def GetImageDeadline(self):
+    """Returns None or the time.time() value when an image must be done."""
+    deadline = self.doc_deadline
+    if self.image_budget is not None:
+      image_deadline = time.time() + self.image_budget
+      if deadline is None or image_deadline < deadline:
+        deadline = image_deadline
+    return deadline
+
+
+def LockFile(file_name):
+  """Acquires an exclusive inter-process lock for updating file_name.
+
+  The lock is held on file_name + '.lock' (created if needed), because
+  file_name itself is replaced by Rename. Blocks until the lock is acquired.
+
+  Args:
+    file_name: Name of the file to be updated.
+  Returns:
+    An object to be passed to UnlockFile, or None if locking is not supported
+    (e.g. on Windows) or it has failed. In the latter case the caller
+    should proceed without the lock.
+  """
+  if fcntl is None:
+    return None
+  try:
+    f = open(file_name + '.lock', 'ab')
+  except IOError, e:
+    LogWarning('could not open lock file: %s' % e)
+    return None
+  try:
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+  except IOError, e:
+    f.close()
+    LogWarning('could not lock file %s: %s' % (f.name, e))
+    return None
+  return f
+
+
+def UnlockFile(lock):
+  """Releases a lock returned by LockFile."""
+  if lock is not None:
+    lock.close()  # This also releases the flock.
+
+
+class ImageOptimizerStats(object):
+  """Statistics of image optimizer outcomes, by image class.
+
+  For each image class (see GetImageClass) and optimizer command name, it
+  keeps [run_count, win_count, total_gain, total_seconds], where win_count
+  is the number of runs in which the optimizer has produced the smallest
+  image (ties included), and total_gain is the total number of bytes saved
+  compared to the sam2p_np (or imgdataopt) image.
+
+  It's OK to use it from multiple threads.
+  """
+
+  __slots__ = ['file_name', '_counts', '_new_counts', '_skip_counts', '_lock']
+
+  IMAGE_STATS_FORMAT = 'pdfsizeopt-image-stats-1'
+  """Format version of the statistics file."""
+
+  MIN_RUN_COUNT = 10
+  """Minimum number of runs before an optimizer can be found losing."""
+
+  RETRY_PERIOD = 20
+  """A losing optimizer is still run on every RETRY_PERIOD-th image."""
+
+  def __init__(self, file_name):
+    self.file_name = file_name
+    # Maps image class strs to dicts mapping cmd_names to lists of counts.
+    self._counts = {}
+    # Like self._counts, but only the runs since the last Load or Save.
+    self._new_counts = {}
+    # Maps (image_class, cmd_name) pairs to the number of skips by IsLosing.
+    self._skip_counts = {}
+    self._lock = threading.Lock()
+
+  @classmethod
+  def GetImageClass(cls, image):
+    """Returns a str describing the color_type, bpc and size of image."""
+    pixel_count = image.width * image.height
+    size_class = 0
+    while pixel_count >> (size_class * 2 + 2):  # Multiples of 4.
+      size_class += 1
+    return '%s-%d-%d' % (image.color_type, image.bpc, size_class)
+
+  @classmethod
+  def _AddCounts(cls, to_counts, from_counts):
+    for image_class, cmd_counts in from_counts.iteritems():
+      to_cmd_counts = to_counts.setdefault(image_class, {})
+      for cmd_name, counts in cmd_counts.iteritems():
+        to_list = to_cmd_counts.setdefault(cmd_name, [0, 0, 0, 0.0])
+        for i in xrange(4):
+          to_list[i] += counts[i]
+
+  def _ReadFile(self):
+    """Returns the counts dict in self.file_name (or an empty dict)."""
+    try:
+      f = open(self.file_name, 'rb')
+    except IOError:
+      return {}
+    try:
+      data = f.read()
+    finally:
+      f.close()
+    try:
+      stats_format, counts = marshal.loads(data)
+    except (ValueError, EOFError, TypeError):
+      LogWarning('ignoring corrupt image stats file: %s' % self.file_name)
+      return {}
+    if stats_format != self.IMAGE_STATS_FORMAT or not isinstance(counts, dict):
+      return {}
+    return counts
+
+  def Load(self):
+    """Loads the statistics from self.file_name. Returns self."""
+    self._lock.acquire()
+    try:
+      self._counts = self._ReadFile()
+      self._AddCounts(self._counts, self._new_counts)
+    finally:
+      self._lock.release()
+    return self
+
+  def Save(self):
+    """Adds the new runs to the statistics in self.file_name.
+
+    The file is read again first (while holding a file lock), so runs
+    recorded by other processes in the meantime are kept.
+    """
+    self._lock.acquire()
+    file_lock = LockFile(self.file_name)
+    try:
+      counts = self._ReadFile()
+      self._AddCounts(counts, self._new_counts)
+      tmp_file_name = '%s.%d.tmp' % (self.file_name, os.getpid())
+      try:
+        f = open(tmp_file_name, 'wb')
+        try:
+          f.write(marshal.dumps((self.IMAGE_STATS_FORMAT, counts)))
+        finally:
+          f.close()
+        Rename(tmp_file_name, self.file_name)
+      except (IOError, OSError), e:
+        LogWarning('could not write image stats file %s: %s' %
+                   (self.file_name, e))
+        return
+      self._counts = counts
+      self._new_counts = {}
+    finally:
+      UnlockFile(file_lock)
+      self._lock.release()
+
+  def GetCounts(self, image_class, cmd_name):
+    """Returns None or [run_count, win_count, total_gain, total_seconds]."""
+    return self._counts.get(image_class, {}).get(cmd_name)
+
+  def IsLosing(self, image_class, cmd_name):
+    """Returns bool indicating whether cmd_name has never won in many runs.
+
+    Every RETRY_PERIOD-th time it would return True for the same image_class
+    and cmd_name, it returns False instead, so that the optimizer is run
+    again, and it can recover (e.g. after an upgrade of the optimizer).
+    """
+    counts = self.GetCounts(image_class, cmd_name)
+    if not (counts and counts[0] >= self.MIN_RUN_COUNT and not counts[1]):
+      return False
+    key = (image_class, cmd_name)
+    self._lock.acquire()
+    try:
+      skip_count = self._skip_counts.get(key, 0) + 1
+      if skip_count >= self.RETRY_PERIOD:
+        skip_count = 0
+      self._skip_counts[key] = skip_count
+    finally:
+      self._lock.release()
+    return bool(skip_count)
+
+  def RecordImage(self, image_class, baseline_size, other_sizes, cmd_results):
+    """Records the outcome of the optimizers run on an image.
+
+    Args:
+      image_class: Return value of GetImageClass.
+      baseline_size: Size of the sam2p_np (or imgdataopt) image data.
+      other_sizes: List of sizes of other candidate images (e.g. sam2p_pr).
+      cmd_results: List of (cmd_name, size, seconds) tuples, size is None if
+        the optimizer hasn't produced an image.
+    """
+    sizes = [size for _, size, _ in cmd_results if size is not None]
+    min_size = min(sizes + list(other_sizes) + [baseline_size])
+    self._lock.acquire()
+    try:
+      for counts_dict in (self._counts, self._new_counts):
+        cmd_counts = counts_dict.setdefault(image_class, {})
+        for cmd_name, size, seconds in cmd_results:
+          counts = cmd_counts.setdefault(cmd_name, [0, 0, 0, 0.0])
+          counts[0] += 1
+          if size is not None:
+            counts[1] += int(size <= min_size)
+            counts[2] += baseline_size - size
+          counts[3] += seconds
+    finally:
+      self._lock.release()
+
+
+class ObjFingerprints(object):
+  """Fingerprints of the stream objs in PDFs written by pdfsizeopt.
+
+  Used for incremental re-optimization: a stream obj in the input PDF with a
+  known fingerprint has been written by pdfsizeopt before (and it hasn't
+  changed since then), so there is no need to optimize it again.
+
+  The fingerprint doesn't depend on the object numbers in references, the
+  order of dict keys or whitespace in the obj head, so it doesn't change when
+  pdfsizeopt renumbers the objs. It depends on flags_key, so an obj recorded
+  by a run with some optimizations disabled (e.g. --do-optimize-images=no)
+  will be optimized by a later run with them enabled.
+  """
+
+  __slots__ = ['file_name', 'flags_key', '_fingerprints', '_new_fingerprints']
+
+  FINGERPRINTS_FORMAT = 'pdfsizeopt-fingerprints-1'
+  """Format version of the fingerprints file."""
+
+  MAX_FINGERPRINT_COUNT = 1 << 20
+  """Maximum number of fingerprints in the file, the oldest are dropped."""
+
+  def __init__(self, file_name, flags_key=''):
+    self.file_name = file_name
+    # str identifying the optimizations done, see GetFingerprintFlagsKey.
+    self.flags_key = flags_key
+    self._fingerprints = set()
+    # List of fingerprints added since the last Load or Save, in order.
+    self._new_fingerprints = []
+
+  def GetFingerprint(self, obj):
+    """Returns the fingerprint (a 16-byte str) of a stream obj."""
+    if obj.stream is None:
+      raise UnexpectedStreamError('expected stream obj')
+    head = PdfObj.CompressValue(obj.head, do_emit_strings_as_hex=True)
+    try:
+      head = PdfObj.CanonicalizeDictOrder(head)
+    except PdfTokenParseError:
+      pass
+    fingerprint = hashlib.sha256(self.flags_key)
+    fingerprint.update('\0')
+    fingerprint.update(PdfObj.PDF_SIMPLE2_REF_RE.sub('0 0 R', head))
+    fingerprint.update('\0')
+    fingerprint.update(obj.stream)
+    return fingerprint.digest()[:16]
+
+  def _ReadFile(self):
+    """Returns the list of fingerprints in self.file_name, oldest first."""
+    try:
+      f = open(self.file_name, 'rb')
+    except IOError:
+      return []
+    try:
+      data = f.read()
+    finally:
+      f.close()
+    try:
+      fingerprints_format, fingerprints = marshal.loads(data)
+    except (ValueError, EOFError, TypeError):
+      LogWarning('ignoring corrupt fingerprints file: %s' % self.file_name)
+      return []
+    if (fingerprints_format != self.FINGERPRINTS_FORMAT or
+        not isinstance(fingerprints, list)):
+      return []
+    return fingerprints
+
+  def Load(self):
+    """Loads the fingerprints from self.file_name. Returns self."""
+    self._fingerprints = set(self._ReadFile())
+    self._fingerprints.update(self._new_fingerprints)
+    return self
+
+  def Save(self):
+    """Adds the new fingerprints to self.file_name.
+
+    The file is read again first (while holding a file lock), so
+    fingerprints added by other processes in the meantime are kept.
+    """
+    new_fingerprints = set(self._new_fingerprints)
+    file_lock = LockFile(self.file_name)
+    try:
+      fingerprints = [fingerprint for fingerprint in self._ReadFile()
+                      if fingerprint not in new_fingerprints]
+      fingerprints.extend(self._new_fingerprints)
+      del fingerprints[:-self.MAX_FINGERPRINT_COUNT]
+      tmp_file_name = '%s.%d.tmp' % (self.file_name, os.getpid())
+      try:
+        f = open(tmp_file_name, 'wb')
+        try:
+          f.write(marshal.dumps((self.FINGERPRINTS_FORMAT, fingerprints)))
+        finally:
+          f.close()
+        Rename(tmp_file_name, self.file_name)
+      except (IOError, OSError), e:
+        LogWarning('could not write fingerprints file %s: %s' %
+                   (self.file_name, e))
+        return
+    finally:
+      UnlockFile(file_lock)
+    self._fingerprints = set(fingerprints)
+    self._new_fingerprints = []
+
+  def HasObj(self, obj):
+    """Returns bool indicating whether stream obj has a known fingerprint."""
+    return self.GetFingerprint(obj) in self._fingerprints
+
+  def AddObj(self, obj):
+    """Adds the fingerprint of stream obj. Call Save to save it."""
+    fingerprint = self.GetFingerprint(obj)
+    if fingerprint not in self._fingerprints:
+      self._fingerprints.add(fingerprint)
+      self._new_fingerprints.append(fingerprint)
+
+
 def RedirectOutputUnix(cmd, mode=False):
   """Returns cmd with output redirected.
 
@@ -480,6 +1493,41 @@ RedirectOutput = (RedirectOutputUnix, RedirectOutputWindows)[
     sys.platform.startswith('win')]
 
 
+def SystemWithTimeout(cmd, timeout=None):
+  """Runs a shell command like os.system, but kills it after timeout.
+
+  Args:
+    cmd: The shell command to run.
+    timeout: None or the maximum number of seconds to wait for cmd. Ignored
+      on systems without process groups (e.g. Windows).
+  Returns:
+    None if cmd has timed out (then cmd and its child processes are killed),
+    otherwise the exit status in the format of os.system.
+  """
+  if (timeout is None or sys.platform.startswith('win') or
+      not hasattr(os, 'setsid') or not hasattr(os, 'killpg')):
+    return os.system(cmd)
+  # Use a new process group, so that the children of the shell are also
+  # killed.
+  proc = subprocess.Popen(cmd, shell=True, preexec_fn=os.setsid)
+  deadline = time.time() + timeout
+  sleep_time = 0.01
+  while proc.poll() is None:
+    now = time.time()
+    if now >= deadline:
+      try:
+        os.killpg(proc.pid, signal.SIGKILL)
+      except OSError:
+        pass
+      proc.wait()
+      return None
+    time.sleep(min(sleep_time, deadline - now))
+    sleep_time = min(sleep_time * 2, 0.25)
+  if proc.returncode < 0:  # Killed by a signal.
+    return -proc.returncode
+  return proc.returncode << 8
+
+
 def FindMultivalentJar(file_name):
   """Find Multivalent.jar
 
@@ -646,6 +1694,17 @@ def ShellQuoteFileName(string, is_gs=False):
   return ShellQuote(string)
 
 
+def FlateCompress(data):
+  """Compresses data in zlib format (for /FlateDecode) with FLATE_COMPRESSOR.
+
+  This is for data written to the output PDF, thus it's worth to spend more
+  time (see --flate-effort=...) on it.
+  """
+  if FLATE_COMPRESSOR is None:
+    return zlib.compress(data, 9)
+  return FLATE_COMPRESSOR.Compress(data)
+
+
 def FormatPercent(num, den):
   if den == 0:
     return '?%'
@@ -747,6 +1806,127 @@ def PermissiveZlibDecompress(data):
     return data
 
 
+def MapFileForReading(f):
+  """Returns a read-only mmap.mmap of the entire file f, or None.
+
+  The mapping remains valid after f is closed. None is returned if the file
+  is empty or it cannot be mapped (e.g. because it's a pipe).
+
+  Args:
+    f: File object opened for reading.
+  Returns:
+    An mmap.mmap object or None.
+  """
+  try:
+    f.seek(0, 2)
+    size = f.tell()
+    f.seek(0, 0)
+    if size <= 0:
+      return None
+    return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+  except (EnvironmentError, ValueError, OverflowError):
+    return None
+
+
+def GetJobCount(jobs):
+  """Returns the number of worker processes to use for parallel work.
+
+  The workers are forked, and they inherit the data to work on from the
+  parent process, so parallel processing is disabled on systems without
+  os.fork (e.g. Windows), and also on Python 2.4 and 2.5, which don't have
+  the multiprocessing module.
+
+  Args:
+    jobs: Value of the --jobs=... flag: 0 means the number of CPUs.
+  Returns:
+    A positive integer, 1 means no parallel processing.
+  """
+  if multiprocessing is None or not hasattr(os, 'fork'):
+    return 1
+  return GetThreadCount(jobs)
+
+
+def GetThreadCount(jobs):
+  """Returns the number of threads to use for parallel work.
+
+  Unlike GetJobCount, it works without os.fork and multiprocessing.
+
+  Args:
+    jobs: Value of the --jobs=... flag: 0 means the number of CPUs.
+  Returns:
+    A positive integer, 1 means no parallel processing.
+  """
+  if not jobs:
+    jobs = GetCpuCount()
+  return max(1, jobs)
+
+
+def GetCpuCount():
+  """Returns the number of CPUs (at least 1), or 1 if unknown."""
+  if multiprocessing is not None:
+    try:
+      return max(1, multiprocessing.cpu_count())
+    except NotImplementedError:
+      pass
+  try:
+    return max(1, int(os.sysconf('SC_NPROCESSORS_ONLN')))
+  except (AttributeError, ValueError, OSError):
+    pass
+  try:
+    return max(1, int(os.getenv('NUMBER_OF_PROCESSORS', '')))  # Windows.
+  except ValueError:
+    return 1
+
+
+def RunInThreads(funcs, jobs):
+  """Calls each function in funcs (without args), using jobs threads.
+
+  This is useful for functions which spend most of their time waiting for
+  external processes (e.g. in os.system), because the GIL is released
+  meanwhile.
+
+  Args:
+    funcs: List of callables.
+    jobs: Maximum number of threads to use. If at most 1, the functions are
+      called in the current thread, in order.
+  Returns:
+    List of return values, in the order of funcs.
+  Raises:
+    Whatever the first failing function (in the order of funcs) has raised,
+    including SystemExit (e.g. LogFatal). After a failure, functions not
+    started yet are not called.
+  """
+  if jobs <= 1 or len(funcs) <= 1:
+    return [func() for func in funcs]
+  results = [None] * len(funcs)
+  exc_infos = {}
+  queue = Queue.Queue()
+  for i in xrange(len(funcs)):
+    queue.put(i)
+
+  def Worker():
+    while not exc_infos:
+      try:
+        i = queue.get_nowait()
+      except Queue.Empty:
+        break
+      try:
+        results[i] = funcs[i]()
+      except:
+        exc_infos[i] = sys.exc_info()
+
+  threads = [threading.Thread(target=Worker)
+             for _ in xrange(min(jobs, len(funcs)))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if exc_infos:
+    exc_info = exc_infos[min(exc_infos)]
+    raise exc_info[0], exc_info[1], exc_info[2]
+  return results
+
+
 NONWORD_RE = re.compile(r'\W+')
 
 
@@ -867,12 +2047,19 @@ class PdfObj(object):
   PdfObj provides convenience methods Set and Get for manipulating PDF objects
   of type dict and stream.
 
+  A PdfObj can also be a lazy stub (created by PdfObj.NewLazy), which
+  remembers the location of the unparsed object in the source data, and
+  parses it when its head or stream is first accessed.
+
   Attributes:
     _head: stripped string between `obj' and (`stream' or `endobj')
     _cache: ParseDict(self._head) or None.
-    stream: stripped string between `stream' and `endstream', or None
+    _stream: stripped string between `stream' and `endstream', or None
+    _lazy: None, or a tuple (data, obj_num, file_ofs, objs,
+      do_ignore_generation_numbers, is_parse_error_ok) if self is a lazy stub
+      not parsed yet.
   """
-  __slots__ = ['_head', 'stream', '_cache']
+  __slots__ = ['_head', '_stream', '_cache', '_lazy']
 
   PDF_WHITESPACE_CHARS = '\0\t\n\r\f '
   """String containing all PDF whitespace characters."""
@@ -1282,6 +2469,9 @@ class PdfObj(object):
   simple tokens, possibly concatenated by a single space.
   """
 
+  PDF_CLOSE_TO_OPEN = {'>>': '<<', ']': '['}
+  """Maps a PDF dict-close or array-close token to the corresponding opener."""
+
   PDF_FONT_FILE_KEYS = ('FontFile', 'FontFile2', 'FontFile3')
   """Tuple of keys in /Type/FontDescriptor referring to the font data obj."""
 
@@ -1312,7 +2502,8 @@ class PdfObj(object):
   """
 
   def __init__(self, other, objs=None, file_ofs=0, start=0, end_ofs_out=None,
-               do_ignore_generation_numbers=False, is_ilstream_ok=False):
+               do_ignore_generation_numbers=False, is_ilstream_ok=False,
+               stream_ofs_out=None):
     """Initialize from other.
 
     If other is a PdfObj, copy everything. Otherwise, if other is a string,
@@ -1340,20 +2531,23 @@ class PdfObj(object):
         generation numbers in references when parsing this object.
       is_ilstream_ok: bool indicating whether it is OK for the obj to have a
         stream with an indirect length.
+      stream_ofs_out: None or an empty array output parameter for the start
+        offset of the stream data in other. Nothing is appended if there is
+        no stream.
     Raises:
       PdfTokenParseError: .
       PdfUnexpectedIlStreamError: .
       PdfIndirectLengthError: .
       Exception: Many others.
     """
-    self._cache = None
+    self._cache = self._lazy = None
     if not isinstance(other, (str, buffer)):
       if isinstance(other, PdfObj):
         self._head = other.head
-        self.stream = other.stream
+        self._stream = other.stream
       elif other is None:
         self._head = None
-        self.stream = None
+        self._stream = None
       else:
         raise TypeError(type(other))
       return
@@ -1388,7 +2582,7 @@ class PdfObj(object):
     self._head = head
 
     if stream_start_idx is None:
-      self.stream = None
+      self._stream = None
       if head.startswith('<<'):
         if '/Filter' in head:
           self.Set('Filter', None)
@@ -1473,10 +2667,85 @@ class PdfObj(object):
     else:
       if end_ofs_out is not None:
         end_ofs_out.append(stream_end_idx + match.end())
-    self.stream = other[stream_start_idx : stream_end_idx]
+    self._stream = other[stream_start_idx : stream_end_idx]
+    if stream_ofs_out is not None:
+      stream_ofs_out.append(stream_start_idx)
     if isinstance(self.Get('Filter'), str):
       self.Set('Filter', self.ExpandAbbreviations(self.Get('Filter')))
 
+  @classmethod
+  def NewLazy(cls, data, obj_num, objs, file_ofs=0,
+              do_ignore_generation_numbers=False, is_parse_error_ok=True):
+    """Creates a lazy stub PdfObj, to be parsed from data on first access.
+
+    Args:
+      data: str or buffer containing the full obj (`X Y obj ... endobj' +
+        garbage), as accepted by PdfObj.__init__. It is kept referenced (not
+        copied) until the stub is parsed.
+      obj_num: The object number, used in error messages.
+      objs: A dictionary mapping object numbers to existing PdfObj objects,
+        for resolving an indirect /Length. It will be looked up at parse time,
+        so it may be filled later.
+      file_ofs: Offset of data in the file. Used for error message generation.
+      do_ignore_generation_numbers: As in PdfObj.__init__.
+      is_parse_error_ok: bool indicating what to do if data can't be parsed.
+        If true, the obj becomes `null' (with a single warning), and
+        IsUnparsable returns true for it, otherwise the PdfTokenParseError is
+        raised at the first access.
+    Returns:
+      The new PdfObj instance.
+    """
+    obj = cls(None)
+    obj._lazy = (data, obj_num, file_ofs, objs, do_ignore_generation_numbers,
+                 is_parse_error_ok)
+    return obj
+
+  def _ParseLazy(self):
+    """Returns a new, fully parsed PdfObj from self._lazy."""
+    (data, obj_num, file_ofs, objs, do_ignore_generation_numbers,
+     is_parse_error_ok) = self._lazy
+    if data is None:  # Known to be unparsable.
+      return PdfObj('0 0 obj null endobj')
+    try:
+      return PdfObj(data, objs=objs, file_ofs=file_ofs,
+                    do_ignore_generation_numbers=do_ignore_generation_numbers)
+    except PdfTokenParseError, e:
+      if not is_parse_error_ok:
+        raise
+      LogWarning(
+          'cannot parse obj %d: %s.%s: %s' %
+          (obj_num, e.__class__.__module__, e.__class__.__name__, e))
+      # Remember the failure, so that Peek won't parse and warn again.
+      self._lazy = (None,) + self._lazy[1:]
+      return PdfObj('0 0 obj null endobj')
+
+  def IsUnparsable(self):
+    """Returns bool indicating whether self is a stub which failed to parse.
+
+    Such a stub behaves like `null'. When loading eagerly, unparsable objs
+    are skipped instead, and PdfData.RemoveUnusedObjs removes these stubs
+    to match that.
+    """
+    return self._lazy is not None and self._lazy[0] is None
+
+  def _Materialize(self):
+    """Parses a lazy stub to self, so it won't be lazy anymore."""
+    obj = self._ParseLazy()
+    self._head = obj._head
+    self._stream = obj._stream
+    self._cache = obj._cache
+    self._lazy = None
+
+  def Peek(self):
+    """Returns self or, for lazy stubs, a temporary parsed copy of self.
+
+    This can be used for reading a stub without keeping the parsed head and
+    stream data in memory.
+    """
+    if self._lazy is None:
+      return self
+    return self._ParseLazy()
+
   @classmethod
   def ParseTokensToSafe(cls, data, start=0, end_ofs_out=None,
                         do_expect_endobj=False, do_expect_startxref=False,
@@ -1745,6 +3014,10 @@ class PdfObj(object):
   def AppendTo(self, output, obj_num, do_emit_short_unsafe=False):
     """Append serialized self to output list, using obj_num."""
     # TODO(pts): Test this method.
+    if self._lazy is not None:
+      # Don't keep the parsed copy of an untouched lazy stub.
+      self._ParseLazy().AppendTo(output, obj_num, do_emit_short_unsafe)
+      return
     output.append('%s 0 obj\n' % int(obj_num))
     head = self.head.strip(self.PDF_WHITESPACE_CHARS)
     if do_emit_short_unsafe:
@@ -1772,17 +3045,33 @@ class PdfObj(object):
       output.append('%sendobj\n' % space)
 
   def __GetHead(self):
+    if self._lazy is not None:
+      self._Materialize()
     if self._head is None and self._cache is not None:
       self._head = self.SerializeDict(self._cache)
     return self._head
 
   def __SetHead(self, head):
+    if self._lazy is not None:
+      self._Materialize()
     if head != self._head:  # Works for None as well.
       self._head = head
       self._cache = None
 
   head = property(__GetHead, __SetHead)
 
+  def __GetStream(self):
+    if self._lazy is not None:
+      self._Materialize()
+    return self._stream
+
+  def __SetStream(self, stream):
+    if self._lazy is not None:
+      self._Materialize()
+    self._stream = stream
+
+  stream = property(__GetStream, __SetStream)
+
   @property
   def size(self):  # GetSize().
     # + 20 for obj...endobj, + 20 for the xref entry
@@ -1866,6 +3155,8 @@ class PdfObj(object):
     """
     if key.startswith('/'):
       raise TypeError('slash in the key= argument')
+    if self._lazy is not None:
+      self._Materialize()
     if self._cache is None:
       assert self._head is not None
       self._CheckDictHead(self.head)
@@ -1895,6 +3186,8 @@ class PdfObj(object):
       value = self.ParseSimpleValue(value)
     else:
       self.SerializeSimpleValue(value)  # just for the TypeError
+    if self._lazy is not None:
+      self._Materialize()
     if self._cache is None:
       assert self._head is not None
       self._CheckDictHead(self.head)
@@ -1910,6 +3203,86 @@ class PdfObj(object):
         self._cache[key] = value
         self._head = None  # self.__GetHead will regenerate it.
 
+  @classmethod
+  def GetDictItemSize(cls, key, value):
+    """Returns the size of a key--value pair as serialized by SerializeDict.
+
+    Args:
+      key: str, the key, without the slash.
+      value: str, the value, as returned by cls.SerializeSimpleValue.
+    """
+    return len(key) + len(value) + 1 + (value[0] not in '<({[/\0\t\n\r\f %')
+
+  def GetStreamSizeFunc(self):
+    """Returns a function to compute self.size for a different stream.
+
+    Computing the size this way is much faster than making a copy of self
+    (with PdfObj(self)), changing the stream and /Length, /Filter and
+    /DecodeParms in the copy, and then querying the size of the copy. That's
+    because the copy of the head wouldn't have to be parsed, modified and
+    serialized.
+
+    Returns:
+      A function taking (stream_size, filter_value=None, decodeparms=None),
+      and returning the value self.size would have after setting self.stream
+      to a str of size stream_size, /Length to stream_size, /Filter to
+      filter_value and /DecodeParms to decodeparms (None means removing the
+      key). The function doesn't change self.
+    """
+    if self._lazy is not None:
+      self._Materialize()
+    if self._cache is None:
+      assert self._head is not None
+      self._CheckDictHead(self.head)
+      self._cache = self.ParseDict(self._head)
+    cache = self._cache
+    # self.Set keeps self._head if none of the values change.
+    head = self._head
+    old_format = (
+        cache.get('Length'), cache.get('Filter'), cache.get('DecodeParms'))
+    get_dict_item_size = self.GetDictItemSize
+    parse_simple_value = self.ParseSimpleValue
+    serialize_simple_value = self.SerializeSimpleValue
+    # + 4 for '<<' and '>>', + 52 for obj...endobj, stream...endstream and
+    # the xref entry.
+    base_size = 56
+    for key, value in cache.iteritems():
+      if key not in ('Length', 'Filter', 'DecodeParms'):
+        base_size += get_dict_item_size(key, serialize_simple_value(value))
+
+    def GetStreamSize(stream_size, filter_value=None, decodeparms=None):
+      if filter_value is not None:
+        filter_value = parse_simple_value(filter_value)
+      if decodeparms is not None:
+        decodeparms = parse_simple_value(decodeparms)
+      if (head is not None and
+          (stream_size, filter_value, decodeparms) == old_format):
+        return len(head) + stream_size + 52
+      size = base_size + stream_size + get_dict_item_size(
+          'Length', str(stream_size))
+      if filter_value is not None:
+        size += get_dict_item_size(
+            'Filter', serialize_simple_value(filter_value))
+      if decodeparms is not None:
+        size += get_dict_item_size(
+            'DecodeParms', serialize_simple_value(decodeparms))
+      return size
+
+    return GetStreamSize
+
+  @classmethod
+  def GetMinFlateSize(cls, data_size):
+    """Returns a lower bound for len(FlateCompress(data)).
+
+    The bound is cheap, but loose: it's based on 1032:1 being the maximum
+    compression ratio of Flate (2 bits for each copy of 258 bytes), and the
+    zlib header, an empty Flate block and the checksum taking 8 bytes.
+
+    Args:
+      data_size: int, len(data).
+    """
+    return 8 + data_size // 1032
+
   def SetStreamAndCompress(self, data, may_keep_old=False, is_flate_ok=True,
                            predictor_width=None, pdf=None):
     """Set self.stream, compress it and set /Length, /Filter and /DecodeParms.
@@ -1921,75 +3294,64 @@ class PdfObj(object):
     one which produces the smallest output: original, uncompressed, ZIP, ZIP
     with the PNG y-predictor, ZIP with the TIFF predictor acting as an
     y-predictor.
+
+    The sizes of the candidates are computed without making copies of self,
+    and a ZIP candidate is skipped (without running the predictor or
+    compressing) if the lower bound of its size (see GetMinFlateSize) isn't
+    smaller than the best size so far. Only the best candidate is applied to
+    self.
     """
     if not isinstance(data, str):
       raise TypeError
 
-    items = [[None, 'uncompressed', PdfObj(self)]]
-    items[-1][2].stream = data
-    items[-1][2].Set('Length', len(items[-1][2].stream))
-    items[-1][2].Set('Filter', None)
-    items[-1][2].Set('DecodeParms', None)
-    items[-1][0] = items[-1][2].size
+    get_stream_size = self.GetStreamSizeFunc()
+    # List of [size, method, stream, filter_value, decodeparms]. For method
+    # '0old', self is kept unchanged.
+    items = [[get_stream_size(len(data)), 'uncompressed', data, None, None]]
+
+    def IsWorthCompressing(data_size, decodeparms=None):
+      """Returns bool indicating whether a ZIP candidate can be the best.
+
+      Ties are not worth it, because methods tried earlier have a name
+      comparing smaller, and the name is the tie breaker.
+      """
+      return get_stream_size(self.GetMinFlateSize(data_size), '/FlateDecode',
+                             decodeparms) < min([item[0] for item in items])
+
+    def AddFlateItem(method, data, decodeparms=None):
+      stream = FlateCompress(data)
+      items.append([get_stream_size(len(stream), '/FlateDecode', decodeparms),
+                    method, stream, '/FlateDecode', decodeparms])
 
     if data:
-      if is_flate_ok:
-        items.append([None, 'zip', PdfObj(self)])
-        items[-1][2].stream = zlib.compress(data, 9)
-        items[-1][2].Set('Length', len(items[-1][2].stream))
-        items[-1][2].Set('Filter', '/FlateDecode')
-        items[-1][2].Set('DecodeParms', None)
-        items[-1][0] = items[-1][2].size
+      if may_keep_old:
+        items.append([self.size, '0old', None, None, None])
+
+      if is_flate_ok and IsWorthCompressing(len(data)):
+        AddFlateItem('zip', data)
 
       if predictor_width is not None and is_flate_ok:
         assert isinstance(predictor_width, int)
         assert len(data) % predictor_width == 0
 
-        output = []
-        output.append('\x00')  # no-predictor mark
-        output.append(data[:predictor_width])
-        i = predictor_width
-        while i < len(data):
-          output.append('\x02')  # y-predictor mark
-          b = bytearray(data[i : i + predictor_width])
-          k = i - predictor_width
-          for j in xrange(predictor_width):  # Implement the y predictor.
-            b[j] = (b[j] - ord(data[k + j])) & 255
-          output.append(bytearray_tostring(b))
-          i += predictor_width
-        items.append([None, 'zip-pred10', PdfObj(self)])
-        items[-1][2].stream = zlib.compress(''.join(output), 9)
-        items[-1][2].Set('Length', len(items[-1][2].stream))
-        items[-1][2].Set('Filter', '/FlateDecode')
         # Oddly enough, Multivalent fails if /Predictor 10 or /Predictor 11
         # is specified for the /Type /XRef obj; but it succeeds with
         # /Predictor 12. See https://github.com/pts/pdfsizeopt/issues/56
         # for example PDF 1206.3686v1.pdf .
-        items[-1][2].Set('DecodeParms',
-                         '<</Predictor 12/Columns %d>>' % predictor_width)
-        items[-1][0] = items[-1][2].size
-
-        output = []
-        output.append(data[:predictor_width])
-        i = predictor_width
-        while i < len(data):
-          b = bytearray(data[i : i + predictor_width])
-          k = i - predictor_width
-          for j in xrange(predictor_width):  # Implement the y predictor.
-            b[j] = (b[j] - ord(data[k + j])) & 255
-          output.append(bytearray_tostring(b))
-          i += predictor_width
-        items.append([None, 'zip-pred2', PdfObj(self)])
-        items[-1][2].stream = zlib.compress(''.join(output), 9)
-        items[-1][2].Set('Length', len(items[-1][2].stream))
-        items[-1][2].Set('Filter', '/FlateDecode')
-        items[-1][2].Set('DecodeParms',
-                         '<</Predictor 2/Colors %d/Columns %d>>' %
-                         (predictor_width, len(data) / predictor_width))
-        items[-1][0] = items[-1][2].size
-
-      if may_keep_old:
-        items.append([self.size, '0old', self])
+        decodeparms = '<</Predictor 12/Columns %d>>' % predictor_width
+        if IsWorthCompressing(len(data) + len(data) // predictor_width,
+                              decodeparms):
+          output = filters.PredictPng(data, predictor_width, filter_type=2)
+          AddFlateItem('zip-pred10', output, decodeparms)
+
+        decodeparms = '<</Predictor 2/Colors %d/Columns %d>>' % (
+            predictor_width, len(data) / predictor_width)
+        if IsWorthCompressing(len(data), decodeparms):
+          # A single row of len(data) / predictor_width pixels, each pixel
+          # being a row of the original data, so it's a y-predictor.
+          output = filters.PredictTiff(
+              data, len(data) / predictor_width, predictor_width)
+          AddFlateItem('zip-pred2', output, decodeparms)
 
     def CompareStr(a, b):
       return (a < b and -1) or (a > b and 1) or 0
@@ -1999,12 +3361,13 @@ class PdfObj(object):
       return a[0].__cmp__(b[0]) or CompareStr(a[1], b[1])
 
     items.sort(CompareSize)
-    if items[0][2] is not self:
-      self.stream = items[0][2].stream
-      self.Set('Length', len(self.stream))
-      self.Set('Filter', items[0][2].Get('Filter'))
-      self.Set('DecodeParms', items[0][2].Get('DecodeParms'))
-      if (pdf and items[0][1] == 'zip-pred2' and predictor_width > 4 and
+    size, method, stream, filter_value, decodeparms = items[0]
+    if method != '0old':
+      self.stream = stream
+      self.Set('Length', len(stream))
+      self.Set('Filter', filter_value)
+      self.Set('DecodeParms', decodeparms)
+      if (pdf and method == 'zip-pred2' and predictor_width > 4 and
           pdf.version < '1.3'):
         pdf.version = '1.3'
 
@@ -2909,6 +4272,77 @@ class PdfObj(object):
     output.append('>>')
     return ''.join(output)
 
+  @classmethod
+  def CanonicalizeDictOrder(cls, data):
+    """Sorts the keys of all dicts in a compact PDF token sequence.
+
+    Args:
+      data: String containing a PDF token sequence, as returned by
+        cls.CompressValue(..., do_emit_strings_as_hex=True).
+    Returns:
+      String containing the same PDF token sequence, with the key--value pairs
+      of all dicts (recursively) sorted by key, without superfluous
+      whitespace. Dicts with duplicate keys are kept in their original order.
+    Raises:
+      PdfTokenParseError: If data is not a sequence of simple PDF tokens.
+    """
+    if '<<' not in data:
+      return data
+    # Each item of the stack is a list of items (serialized values) of an open
+    # dict or array, starting with the '<<' or '['.
+    stack = [[]]
+    scanner = cls.PDF_SIMPLE_TOKEN_RE.scanner(data)
+    match = scanner.match()
+    last_end = 0
+    while match:
+      last_end = match.end()
+      token = match.group()
+      if token == ' ':
+        pass
+      elif token == '<<' or token == '[':
+        stack.append([token])
+      elif token == '>>' or token == ']':
+        items = stack.pop()
+        if not stack or items[0] != cls.PDF_CLOSE_TO_OPEN[token]:
+          raise PdfTokenParseError('unexpected %s' % token)
+        if token == '>>' and len(items) & 1:
+          keys = items[1::2]
+          if keys != sorted(keys) and len(set(keys)) == len(keys):
+            pairs = [(items[i], items[i + 1])
+                     for i in xrange(1, len(items), 2)]
+            pairs.sort()
+            del items[1:]
+            for key, value in pairs:
+              items.append(key)
+              items.append(value)
+        items.append(token)
+        stack[-1].append(cls._JoinCompactTokens(items))
+      elif (token == 'R' and len(stack[-1]) >= 2 and
+            stack[-1][-1].isdigit() and stack[-1][-2].isdigit()):
+        stack[-1][-2:] = ['%s %s R' % (stack[-1][-2], stack[-1][-1])]
+      else:
+        stack[-1].append(token)
+      match = scanner.match()
+    if last_end != len(data):
+      raise PdfTokenParseError(
+          'syntax error at %r...' % data[last_end : last_end + 32])
+    if len(stack) != 1:
+      raise PdfTokenParseError('data structures not closed')
+    return cls._JoinCompactTokens(stack[0])
+
+  @classmethod
+  def _JoinCompactTokens(cls, items):
+    """Joins PDF tokens, adding a space only where needed."""
+    output = []
+    prev = None
+    for item in items:
+      if (prev is not None and prev[-1] not in '<>)[]{}' and
+          item[0] not in '/<>([]{}'):
+        output.append(' ')
+      output.append(item)
+      prev = item
+    return ''.join(output)
+
   @classmethod
   def SerializePdfStringSafe(cls, data):
     """Serializes a string as a PDF string: (...) if safe, otherwise <...>."""
@@ -3588,21 +5022,52 @@ class PdfObj(object):
     return (self.stream is not None and
             ('/Filter' not in self.head or self.Get('Filter') in (None, '[]')))
 
-  def GetUncompressedStream(self, objs=None):
+  def GetUncompressedStream(self, objs=None, prefetched=None):
     """Returns the uncompressed stream data in this obj.
 
     Args:
       objs: None or a dict mapping object numbers to PdfObj objects. It will be
         passed to ResolveReferences.
+      prefetched: None or the value for self in the dict returned by
+        PdfObj.PrefetchUncompressedStreams (or the value yielded by
+        PdfData.YieldPrefetchedStreams): the uncompressed data or the
+        exception to raise.
     Returns:
       A string containing the stream data in this obj uncompressed.
     Raises:
       FilterNotImplementedError: .
       FilterError: .
     """
+    if prefetched is not None:
+      if isinstance(prefetched, Exception):
+        raise prefetched
+      return prefetched
+    decode_filter = self._GetDecodeFilter(objs)
+    if decode_filter is None:
+      return self.stream
+    filter_value, decodeparms = decode_filter
+    if self.IsDecodableInProcess(filter_value, decodeparms):
+      return self.DecodeInProcess(self.stream, filter_value, decodeparms)
+    data = self.DecodeWithGs(((filter_value, decodeparms, self.stream),))[0]
+    if isinstance(data, Exception):
+      raise data
+    return data
+
+  def _GetDecodeFilter(self, objs):
+    """Returns None or (filter_value, decodeparms) for decompression.
+
+    Args:
+      objs: As in GetUncompressedStream.
+    Returns:
+      None if the stream is not compressed, otherwise a tuple
+      (filter_value, decodeparms) of strings, with references resolved.
+    Raises:
+      FilterNotImplementedError: .
+      FilterError: .
+    """
     if self.HasUncompressedStream():
       assert self.stream is not None
-      return self.stream
+      return None
     filter_value = self.Get('Filter')
     decodeparms = self.Get('DecodeParms') or ''
     if objs is None:
@@ -3613,78 +5078,281 @@ class PdfObj(object):
       raise FilterError('/Filter is not a str: %r' % (filter_value,))
     if not isinstance(decodeparms, str):
       raise FilterError('/DecodeParms is not a str.')
-    if (filter_value in ('/FlateDecode', '[/FlateDecode]') and
-        '/Predictor' not in decodeparms):
-      try:
-        return PermissiveZlibDecompress(self.stream)
-      except zlib.error, e:
-        raise FilterError('Flate decompression error: %s' % e)
+    if self.IsDecodableInProcess(filter_value, decodeparms):
+      return filter_value, decodeparms
     is_gs_ok = True  # TODO(pts): Add command-line flag to disable.
     if not is_gs_ok:
       raise FilterNotImplementedError(
           'filter not implemented: ' + filter_value)
     if '/JBIG2Decode' in filter_value and '/JBIG2Globals' in decodeparms:
       raise FilterNotImplementedError('/JBIG2Globals not supported.')
+    return filter_value, decodeparms
+
+  @classmethod
+  def ParseDecodeFilters(cls, filter_value, decodeparms):
+    """Parses the filter chain of a stream for DecodeInProcess.
+
+    Args:
+      filter_value: Resolved /Filter value.
+      decodeparms: Resolved /DecodeParms value or ''.
+    Returns:
+      None if the filter chain (or a filter parameter) is not supported
+      by DecodeInProcess, otherwise a list of (filter_name, parms) pairs in
+      decoding order, where filter_name is a canonical filter name (e.g.
+      '/FlateDecode'), and parms is None or a dict mapping /DecodeParms keys
+      (without the slash) to values.
+    """
+    if filter_value in ('/FlateDecode', '[/FlateDecode]') and not decodeparms:
+      return [('/FlateDecode', None)]  # Shortcut for the most common case.
+    try:
+      filter_names = cls.ParseValueRecursive(filter_value)
+      parms_list = cls.ParseValueRecursive(decodeparms or 'null')
+    except PdfTokenParseError:
+      return None
+    if not isinstance(filter_names, list):
+      filter_names = [filter_names]
+    if not isinstance(parms_list, list):
+      parms_list = [parms_list]
+    if len(parms_list) < len(filter_names):
+      parms_list.extend([None] * (len(filter_names) - len(parms_list)))
+    decode_filters = []
+    for filter_name, parms in zip(filter_names, parms_list):
+      if not isinstance(filter_name, str):
+        return None
+      filter_name = filters.FILTER_NAMES.get(filter_name)
+      if filter_name is None:
+        return None
+      if parms is not None:
+        if not isinstance(parms, dict):
+          return None
+        if filter_name in filters.PREDICTOR_FILTER_NAMES:
+          if not filters.IsPredictorSupported(parms):
+            return None
+        if filter_name == '/LZWDecode':
+          if parms.get('EarlyChange', 1) not in (0, 1):
+            return None
+      decode_filters.append((filter_name, parms))
+    return decode_filters
+
+  @classmethod
+  def IsDecodableInProcess(cls, filter_value, decodeparms):
+    """Returns bool indicating whether DecodeInProcess supports the filter."""
+    return cls.ParseDecodeFilters(filter_value, decodeparms) is not None
+
+  @classmethod
+  def DecodeInProcess(cls, data, filter_value, decodeparms):
+    """Decompresses data without Ghostscript.
+
+    Args:
+      data: str containing the compressed stream data.
+      filter_value: Resolved /Filter value, for which
+        cls.IsDecodableInProcess(filter_value, decodeparms) is true.
+      decodeparms: Resolved /DecodeParms value or ''.
+    Returns:
+      str containing the uncompressed data.
+    Raises:
+      FilterError: .
+    """
+    decode_filters = cls.ParseDecodeFilters(filter_value, decodeparms)
+    assert decode_filters is not None
+    for filter_name, parms in decode_filters:
+      try:
+        if filter_name == '/FlateDecode':
+          data = PermissiveZlibDecompress(data)
+        elif filter_name == '/LZWDecode':
+          early_change = 1
+          if parms:
+            early_change = parms.get('EarlyChange', 1)
+          data = filters.DecodeLzw(data, early_change)
+        elif filter_name == '/ASCII85Decode':
+          data = filters.DecodeAscii85(data)
+        elif filter_name == '/ASCIIHexDecode':
+          data = filters.DecodeAsciiHex(data)
+        elif filter_name == '/RunLengthDecode':
+          data = filters.DecodeRunLength(data)
+        else:
+          assert False, 'unexpected filter: %s' % filter_name
+        if filter_name in filters.PREDICTOR_FILTER_NAMES:
+          data = filters.Unpredict(data, parms)
+      except zlib.error, e:
+        raise FilterError('Flate decompression error: %s' % e)
+      except filters.FilterDecodeError, e:
+        raise FilterError('%s decompression error: %s' % (filter_name, e))
+    return data
+
+  GS_DECODE_FRAME_RE = re.compile(r'C(\d+)\n|([EF])\n')
+  """Matches the header of a frame written by the DecodeWithGs PostScript code.
+  """
+
+  @classmethod
+  def DecodeWithGs(cls, items):
+    """Decompresses multiple streams using a single Ghostscript invocation.
+
+    Args:
+      items: A sequence of (filter_value, decodeparms, data) tuples, where
+        filter_value is a resolved /Filter value, decodeparms is a resolved
+        /DecodeParms value (or '') and data is a str containing the compressed
+        stream data.
+    Returns:
+      A list of the same size as items, containing a str with the
+      uncompressed data, or a FilterError instance for each item.
+    """
+    results = [None] * len(items)
+    gs_indexes = [i for i in xrange(len(items)) if items[i][2]]
+    for i in xrange(len(items)):
+      if not items[i][2]:
+        results[i] = ''  # /SubFileDecode can't read 0 bytes.
+    if not gs_indexes:
+      return results
+    # We concatenate all compressed data to a single file, and Ghostscript
+    # reads the streams from it using /SubFileDecode. For each stream,
+    # Ghostscript writes zero or more frames of `C<size>\n<data>', and then
+    # `E\n' on success or `F\n' on a decompression error.
+    tmp_file_name = TMP_PREFIX + 'filter.tmp.bin'
+    ps_file_name = TMP_PREFIX + 'filter.tmp.ps'
+    gs_code = [
+        '/i INFN(r)file def/o(%stdout)(w)file def/s 4096 string def\n'
+        '/D{/d exch def/n exch def i exch setfileposition\n'
+        '/r i n()/SubFileDecode filter d/ReusableStreamDecode filter def\n'
+        '{r s readstring/m exch def/t exch def t length 0 gt{o(C)writestring\n'
+        'o t length 20 string cvs writestring o(\\n)writestring\n'
+        'o t writestring}if m not{exit}if}loop r closefile}bind def\n'
+        '/E{stopped{o(F\\n)writestring}{o(E\\n)writestring}ifelse clear}'
+        'bind def\n']
+    total_size = 0
+    f = open(tmp_file_name, 'wb')
+    write_ok = False
+    try:
+      for i in gs_indexes:
+        filter_value, decodeparms, data = items[i]
+        f.write(data)
+        decodeparms_pair = ''
+        if decodeparms:
+          decodeparms_pair = '/DecodeParms ' + decodeparms
+        gs_code.append(
+            '{%d %d<</CloseSource true/Intent 2/Filter %s%s>>D}E\n' %
+            (total_size, len(data), filter_value, decodeparms_pair))
+        total_size += len(data)
+      write_ok = True
+    finally:
+      f.close()
+      if not write_ok:
+        os.remove(tmp_file_name)
+    # We don't close o, because it's the stdout of a GsWorker.
+    gs_code.append('i closefile o flushfile\n')
+    f = open(ps_file_name, 'wb')
+    try:
+      f.write(''.join(gs_code))
+    finally:
+      f.close()
+    gs_code = None  # Save memory.
+    # TODO(pts): If tmp_file_name contains funny characters, Ghostscript
+    # will fails with data == ''. Fix it (possibly not use -s...="..." on
+    # Windows?).
+    gs_defilter_cmd = (
+        '%s -dNODISPLAY -dBATCH -sINFN=%s -q -P- %s' %
+        (GetGsCommand(), ShellQuoteFileName(tmp_file_name, is_gs=True),
+         ShellQuoteFileName(ps_file_name, is_gs=True)))
+    if len(gs_indexes) == 1:
+      item = items[gs_indexes[0]]
+      LogProportionalInfo(
+          'decompressing %d bytes with Ghostscript /Filter%s%s' %
+          (total_size, item[0], item[1] and '/DecodeParms ' + item[1]))
+    else:
+      LogProportionalInfo(
+          'decompressing %d streams of %d bytes with Ghostscript' %
+          (len(gs_indexes), total_size))
+    sys.stdout.flush()
+    job_result = RunGsJob(ps_file_name, {'INFN': tmp_file_name})
+    if job_result is not None:
+      status, data = job_result
+    else:
+      # We don't redirect stderr to stdout (as we do with other Ghostscript
+      # invocations), because it would interfere with the frames.
+      f = os.popen(gs_defilter_cmd, 'rb')
+      data = f.read()  # TODO(pts): Handle IOError etc.
+      status = f.close()
+    os.remove(tmp_file_name)
+    os.remove(ps_file_name)
+
+    for i, result in zip(gs_indexes, cls.ParseGsFramedOutput(
+        data, [items[j][0] for j in gs_indexes], gs_defilter_cmd, status)):
+      results[i] = result
+    return results
+
+  @classmethod
+  def ParseGsFramedOutput(cls, data, filter_values, gs_defilter_cmd='gs',
+                          status=None):
+    """Parses the output of the Ghostscript code in DecodeWithGs.
+
+    Args:
+      data: str containing the Ghostscript output.
+      filter_values: List of /Filter values, one for each stream.
+      gs_defilter_cmd: Ghostscript command, for the error message.
+      status: The exit status of Ghostscript (None or 0 on success).
+    Returns:
+      A list of the same size as filter_values, containing a str with the
+      uncompressed data, or a FilterError instance for each stream.
+    """
+    results = []
+    i = 0
+    _frame_re = cls.GS_DECODE_FRAME_RE
+    for filter_value in filter_values:
+      chunks = []
+      while 1:
+        match = _frame_re.match(data, i)
+        if not match:
+          break
+        if match.group(1) is not None:
+          i = match.end() + int(match.group(1))
+          chunks.append(data[match.end() : i])
+        else:
+          i = match.end()
+          break
+      if match and match.group(2) == 'E' and i <= len(data):
+        results.append(''.join(chunks))
+        continue
+      if match and match.group(2) == 'F':
+        results.append(FilterError(
+            'Ghostscript decompression with filter %r failed' %
+            (filter_value,)))
+        continue
+      # Garbage or truncated output, possibly because Ghostscript has
+      # failed. Report the same error for all remaining items.
+      msg = 'Ghostscript decompression with filter %r failed: %s (%r)' % (
+          filter_value, gs_defilter_cmd, data[i : i + 256])
+      if status:
+        msg += ', status=0x%x' % status
+      while len(results) < len(filter_values):
+        results.append(FilterError(msg))
+      break
+    return results
+
+  @classmethod
+  def PrefetchUncompressedStreams(cls, obj_items, objs=None):
+    """Decompresses multiple streams needing Ghostscript in a single batch.
 
-    ps_file_name = None
-    tmp_file_name = TMP_PREFIX + 'filter.tmp.bin'
-    f = open(tmp_file_name, 'wb')
-    write_ok = False
-    try:
-      f.write(self.stream)
-      write_ok = True
-    finally:
-      f.close()
-      if not write_ok:
-        os.remove(tmp_file_name)
-    decodeparms_pair = ''
-    if decodeparms:
-      decodeparms_pair = '/DecodeParms ' + decodeparms
-
-    # !! batch all decompressions, so we don't have to run gs again.
-
-    gs_code = (
-        '/i INFN(r)file<</CloseSource true '
-        '/Intent 2/Filter %s%s>>/ReusableStreamDecode filter def '
-        '/o(%%stdout)(w)file def/s 4096 string def '
-        '{i s readstring exch o exch writestring not{exit}if}loop '
-        'o closefile quit' %
-        (filter_value, decodeparms_pair))
-    if sys.platform.startswith('win'):
-      # TODO(pts): If tmp_file_name contains funny characters, Ghostscript
-      # will fails with data == ''. Fix it (possibly not use -s...="..." on
-      # Windows?).
-      ps_file_name = TMP_PREFIX + 'filter.tmp.ps'
-      f = open(ps_file_name, 'wb')
+    Args:
+      obj_items: A sequence of (key, pdf_obj) pairs.
+      objs: As in GetUncompressedStream.
+    Returns:
+      A dict mapping keys (only for streams which need Ghostscript to
+      decompress) to a str containing the uncompressed data, or an exception
+      to raise. Each value can be passed to pdf_obj.GetUncompressedStream as
+      prefetched=...
+    """
+    keys = []
+    gs_items = []
+    for key, obj in obj_items:
       try:
-        f.write(gs_code)
-      finally:
-        f.close()
-      gs_defilter_cmd = (
-          '%s -dNODISPLAY -sINFN=%s -q -P- %s' %
-          (GetGsCommand(), ShellQuoteFileName(tmp_file_name, is_gs=True),
-           ShellQuoteFileName(ps_file_name, is_gs=True)))
-    else:
-      gs_defilter_cmd = (
-          '%s -dNODISPLAY -sINFN=%s -q -P- -c %s' %
-          (GetGsCommand(), ShellQuoteFileName(tmp_file_name, is_gs=True),
-           ShellQuote(gs_code)))
-    LogProportionalInfo(
-        'decompressing %d bytes with Ghostscript '
-        '/Filter%s%s' % (len(self.stream), filter_value, decodeparms_pair))
-    sys.stdout.flush()
-    f = os.popen(RedirectOutput(gs_defilter_cmd, mode=True), 'rb')
-    # On Windows, data would start with 'Error: ' on a Ghostscript error, and
-    # data will be '' if gswin32c is not found.
-    data = f.read()  # TODO(pts): Handle IOError etc.
-    if f.close():
-      raise FilterError(
-          'Ghostscript decompression with filter %r failed: %s (%r)' %
-          (filter_value, gs_defilter_cmd, data))
-    os.remove(tmp_file_name)
-    if ps_file_name:
-      os.remove(ps_file_name)
-    return data
+        decode_filter = obj._GetDecodeFilter(objs)
+      except (FilterNotImplementedError, FilterError):
+        continue  # GetUncompressedStream will raise it again.
+      if (decode_filter is not None and
+          not cls.IsDecodableInProcess(*decode_filter)):
+        keys.append(key)
+        gs_items.append((decode_filter[0], decode_filter[1], obj.stream))
+    return dict(zip(keys, cls.DecodeWithGs(gs_items)))
 
   @classmethod
   def ResolveReferences(cls, data, objs, do_strings=False):
@@ -3819,7 +5487,7 @@ class PdfObj(object):
     # TODO(pts): Add generic recompression of all /FlateDecode filters
     #            (because Ghostscript is suboptimal everywhere).
     if self.Get('Filter') != '/FlateDecode' or new_data != data:
-      self.stream = zlib.compress(new_data, 9)
+      self.stream = FlateCompress(new_data)
       self.Set('Filter', '/FlateDecode')
       self.Set('DecodeParms', None)
       self.Set('Length', len(self.stream))
@@ -3832,11 +5500,13 @@ class PdfObj(object):
        end -= 1
      return buffer(data, start, end - start)
 
-  def ParseObjStm(self, obj_num):
+  def ParseObjStm(self, obj_num, prefetched=None):
     """Parses a /Type/ObjStm trailer_obj.
 
     Args:
       obj_num: Object number, used only in exception texts.
+      prefetched: None or the prefetched uncompressed stream, see
+        GetUncompressedStream.
     Returns:
       Tuple (compressed_obj_nums, compressed_obj_headbufs), both of items
       being lists of the same size, the first containing object numbers, the
@@ -3867,7 +5537,7 @@ class PdfObj(object):
 
     # TODO(pts): Handle the various exceptions raised by
     #            trailer_obj.GetUncompressedStream().
-    objstm_data = self.GetUncompressedStream()
+    objstm_data = self.GetUncompressedStream(prefetched=prefetched)
     rstrip_buffer = self.PdfRstripBuffer
     self = None  # Save memory.
     end_ofs_ary = []
@@ -3972,6 +5642,13 @@ class ImageData(object):
   }
   """Map a PNG color type byte value to a color_type string."""
 
+  MAX_FILTER_OPTIMIZATION_SIZE = 1 << 20
+  """Maximum uncompressed image data size for optimizing the PNG filters.
+
+  CompressToZipPng(do_optimize_filters=True) doesn't optimize larger images,
+  because the PNG Paeth filter is slow in Python.
+  """
+
   def __init__(self, other=None):
     """Initialize from other.
 
@@ -4185,9 +5862,23 @@ class ImageData(object):
     return self.compression in ('zip-png', 'zip', 'none')
 
   def CompressToZipPng(
-      self, do_try_invert=False, effort=9,
+      self, do_try_invert=False, effort=9, do_optimize_filters=False,
       _invert_table=''.join(chr(i) for i in xrange(255, -1, -1))):
-    """Compress self.idat to self.compression == 'zip-png'."""
+    """Compress self.idat to self.compression == 'zip-png'.
+
+    Args:
+      do_try_invert: bool indicating whether to invert the image data (and
+        flip self.is_inverted).
+      effort: int, the zlib compression level.
+      do_optimize_filters: bool indicating whether to try all PNG filters
+        (None, Sub, Up, Average and Paeth) for all rows, and the filters
+        picked adaptively per row (like libpng does), and keep the smallest
+        output. If false or the image is larger than
+        self.MAX_FILTER_OPTIMIZATION_SIZE, then the None filter is used for
+        all rows.
+    Returns:
+      self.
+    """
     assert self
     if self.compression == 'zip-png':
       # For testing: ./pdfsizeopt.py --use-jbig2=false --use-pngout=false \
@@ -4213,22 +5904,31 @@ class ImageData(object):
     #   pts2ep.pdf
     # For testing: http://code.google.com/p/pdfsizeopt/issues/detail?id=26
     # For testing: idat_size_mod == 1 in vrabimintest.pdf
-    output = []
+    idat = idat[:useful_idat_size]
     if do_try_invert:
-      for i in xrange(0, useful_idat_size, bytes_per_row):
-        output.append('\0')  # Select PNG None predictor for this row.
-        output.append(idat[i : i + bytes_per_row].translate(_invert_table))
+      idat = idat.translate(_invert_table)
+    # With do_optimize_filters, we pick the best predictor here (for images
+    # up to MAX_FILTER_OPTIMIZATION_SIZE), so that the in-process result is
+    # already competitive. Otherwise we use the None filter, and leave the
+    # search to the external image optimizers run by PdfData.OptimizeImages.
+    # For testing \0 vs \1: ./pdfsizeopt.py --use-pngout=false pts3.pdf
+    if (do_optimize_filters and
+        useful_idat_size <= self.MAX_FILTER_OPTIMIZATION_SIZE):
+      # None means picking the filter for each row adaptively.
+      filter_types = filters.PNG_FILTER_TYPES + (None,)
     else:
-      for i in xrange(0, useful_idat_size, bytes_per_row):
-        # We don't want to optimize here (like how libpng does) by picking the
-        # best predictor, i.e. the one which probably yields the smallest output.
-        # PdfData.OptimizeImages has much better and faster algorithms for that.
-        # For testing \0 vs \1: ./pdfsizeopt.py --use-pngout=false pts3.pdf
-        output.append('\0')  # Select PNG None predictor for this row.
-        output.append(idat[i : i + bytes_per_row])
-
-    # TODO(pts): Maybe use a smaller effort? We're not optimizing anyway.
-    self.idat = zlib.compress(''.join(output), effort)
+      filter_types = (0,)
+    best_idat = None
+    for filter_type in filter_types:
+      # TODO(pts): Maybe use a smaller effort if not do_optimize_filters?
+      #            We're not optimizing anyway.
+      output = zlib.compress(filters.PredictPng(
+          idat, self.width, self.samples_per_pixel, self.bpc,
+          filter_type=filter_type), effort)
+      if best_idat is None or len(output) < len(best_idat):
+        best_idat = output
+      output = None  # Save memory.
+    self.idat = best_idat
     self.compression = 'zip-png'
     if do_try_invert:
       self.is_inverted = not self.is_inverted
@@ -4570,10 +6270,113 @@ class ImageData(object):
     return self
 
 
+class SerializedOutput(object):
+  """Output of PdfData.AppendSerializedPdf, keeping track of the byte size.
+
+  The strings appended are either appended to a list, or written to a
+  file-like object right away (for streaming output).
+  """
+  __slots__ = ['size', '_write']
+
+  def __init__(self, output):
+    if isinstance(output, list):
+      self._write = output.append
+    elif callable(getattr(output, 'write', None)):
+      self._write = output.write
+    else:
+      raise TypeError
+    self.size = 0
+
+  def append(self, data):
+    self.size += len(data)
+    self._write(data)
+
+
+# (data, do_ignore_generation_numbers) for ParseObjsInWorker. Set by the
+# parent process before forking the workers.
+PARSE_WORKER_ARGS = None
+
+
+def ParseObjsInWorker(items):
+  """Parses a shard of objs in a worker process forked by PdfData.Load.
+
+  Args:
+    items: A list of (obj_num, start, size) tuples, describing objs within
+      PARSE_WORKER_ARGS[0].
+  Returns:
+    A list of (obj_num, kind, a, b, c) tuples. kind is 'ok' (with a being the
+    head, b being the stream and c being the offset of the stream in the
+    data, or None), 'ilstream' (the stream has an indirect /Length, parse it
+    again later) or 'error' (with a being the PdfTokenParseError class and b
+    being the message).
+  """
+  data, do_ignore_generation_numbers = PARSE_WORKER_ARGS
+  results = []
+  for obj_num, start, size in items:
+    stream_ofs_out = []
+    try:
+      obj = PdfObj(
+          buffer(data, start, size), file_ofs=start,
+          do_ignore_generation_numbers=do_ignore_generation_numbers,
+          is_ilstream_ok=True, stream_ofs_out=stream_ofs_out)
+      if stream_ofs_out:
+        results.append((obj_num, 'ok', obj.head, obj.stream,
+                        start + stream_ofs_out[0]))
+      else:
+        results.append((obj_num, 'ok', obj.head, obj.stream, None))
+    except PdfUnexpectedIlStreamError:
+      results.append((obj_num, 'ilstream', None, None, None))
+    except PdfTokenParseError, e:
+      results.append((obj_num, 'error', e.__class__, str(e), None))
+  return results
+
+
+def GetParseCodeDigest(_cache=[]):
+  """Returns a binary SHA-256 digest of the code which parses PDF files.
+
+  The digest covers the source of the main and filters modules (including
+  all methods, staticmethods and module-level helpers used for parsing)
+  and the version string, so a pdfsizeopt upgrade changes it.
+  """
+  if _cache:
+    return _cache[0]
+  code_hash = hashlib.sha256()
+  code_hash.update(GetVersionSpec(None) + '\0')
+  for module in (sys.modules[__name__], filters):
+    module_file = module.__file__
+    if module_file.endswith('.pyc') or module_file.endswith('.pyo'):
+      module_file = module_file[:-1]
+    try:
+      f = open(module_file, 'rb')
+      try:
+        source = f.read()
+      finally:
+        f.close()
+    except IOError:
+      # We'll get this if the module is within a .zip file (on $PYTHONPATH).
+      loader = getattr(module, '__loader__', None)
+      if loader is None:
+        raise
+      source = loader.get_source(module.__name__)
+      if source is None:  # Only the .pyc file is in the .zip file.
+        source = marshal.dumps(loader.get_code(module.__name__))
+    code_hash.update('%s\0%d\0' % (module.__name__, len(source)))
+    code_hash.update(source)
+  _cache.append(code_hash.digest())
+  return _cache[0]
+
+
 class PdfData(object):
 
   __slots__ = ['objs', 'trailer', 'version', 'file_name', 'file_size',
-               'do_ignore_generation_numbers', 'has_generational_objs']
+               'do_ignore_generation_numbers', 'has_generational_objs',
+               'optimized_obj_nums', 'unfinished_obj_nums']
+
+  MIN_PARALLEL_PARSE_OBJ_COUNT = 1000
+  """Minimum number of objs in a PDF for parsing them in parallel in Load.
+
+  Starting the worker processes is not worth it for fewer objs.
+  """
 
   def __init__(self, do_ignore_generation_numbers=False):
     self.do_ignore_generation_numbers = bool(do_ignore_generation_numbers)
@@ -4589,10 +6392,81 @@ class PdfData(object):
     self.version = '1.0'
     self.file_name = None
     self.file_size = None
+    # Set of object numbers of stream objs which have been optimized by a
+    # previous pdfsizeopt run (see FindOptimizedObjs). The image, font and
+    # stream optimizations skip them. Cleared by OptimizeObjs, which
+    # renumbers the objs.
+    self.optimized_obj_nums = set()
+    # Set of object numbers of stream objs which this run has left (partially)
+    # unoptimized, e.g. because of a time budget or a decompression error.
+    # RecordOptimizedObjs doesn't record them, so a later run with
+    # --fingerprints-file=... will try again. Renumbered by OptimizeObjs.
+    self.unfinished_obj_nums = set()
+
+  def FindOptimizedObjs(self, fingerprints):
+    """Finds the stream objs already optimized by a previous pdfsizeopt run.
+
+    Args:
+      fingerprints: An ObjFingerprints instance, loaded.
+    Returns:
+      self, with self.optimized_obj_nums updated.
+    """
+    stream_count = 0
+    for obj_num in sorted(self.objs):
+      obj = self.objs[obj_num].Peek()  # Keep lazy stubs lazy.
+      if obj.stream is not None:
+        stream_count += 1
+        if fingerprints.HasObj(obj):
+          self.optimized_obj_nums.add(obj_num)
+    LogInfo('found %d of %d stream objs optimized by a previous run' %
+            (len(self.optimized_obj_nums), stream_count))
+    return self
+
+  def RecordOptimizedObjs(self, fingerprints):
+    """Adds the fingerprints of the optimized stream objs to fingerprints.
+
+    Stream objs in self.unfinished_obj_nums are not added. Call this after
+    saving the PDF, and then call fingerprints.Save().
+    """
+    for obj_num in sorted(self.objs):
+      if obj_num in self.unfinished_obj_nums:
+        continue
+      obj = self.objs[obj_num].Peek()  # Keep lazy stubs lazy.
+      if obj.stream is not None:
+        fingerprints.AddObj(obj)
 
   def Load(self, file_data, is_no_objs_ok=False, is_parse_error_ok=True,
-           is_proportional=False):
-    """Load PDF from file_name to self, return self."""
+           is_proportional=False, do_mmap=False, do_lazy=False, jobs=1,
+           parse_cache_dir=None):
+    """Load PDF from file_name to self, return self.
+
+    Args:
+      file_data: File name (str) or file object to read the PDF from.
+      is_no_objs_ok: bool indicating whether it is OK to find no objs.
+      is_parse_error_ok: bool indicating whether unparsable objs should be
+        skipped (with a warning) rather than raising an exception.
+      is_proportional: bool indicating whether the info messages are
+        proportional to the input size.
+      do_mmap: bool indicating whether to map the file to memory with
+        mmap instead of reading it to a string. With mmap, the objs are
+        parsed from zero-copy buffer views, so the unparsed file data
+        doesn't count as resident memory. Falls back to reading if the file
+        cannot be mapped.
+      do_lazy: bool indicating whether to create lazy stubs (see
+        PdfObj.NewLazy) in self.objs instead of parsing each obj. A stub
+        keeps a reference to the file data (or its mapping) until it is
+        parsed on its first access. Unparsable objs are detected only at that
+        time.
+      jobs: Number of worker processes to parse objs in parallel, 0 means the
+        number of CPUs. See GetJobCount.
+      parse_cache_dir: None or the name of a directory containing parse
+        cache files. If the file data was parsed before (by the same parser
+        code), then the parsed objs are loaded from the cache, otherwise they
+        are saved to the cache after parsing. Not used with do_lazy=True.
+    Returns:
+      self.
+    """
+    mmap_obj = None
     if isinstance(file_data, str):
       # Treat file_data as file name.
       LogInfo('loading PDF from: %s' % (file_data,), is_proportional)
@@ -4601,17 +6475,55 @@ class PdfData(object):
       except IOError, e:
         LogFatal('error opening PDF (%s): %s' % (e, file_data))
       try:
-        data = f.read()
+        if do_mmap:
+          mmap_obj = MapFileForReading(f)
+        if mmap_obj is None:
+          data = f.read()
       finally:
         f.close()
     elif isinstance(file_data, file):
       f = file_data
       LogInfo('loading PDF from: %s' % (f.name,), is_proportional)
-      f.seek(0, 0)
-      data = f.read()  # Don't close.
-    LogInfo('loaded PDF of %s bytes' % len(data), is_proportional)
+      if do_mmap:
+        mmap_obj = MapFileForReading(f)
+      if mmap_obj is None:
+        f.seek(0, 0)
+        data = f.read()  # Don't close.
+    if mmap_obj is not None:
+      data = buffer(mmap_obj)
+    try:
+      return self._LoadFromData(
+          data, f.name, is_no_objs_ok=is_no_objs_ok,
+          is_parse_error_ok=is_parse_error_ok,
+          is_proportional=is_proportional, is_mapped=mmap_obj is not None,
+          do_lazy=do_lazy, jobs=jobs, parse_cache_dir=parse_cache_dir)
+    finally:
+      if mmap_obj is not None and not do_lazy:
+        # All PdfObj instances have copied their head and stream by now, so
+        # it's safe to close. Lazy stubs keep the mapping open until they
+        # are garbage collected.
+        data = None
+        mmap_obj.close()
+
+  def _LoadFromData(self, data, file_name, is_no_objs_ok, is_parse_error_ok,
+                    is_proportional, is_mapped, do_lazy, jobs,
+                    parse_cache_dir):
+    """Internal helper of Load, parses data (str or buffer) to self."""
+    if is_mapped:
+      LogInfo('mapped PDF of %s bytes' % len(data), is_proportional)
+    else:
+      LogInfo('loaded PDF of %s bytes' % len(data), is_proportional)
+    parse_cache_file_name = stream_ofs = None
+    if parse_cache_dir and not do_lazy:
+      if hashlib is None:
+        LogWarning('parse cache needs hashlib (Python 2.5), not using it')
+      else:
+        parse_cache_file_name = os.path.join(
+            parse_cache_dir, self.GetParseCacheKey(data) + '.parse.cache')
+        # Maps obj_num to the offset of its stream in data.
+        stream_ofs = {}
     self.has_generational_objs = False
-    self.file_name = f.name
+    self.file_name = file_name
     self.file_size = len(data)
     # For some PDFs, there are some junk bytes in front of thje %PDF- header.
     # Just like Google Chrome, Evince and gv, We just ignore these junk bytes,
@@ -4621,10 +6533,17 @@ class PdfData(object):
     match = PdfObj.PDF_VERSION_HEADER_RE.search(buffer(data, 0, 256))
     if not match:
       raise PdfTokenParseError('unrecognized PDF signature %r' % data[: 16])
-    data = data[match.start():]
+    if match.start():
+      # Zero-copy, also works if data is a buffer of an mmap.
+      data = buffer(data, match.start())
     self.version = match.group(1)
     self.objs = objs = {}
     self.trailer = None
+    if (parse_cache_file_name is not None and
+        self._LoadParseCache(parse_cache_file_name, data)):
+      LogInfo('loaded %d parsed objs from parse cache: %s' %
+              (len(self.objs), parse_cache_file_name), is_proportional)
+      return self
 
     try:
       try:
@@ -4721,14 +6640,40 @@ class PdfData(object):
         for i in xrange(1, len(obj_items2)))
     obj_items = None  # Save memory.
 
+    if do_lazy:
+      # Used by the stubs for resolving an indirect /Length. We fill it after
+      # all stubs are created, and we keep it separate from self.objs, so
+      # later changes in self.objs won't affect parsing.
+      length_objs = {}
+      for obj_num, obj_data in objs_to_parse:
+        objs[obj_num] = PdfObj.NewLazy(
+            obj_data, obj_num, length_objs, file_ofs=obj_starts[obj_num],
+            do_ignore_generation_numbers=self.do_ignore_generation_numbers,
+            is_parse_error_ok=is_parse_error_ok)
+      length_objs.update(objs)
+      LogInfo('created %d lazy objs' % len(objs_to_parse), is_proportional)
+      objs_to_parse = ()
+    else:
+      jobs = GetJobCount(jobs)
+      if jobs > 1 and len(objs_to_parse) >= self.MIN_PARALLEL_PARSE_OBJ_COUNT:
+        # Parses most objs, returns those which need a second pass.
+        objs_to_parse = self._ParseObjsInParallel(
+            data, objs_to_parse, obj_starts, jobs, is_parse_error_ok,
+            is_proportional, stream_ofs)
+
     objs_with_ilstream = []
+    stream_ofs_out = None
     for is_ilstream_ok in (True, False):
       for obj_num, obj_data in objs_to_parse:
+        if stream_ofs is not None:
+          stream_ofs_out = []
         try:
           self.objs[obj_num] = PdfObj(
               obj_data, objs=self.objs, file_ofs=obj_starts[obj_num],
               do_ignore_generation_numbers=self.do_ignore_generation_numbers,
-              is_ilstream_ok=is_ilstream_ok)
+              is_ilstream_ok=is_ilstream_ok, stream_ofs_out=stream_ofs_out)
+          if stream_ofs_out:
+            stream_ofs[obj_num] = obj_starts[obj_num] + stream_ofs_out[0]
         except PdfUnexpectedIlStreamError:  # Happens with is_ilstream_ok=True.
           # For testing: eurotex2006.final.pdf and lme_v6.pdf
           # Defer parsing this obj later, after we have the length objects
@@ -4751,8 +6696,181 @@ class PdfData(object):
       # Happens e.g. when no objs can be parsed.
       raise PdfNoObjsError('No objs found in PDF.')
 
+    if parse_cache_file_name is not None:
+      self._SaveParseCache(parse_cache_file_name, stream_ofs)
     return self
 
+  PARSE_CACHE_FORMAT = 'pdfsizeopt-parse-cache-1'
+  """Format version of the files written by _SaveParseCache."""
+
+  def GetParseCacheKey(self, data):
+    """Returns a hex string identifying the result of parsing data.
+
+    The key depends on the SHA-256 of data, the parse cache format, the
+    parser settings and the parser code (see GetParseCodeDigest), so a change
+    in any of these (including a pdfsizeopt upgrade) invalidates the cache.
+
+    Args:
+      data: str or buffer containing the PDF file.
+    Returns:
+      A string of 64 lowercase hex digits.
+    """
+    data_hash = hashlib.sha256()
+    data_hash.update(data)
+    key_hash = hashlib.sha256()
+    key_hash.update('%s\0%s\0%d\0%s\0' % (
+        self.PARSE_CACHE_FORMAT, marshal.version,
+        self.do_ignore_generation_numbers, GetParseCodeDigest()))
+    key_hash.update(data_hash.digest())
+    return key_hash.hexdigest()
+
+  def _SaveParseCache(self, file_name, stream_ofs):
+    """Saves the parsed objs (but not the streams) to a parse cache file.
+
+    Args:
+      file_name: Name of the parse cache file to create.
+      stream_ofs: Dict mapping obj_num to the offset of its stream in the
+        (trimmed) PDF file data. All objs with a stream must be present.
+    """
+    if self.trailer.stream is not None:
+      return
+    obj_nums = sorted(self.objs)
+    heads, stream_ofss, stream_sizes = [], [], []
+    for obj_num in obj_nums:
+      obj = self.objs[obj_num]
+      heads.append(obj.head)
+      if obj.stream is None:
+        stream_ofss.append(-1)
+        stream_sizes.append(0)
+      elif obj_num not in stream_ofs:
+        return  # Can't happen.
+      else:
+        stream_ofss.append(stream_ofs[obj_num])
+        stream_sizes.append(len(obj.stream))
+    cache_data = marshal.dumps((
+        self.PARSE_CACHE_FORMAT, self.version, self.has_generational_objs,
+        self.trailer.head, obj_nums, heads, stream_ofss, stream_sizes))
+    tmp_file_name = '%s.%d.tmp' % (file_name, os.getpid())
+    try:
+      dir_name = os.path.dirname(file_name)
+      if dir_name and not os.path.isdir(dir_name):
+        os.makedirs(dir_name)
+      f = open(tmp_file_name, 'wb')
+      try:
+        f.write(cache_data)
+      finally:
+        f.close()
+      Rename(tmp_file_name, file_name)
+    except (IOError, OSError), e:
+      LogWarning('could not write parse cache %s: %s' % (file_name, e))
+
+  def _LoadParseCache(self, file_name, data):
+    """Loads the parsed objs from a parse cache file to self.
+
+    Args:
+      file_name: Name of the parse cache file to read.
+      data: str or buffer containing the (trimmed) PDF file data. The streams
+        are copied from here.
+    Returns:
+      bool indicating whether self was loaded.
+    """
+    try:
+      f = open(file_name, 'rb')
+    except IOError:
+      return False
+    try:
+      cache_data = f.read()
+    finally:
+      f.close()
+    try:
+      (cache_format, version, has_generational_objs, trailer_head, obj_nums,
+       heads, stream_ofss, stream_sizes) = marshal.loads(cache_data)
+    except (ValueError, EOFError, TypeError):
+      LogWarning('ignoring corrupt parse cache: %s' % file_name)
+      return False
+    if cache_format != self.PARSE_CACHE_FORMAT or version != self.version:
+      return False
+    data_size = len(data)
+    objs = {}
+    for i in xrange(len(obj_nums)):
+      obj = objs[obj_nums[i]] = PdfObj(None)
+      obj.head = heads[i]
+      if stream_ofss[i] >= 0:
+        if stream_ofss[i] + stream_sizes[i] > data_size:
+          LogWarning('ignoring corrupt parse cache: %s' % file_name)
+          return False
+        obj.stream = data[stream_ofss[i] : stream_ofss[i] + stream_sizes[i]]
+    self.trailer = PdfObj(None)
+    self.trailer.head = trailer_head
+    self.has_generational_objs = has_generational_objs
+    self.objs = objs
+    return True
+
+  def _ParseObjsInParallel(self, data, objs_to_parse, obj_starts, jobs,
+                           is_parse_error_ok, is_proportional, stream_ofs):
+    """Parses objs to self.objs using multiple worker processes.
+
+    Args:
+      data: str or buffer containing the PDF file.
+      objs_to_parse: List of (obj_num, obj_data) pairs, sorted by obj_num.
+      obj_starts: Dict mapping obj_num to offset in data.
+      jobs: Number of worker processes, at least 2.
+      is_parse_error_ok: As in Load.
+      is_proportional: As in Load.
+      stream_ofs: None or a dict to be updated, mapping obj_num to the offset
+        of its stream in data.
+    Returns:
+      A list of (obj_num, obj_data) pairs with an indirect stream /Length,
+      which still have to be parsed, after the /Length objs.
+    """
+    global PARSE_WORKER_ARGS
+    # Contiguous shards by file offset, for better locality in the workers.
+    items = sorted(
+        [(obj_starts[obj_num], obj_num, len(obj_data))
+         for obj_num, obj_data in objs_to_parse])
+    # Create more shards than workers, to balance the load.
+    shard_size = max(1, (len(items) + jobs * 4 - 1) / (jobs * 4))
+    shards = []
+    for i in xrange(0, len(items), shard_size):
+      shards.append([(obj_num, start, size)
+                     for start, obj_num, size in items[i : i + shard_size]])
+    items = None  # Save memory.
+    LogInfo('parsing %d objs in %d shards with %d jobs' %
+            (len(objs_to_parse), len(shards), jobs), is_proportional)
+    PARSE_WORKER_ARGS = (data, self.do_ignore_generation_numbers)
+    try:
+      pool = multiprocessing.Pool(jobs)  # Forks now, inherits the args.
+      try:
+        results = {}
+        for shard_results in pool.imap_unordered(ParseObjsInWorker, shards):
+          for result in shard_results:
+            results[result[0]] = result
+      finally:
+        pool.terminate()  # All workers are idle by now, unless on error.
+        pool.join()
+    finally:
+      PARSE_WORKER_ARGS = None
+
+    # Process the results in obj_num order, like the sequential parser.
+    objs_with_ilstream = []
+    for obj_num, obj_data in objs_to_parse:
+      _, kind, a, b, c = results.pop(obj_num)
+      if kind == 'ok':
+        obj = PdfObj(None)
+        obj.head, obj.stream = a, b
+        self.objs[obj_num] = obj
+        if stream_ofs is not None and c is not None:
+          stream_ofs[obj_num] = c
+      elif kind == 'ilstream':
+        objs_with_ilstream.append((obj_num, obj_data))
+      else:
+        if not is_parse_error_ok:
+          raise a(b)
+        LogWarning(
+            'cannot parse obj %d: %s.%s: %s' %
+            (obj_num, a.__module__, a.__name__, b))
+    return objs_with_ilstream
+
   @classmethod
   def CheckNotEncrypted(cls, trailer_obj):
     """Raises an exception if the PDF file is encrypted."""
@@ -4968,7 +7086,14 @@ class PdfData(object):
       except PdfTokenParseError, e:
         raise PdfXrefStreamError('Parse objstm obj %d: %s' %
                                  (objstm_obj_num, e))
-      obj_streams[objstm_obj_num] = objstm_obj.ParseObjStm(objstm_obj_num)
+      obj_streams[objstm_obj_num] = objstm_obj
+    # Decompress all objstm objs which need Ghostscript in a single batch.
+    prefetched_streams = PdfObj.PrefetchUncompressedStreams(
+        obj_streams.iteritems())
+    for objstm_obj_num in sorted(obj_streams):
+      obj_streams[objstm_obj_num] = obj_streams[objstm_obj_num].ParseObjStm(
+          objstm_obj_num, prefetched_streams.pop(objstm_obj_num, None))
+    prefetched_streams = None  # Save memory.
 
     # Parse used compressed objs (in objstm objs), and add them to
     # obj_starts with the PdfObj (instead of the offset) as a value.
@@ -5218,7 +7343,7 @@ class PdfData(object):
   @classmethod
   def GenerateXrefStream(cls, obj_numbers, obj_ofs, xref_ofs, trailer_obj,
                          trailer_obj_num, objstm_obj_num, objstm_obj_numbers,
-                         is_flate_ok=True):
+                         is_flate_ok=True, objstm_groups=None):
     """Generate the xref stream for the specified trailer object.
 
     Add the appropriate, size-optimized trailer_obj.stream, add the
@@ -5245,34 +7370,46 @@ class PdfData(object):
         obj, or None.
       is_flate_ok: bool indicating if it's OK to generate xref and object
         streams with /Filter/FlateDecode.
+      objstm_groups: Sequence of (objstm_obj_num, objstm_obj_numbers) pairs
+        for multiple /Type/ObjStm objs, or None. Can't be combined with a
+        non-None objstm_obj_numbers.
     """
-    assert obj_numbers or objstm_obj_numbers
+    if objstm_obj_numbers:
+      assert not objstm_groups
+      objstm_groups = ((objstm_obj_num, objstm_obj_numbers),)
+    elif not objstm_groups:
+      objstm_groups = ()
+    assert obj_numbers or objstm_groups
     assert trailer_obj.head.startswith('<<')
     assert trailer_obj.stream is None
     assert not [obj_num for obj_num in obj_numbers if obj_ofs[obj_num] <= 0]
     assert xref_ofs not in obj_ofs
     assert trailer_obj_num not in obj_numbers  # Slow.
-    if objstm_obj_numbers:
+    for objstm_obj_num, objstm_obj_numbers in objstm_groups:
       assert trailer_obj_num not in objstm_obj_numbers  # Slow.
     need_w0 = False  # Do we need w0 be 1 instead of 0?
     max_w2 = -1
     max_obj_num = (obj_numbers and obj_numbers[-1]) or 0
-    if objstm_obj_numbers:
-      assert objstm_obj_num
+    # Maps object numbers within a /Type/ObjStm obj to the objstm obj number.
+    objstm_obj_num_of = {}
+    if objstm_groups:
       need_w0 = True
       obj_numbers = set(obj_numbers)
-      assert objstm_obj_num not in obj_numbers
       obj_numbers_size = len(obj_numbers)
-      obj_numbers.update(objstm_obj_numbers)
-      obj_numbers.add(objstm_obj_num)
-      assert (len(obj_numbers) ==
-              obj_numbers_size + len(objstm_obj_numbers) + 1), (
+      objstm_obj_numbers_rev = {}
+      for objstm_obj_num, objstm_obj_numbers in objstm_groups:
+        assert objstm_obj_num
+        assert objstm_obj_num not in obj_numbers
+        obj_numbers_size += len(objstm_obj_numbers) + 1
+        obj_numbers.update(objstm_obj_numbers)
+        obj_numbers.add(objstm_obj_num)
+        max_w2 = max(max_w2, len(objstm_obj_numbers) - 1)
+        for i, obj_num in enumerate(objstm_obj_numbers):
+          objstm_obj_numbers_rev[obj_num] = -i  # Can be 0.
+          objstm_obj_num_of[obj_num] = objstm_obj_num
+      assert len(obj_numbers) == obj_numbers_size, (
           '/Type/ObjStm and non-objstm object numbers must be disjoint.')
       obj_numbers = sorted(obj_numbers)
-      max_w2 = max(max_w2, len(objstm_obj_numbers) - 1)
-      objstm_obj_numbers_rev = {}
-      for i, obj_num in enumerate(objstm_obj_numbers):
-        objstm_obj_numbers_rev[obj_num] = -i  # Can be 0.
       ofs_list = []
       for obj_num in obj_numbers:
         if obj_num in objstm_obj_numbers_rev:
@@ -5310,7 +7447,7 @@ class PdfData(object):
                 obj_numbers[i] - 1 == trailer_obj_num):
           need_w0 = True
       max_ofs = max(max_ofs, ofs_list[i])  # Negative entries are ignored.
-    if objstm_obj_numbers:
+    for objstm_obj_num, objstm_obj_numbers in objstm_groups:
       max_ofs = max(max_ofs, objstm_obj_num)
     if trailer_obj_num != obj_numbers[-1] + 1:
       need_w0 = True
@@ -5356,7 +7493,8 @@ class PdfData(object):
           ofs_output.append(free_entry)
           done_obj_num += 1
         i += 1
-        if ofs <= 0:  # An object from the /Type/ObjStm obj.
+        if ofs <= 0:  # An object from a /Type/ObjStm obj.
+          objstm_obj_num = objstm_obj_num_of[obj_num_limit]
           ofs_output.append('\x02')
           if max_ofs_size <= 4:
             ofs_output.append(
@@ -5417,50 +7555,250 @@ class PdfData(object):
     assert self.trailer.head.startswith('<<')
     assert self.trailer.head.endswith('>>')
 
+  PDF_TYPE_IN_HEAD_RE = re.compile(
+      r'/(Type|Subtype)[\0\t\n\r\f ]*/([^/{}\[\]()<>\0\t\n\r\f %]+)')
+  """Matches a /Type or /Subtype name in a dict head."""
+
+  OBJSTM_GROUP_BY_TYPE = {
+      '/Font': 'font',
+      '/FontDescriptor': 'font',
+      '/Encoding': 'font',
+      '/Annot': 'annot',
+      '/Action': 'annot',
+      '/Border': 'annot',
+      '/Page': 'page',
+      '/Pages': 'page',
+  }
+  """Maps a /Type value to the name of its object stream group."""
+
+  MIN_OBJSTM_GROUP_SIZE = 16
+  """Object stream groups with less objects are merged to a common objstm."""
+
+  @classmethod
+  def BuildObjStm(cls, objstm_items, is_flate_ok=True):
+    """Builds a /Type/ObjStm obj.
+
+    Args:
+      objstm_items: Nonempty sequence of (obj_num, head) pairs, in the order
+        they should be emitted to the object stream.
+      is_flate_ok: bool indicating if it's OK to generate the object stream
+        with /Filter/FlateDecode.
+    Returns:
+      (objstm_obj, plain_size), where plain_size is the estimated number of
+      bytes the objects would take outside the object stream.
+    """
+    objstm_output = ['', '>']  # Sentinel for IsSpaceNeeded below.
+    objstm_size = 0  # In bytes.
+    objstm_numbers = []
+    plain_size = 0
+    for obj_num, head in objstm_items:
+      if PdfObj.IsSpaceNeeded(objstm_output[-1], head[0]):
+        objstm_output.append(' ')
+        objstm_size += 1
+      objstm_numbers.append(obj_num)
+      # If we append the wrong offset here, Ghostscript can still process
+      # the output PDF, because it ignores this offset.
+      objstm_numbers.append(objstm_size)
+      objstm_output.append(head)
+      objstm_size += len(head)
+      # This 19 includes 4 bytes in the xref stream and
+      # ' 0 obj  endobj\n'.
+      # TODO(pts): Improve the estimate of 4 bytes in the xref stream:
+      # take compression, len(w0) and len(w1) into account.
+      plain_size += 19 + len(str(obj_num)) + len(head)
+    # Replace the simulated digit.
+    objstm_output[0] = ' '.join([str(i) for i in objstm_numbers])
+    objstm_output[1] = ' ' * (
+        len(objstm_output) > 2 and
+        PdfObj.IsSpaceNeeded(objstm_output[0], objstm_output[2]))
+    objstm_first = len(objstm_output[0]) + len(objstm_output[1])
+    objstm_output = ''.join(objstm_output)
+    objstm_obj = PdfObj(None)
+    objstm_obj.head = '<<>>'
+    objstm_obj.SetStreamAndCompress(objstm_output, is_flate_ok=is_flate_ok)
+    objstm_obj.Set('Type', '/ObjStm')
+    objstm_obj.Set('N', len(objstm_items))
+    objstm_obj.Set('First', objstm_first)
+    return objstm_obj, plain_size
+
+  @classmethod
+  def EstimateObjStmXrefSize(cls, item_lists):
+    """Estimates the compressed xref stream size of the objstm entries.
+
+    Args:
+      item_lists: Sequence of object stream contents, each a sequence of
+        (obj_num, head) pairs.
+    Returns:
+      The estimated size of the compressed xref stream entries (type 2)
+      of the objects in item_lists, in bytes. Only useful for comparing
+      layouts of the same objects.
+    """
+    entries = []
+    for i in xrange(len(item_lists)):
+      item_list = item_lists[i]
+      for j in xrange(len(item_list)):
+        entries.append((item_list[j][0], i, j))
+    entries.sort()
+    # Similar to the PNG Up predictor used by GenerateXrefStream.
+    output = []
+    prev_i = prev_j = 0
+    for _, i, j in entries:
+      output.append(struct.pack('>BH', (i - prev_i) & 255,
+                                (j - prev_j) & 0xffff))
+      prev_i, prev_j = i, j
+    return len(zlib.compress(''.join(output), 9))
+
+  @classmethod
+  def LayOutObjStms(cls, objstm_items, is_flate_ok=True,
+                    do_optimize_layout=True):
+    """Distributes objects to object streams, for the smallest output.
+
+    With do_optimize_layout, these layouts are tried, and the smallest one is
+    used:
+
+    * a single object stream, objects in object number order;
+    * a single object stream, objects sorted by /Type and /Subtype, so
+      similar objects are near each other, and Flate can find more matches
+      (objects of the same type are kept in object number order, because
+      more shuffling would make the xref stream much less compressible);
+    * the same order, but objects of each group in
+      OBJSTM_GROUP_BY_TYPE (fonts, annotations, pages) in a separate object
+      stream, groups smaller than MIN_OBJSTM_GROUP_SIZE merged.
+
+    Then the object streams which would be larger than their objects
+    outside the object stream are dropped.
+
+    Args:
+      objstm_items: Nonempty sequence of (obj_num, head) pairs, in increasing
+        obj_num order.
+      is_flate_ok: bool indicating if it's OK to generate the object streams
+        with /Filter/FlateDecode.
+      do_optimize_layout: bool indicating whether to try the layouts above. If
+        false, just return a single object stream in object number order.
+    Returns:
+      List of (objstm_obj, objstm_obj_numbers) pairs, for the objects which
+      should be put to object streams. Objects not in any of the
+      objstm_obj_numbers should be emitted outside object streams.
+    """
+    if not do_optimize_layout:
+      objstm_obj = cls.BuildObjStm(objstm_items, is_flate_ok=is_flate_ok)[0]
+      LogInfo('generated object stream of %d bytes in %d objects' %
+              (len(objstm_obj.stream), len(objstm_items)))
+      return [(objstm_obj, [obj_num for obj_num, _ in objstm_items])]
+
+    type_re = cls.PDF_TYPE_IN_HEAD_RE
+    group_by_type = cls.OBJSTM_GROUP_BY_TYPE
+    # List of (group, type, subtype, obj_num, head).
+    sort_items = []
+    group_sizes = {}
+    for obj_num, head in objstm_items:
+      obj_type = obj_subtype = ''
+      if head.startswith('<<'):
+        # This may find a /Type in a nested dict, but it's good enough for
+        # grouping similar objects.
+        for match in type_re.finditer(head):
+          if match.group(1) == 'Type':
+            if not obj_type:
+              obj_type = '/' + match.group(2)
+          elif not obj_subtype:
+            obj_subtype = '/' + match.group(2)
+      group = group_by_type.get(obj_type, '')
+      group_sizes[group] = group_sizes.get(group, 0) + 1
+      sort_items.append((group, obj_type, obj_subtype, obj_num, head))
+    for group in group_sizes:
+      if group_sizes[group] < cls.MIN_OBJSTM_GROUP_SIZE:
+        group_sizes[group] = 0
+    sort_items.sort()
+
+    layouts = [('objnum', [objstm_items])]
+    layouts.append(('bytype', [[(item[3], item[4]) for item in sort_items]]))
+    groups = {}
+    for item in sort_items:
+      group = item[0]
+      if not group_sizes[group]:
+        group = ''
+      if group in groups:
+        groups[group].append((item[3], item[4]))
+      else:
+        groups[group] = [(item[3], item[4])]
+    del sort_items  # Save memory.
+    if len(groups) > 1:
+      layouts.append(('grouped', [groups[group] for group in sorted(groups)]))
+    del groups  # Save memory.
+
+    best = None
+    for layout_name, item_lists in layouts:
+      objstms = []
+      # The order of objects in the object streams also affects the size of
+      # the xref stream.
+      total_size = cls.EstimateObjStmXrefSize(item_lists)
+      for item_list in item_lists:
+        objstm_obj, plain_size = cls.BuildObjStm(
+            item_list, is_flate_ok=is_flate_ok)
+        objstms.append((objstm_obj, plain_size, item_list))
+        total_size += min(objstm_obj.size, plain_size)
+      if best is None or total_size < best[0]:
+        best = (total_size, layout_name, objstms)
+    del layouts  # Save memory.
+
+    total_size, layout_name, objstms = best
+    result = []
+    for objstm_obj, plain_size, item_list in objstms:
+      if objstm_obj.size < plain_size:
+        result.append((objstm_obj, [obj_num for obj_num, _ in item_list]))
+        LogInfo(
+            'generated object stream of %d bytes in %d objects (%s)' %
+            (len(objstm_obj.stream), len(item_list),
+             FormatPercent(objstm_obj.size, plain_size)))
+      else:
+        LogInfo('kept %d objects outside object stream, would be %d bytes' %
+                (len(item_list), len(objstm_obj.stream)))
+    LogInfo('used %s object stream layout in %d objstms' %
+            (layout_name, len(result)))
+    return result
+
   def AppendSerializedPdf(self, output,
                           do_hide_images=False,
                           do_generate_xref_stream=True,
                           do_generate_object_stream=True,
                           do_emit_short_unsafe=True,
-                          is_flate_ok=True):
-    """Appends a serialized PDF file to the list output.
+                          is_flate_ok=True,
+                          do_optimize_objstm_layout=True):
+    """Appends a serialized PDF file to the list output, or writes it.
 
     Args:
       output: A list of strings, will be appended in place. Must be empty
-        in the beginning.
+        in the beginning. Alternatively, a file-like object (with a write
+        method) positioned at the start of the PDF file, the serialized PDF
+        will be written to it object by object, without building the output
+        in memory.
       do_hide_images: bool indicating whether to hide images from Multivalent.
       do_generate_xref_stream: bool indicating if we should generate a PDF
         containing a cross-reference stream.
       do_generate_object_stream: bool indicating if we should generate a PDF
-        containing all non-stream objects packed to an object stream (objstm).
+        containing non-stream objects packed to object streams (objstm).
       do_emit_short_unsafe: bool indicating whether to emit unsafe PDF token
         squences. If true, pdfsizeopt wouldn't be able to process these strings
         further without additional parsing by PdfObj.ParseTokensToSafe. So true
         is OK for output .pdf files.
       is_flate_ok: bool indicating if it's OK to generate xref and object
         streams with /Filter/FlateDecode.
+      do_optimize_objstm_layout: bool indicating whether to group and reorder
+        the objects in the object streams for better compression (see
+        LayOutObjStms). If false, a single object stream with the objects
+        in object number order is generated.
     Returns:
       The number of bytes appended.
     """
-    if not isinstance(output, list):
-      raise TypeError
-    assert not output
+    if isinstance(output, list):
+      assert not output
+    output = SerializedOutput(output)
     # Emit header.
     if do_generate_xref_stream:
       version = max(self.version, '1.5')
     else:
       version = self.version
-    output.extend(('%PDF-', version, '\n%\xD0\xD4\xC5\xD0\n'))
-
-    output_size = [0]
-    output_size_idx = [0]
-
-    def GetOutputSize():
-      if output_size_idx[0] < len(output):
-        for i in xrange(output_size_idx[0], len(output)):
-          output_size[0] += len(output[i])
-        output_size_idx[0] = len(output)
-      return output_size[0]
+    output.append('%%PDF-%s\n%%\xD0\xD4\xC5\xD0\n' % version)
 
     # Dictionary mapping object numbers to 0-based offsets in the output file.
     obj_ofs = {}
@@ -5472,18 +7810,12 @@ class PdfData(object):
       next_obj_num = obj_numbers[-1] + 1
     else:
       next_obj_num = 0
-    objstm_obj = None
-    objstm_obj_numbers = None
+    # List of (objstm_obj, objstm_obj_numbers) pairs.
+    objstms = []
 
     if do_generate_object_stream:
-      objstm_output = ['', '>']  # Sentinel for IsSpaceNeeded below.
-      objstm_size = 0  # In bytes.
-      objstm_numbers = []
-      objstm_objcount = 0
-      objstm_overhead_size = 0
-      objstm_obj_numbers = []
-      # TODO(pts): Reorder heads (lexicographically? by size? by
-      # subtype--type? try all?) to achieve better ZIP compression.
+      # List of (obj_num, head) pairs.
+      objstm_items = []
       for obj_num in obj_numbers:
         # According the the PDF reference, object streams must not contain
         # objects: which have a stream; which have a non-zero generation
@@ -5496,7 +7828,7 @@ class PdfData(object):
         #
         # Strings in objects in an object stream must not be encrypted. We
         # ensure this, because we don't encrypt at all.
-        pdf_obj = self.objs[obj_num]
+        pdf_obj = self.objs[obj_num].Peek()  # Keep lazy stubs lazy.
         if pdf_obj.stream is None:
           # TODO(pts): Renumber objstm objects, group them together, so the
           # xref stream can be compressed to become shorter.
@@ -5511,50 +7843,17 @@ class PdfData(object):
               head = PdfObj.CompressValue(
                   head,
                   do_emit_safe_names=False, do_emit_safe_strings=False)
-            if PdfObj.IsSpaceNeeded(objstm_output[-1], head[0]):
-              objstm_output.append(' ')
-              objstm_size += 1
-            objstm_numbers.append(obj_num)
-            # If we append the wrong offset here, Ghostscript can still process
-            # the output PDF, because it ignores this offset.
-            objstm_numbers.append(objstm_size)
-            objstm_output.append(head)
-            objstm_size += len(head)
-            objstm_objcount += 1
-            # This 19 includes 4 bytes in the xref stream and
-            # ' 0 obj  endobj\n'.
-            # TODO(pts): Improve the estimate of 4 bytes in the xref stream:
-            # take compression, len(w0) and len(w1) into account.
-            objstm_overhead_size += 19 + len(str(obj_num)) + len(head)
-            objstm_obj_numbers.append(obj_num)
-      del head  # Save memory.
-      if objstm_size:
-        # TODO(pts): If the generated object stream is longer than the
-        # sum of the individual objects, don't use it.
-        # Replace the simulated digit.
-        objstm_output[0] = ' '.join(str(i) for i in objstm_numbers)
-        objstm_output[1] = ' ' * (
-            len(objstm_output) > 2 and
-            PdfObj.IsSpaceNeeded(objstm_output[0], objstm_output[2]))
-        objstm_first = len(objstm_output[0]) + len(objstm_output[1])
-        objstm_output = ''.join(objstm_output)
-        objstm_obj = PdfObj(None)
-        #sys.stdout.write(objstm_output)
-        #sys.stdout.write('\n')
-        objstm_obj.head = '<<>>'
-        # For the statistics below.
-        objstm_size = len(objstm_output) + objstm_overhead_size
-        objstm_obj.SetStreamAndCompress(objstm_output, is_flate_ok=is_flate_ok)
-        del objstm_output  # Save memory.
-        objstm_obj.Set('Type', '/ObjStm')
-        objstm_obj.Set('N', objstm_objcount)
-        objstm_obj.Set('First', objstm_first)
-        LogInfo(
-            'generated object stream of %d bytes in %d objects (%s)' %
-            (len(objstm_obj.stream), objstm_objcount,
-             FormatPercent(len(objstm_obj.stream), objstm_size)))
+            objstm_items.append((obj_num, head))
+      if objstm_items:
+        objstms = self.LayOutObjStms(
+            objstm_items, is_flate_ok=is_flate_ok,
+            do_optimize_layout=do_optimize_objstm_layout)
+      del objstm_items  # Save memory.
+      if objstms:
         i = j = 0
-        objstm_obj_numbers_set = set(objstm_obj_numbers)
+        objstm_obj_numbers_set = set()
+        for objstm_obj, objstm_obj_numbers in objstms:
+          objstm_obj_numbers_set.update(objstm_obj_numbers)
         while i < len(obj_numbers):
           if obj_numbers[i] in objstm_obj_numbers_set:
             i += 1  # Remove this object from obj_numbers.
@@ -5568,8 +7867,8 @@ class PdfData(object):
     # Emit objs outside the object stream.
     # Number of objects including missing ones.
     for obj_num in obj_numbers:
-      obj_ofs[obj_num] = GetOutputSize()
-      pdf_obj = self.objs[obj_num]
+      obj_ofs[obj_num] = output.size
+      pdf_obj = self.objs[obj_num].Peek()  # Keep lazy stubs lazy.
       if do_hide_images and pdf_obj.HasImageToHide():
         pdf_obj = PdfObj(pdf_obj)
         # We convert /Subtype/Image to /Subtype/ImagE and /Filter
@@ -5595,15 +7894,16 @@ class PdfData(object):
       pdf_obj.AppendTo(output, obj_num,
                        do_emit_short_unsafe=do_emit_short_unsafe)
 
-    if objstm_obj:
+    # List of (objstm_obj_num, objstm_obj_numbers) pairs.
+    objstm_groups = []
+    for objstm_obj, objstm_obj_numbers in objstms:
       objstm_obj_num = next_obj_num  # The largest.
       next_obj_num += 1
-      obj_ofs[objstm_obj_num] = GetOutputSize()
+      obj_ofs[objstm_obj_num] = output.size
       objstm_obj.AppendTo(output, objstm_obj_num,
                           do_emit_short_unsafe=do_emit_short_unsafe)
-    else:
-      objstm_obj_num = None
-    del objstm_obj  # Save memory.
+      objstm_groups.append((objstm_obj_num, objstm_obj_numbers))
+    del objstms  # Save memory.
 
     trailer_obj_num = next_obj_num
     next_obj_num += 1
@@ -5618,14 +7918,14 @@ class PdfData(object):
     assert trailer_obj.head.endswith('>>')
     assert trailer_obj.stream is None
 
-    xref_ofs = GetOutputSize()
+    xref_ofs = output.size
     if do_generate_xref_stream:  # Emit xref stream containing trailer.
       # Also modifies trailer_obj, setting .stream, /Size etc.
       self.GenerateXrefStream(obj_numbers=obj_numbers, obj_ofs=obj_ofs,
                               xref_ofs=xref_ofs, trailer_obj=trailer_obj,
                               trailer_obj_num=trailer_obj_num,
-                              objstm_obj_num=objstm_obj_num,
-                              objstm_obj_numbers=objstm_obj_numbers,
+                              objstm_obj_num=None, objstm_obj_numbers=None,
+                              objstm_groups=objstm_groups,
                               is_flate_ok=is_flate_ok)
       trailer_obj.AppendTo(output, trailer_obj_num,
                            do_emit_short_unsafe=do_emit_short_unsafe)
@@ -5658,7 +7958,7 @@ class PdfData(object):
 
     output.append('startxref\n%d\n' % xref_ofs)
     output.append('%%EOF\n')  # Avoid doubling % in printf().
-    return GetOutputSize()
+    return output.size
 
 
   def GetFonts(self, font_type=None,
@@ -5716,6 +8016,8 @@ class PdfData(object):
         if not match:
           continue
         font_obj_num = int(match.group(1))
+        if font_obj_num in self.optimized_obj_nums:
+          continue
         font_obj = self.objs[font_obj_num]
         # Known values: /Type1, /Type1C, /CIDFontType0C.
         subtype = font_obj.Get('Subtype')
@@ -5921,75 +8223,39 @@ class PdfData(object):
 
   @classmethod
   def ParseType1CFonts(cls, objs, ps_tmp_file_name, data_tmp_file_name,
-                       is_permissive=False):
+                       is_permissive=False, do_use_python_cff=True):
     """Converts /Subtype/Type1C objs to data structure representation.
 
     Modifies objs in place, removes unparsable and strange fonts.
+
+    If do_use_python_cff is true, parses the fonts with cff.ParseType1CFont,
+    and runs Type1CParser (via Ghostscript) only for fonts which failed.
     """
     if not objs:
       return {}
-    output = ['%!PS-Adobe-3.0\n',
-              '% Ghostscript helper parsing Type1C fonts\n',
-              '%% autogenerated by %s at %s\n' % ('pdfsizeopt', time.time())]
-    output.append(psproc.GENERIC)
-    output.append(psproc.TYPE1C_PARSER)
-    output_prefix_len = sum(map(len, output))
-    type1_size = 0
+    parsed_fonts = {}
+    gs_objs = {}
     for obj_num in sorted(objs):
-      type1_size += objs[obj_num].size
       obj = objs[obj_num]
       if obj.stream is None:
         raise ValueError('Missing stream in Type1C obj %d' % obj_num)
-      obj.CopyStreamObj().AppendTo(output, obj_num)
-    output.append('(Type1CParser: all OK\\n) print flush\n%%EOF\n')
-    output_str = ''.join(output)
-    LogInfo(
-        'writing Type1CParser (%s font bytes) to: %s' %
-        (len(output_str) - output_prefix_len, ps_tmp_file_name))
-    f = open(ps_tmp_file_name, 'wb')
-    try:
-      f.write(output_str)
-    finally:
-      f.close()
-
-    EnsureRemoved(data_tmp_file_name)
-    gs_cmd = (
-        '%s -q -P- -dNOPAUSE -dBATCH -sDEVICE=nullpage '
-        '-sDataFile=%s -f %s'
-        % (GetGsCommand(), ShellQuoteFileName(data_tmp_file_name, is_gs=True),
-           ShellQuoteFileName(ps_tmp_file_name, is_gs=True)))
-    LogInfo(
-        'executing Type1CParser with Ghostscript: %s' % gs_cmd)
-    sys.stdout.flush()
-    romode = (None, False)[NeedToolLogOutput()]
-    status = os.system(RedirectOutput(gs_cmd, mode=romode))
-    if status:
-      LogFatal('Type1CParser failed, status=0x%x' % status)
-    if not os.path.isfile(data_tmp_file_name):
-      LogFatal('Type1CParser has not created output: %s' % data_tmp_file_name)
-    # ps_tmp_file_name is usually about 5 times as large as the input of
-    # Type1CParse (pdf_tmp_file_name)
-    os.remove(ps_tmp_file_name)
-    f = open(data_tmp_file_name, 'rb')
-    try:
-      data = f.read()
-    finally:
-      f.close()
-    # So far, `data' doesn't have names converted to hex (#AB), e.g.
-    # /pedal.* remains intact, and doesn't become /pedal.#2A .
-    # PdfObj.CompressValue called by
-    # PdfObj.ParseValueRecursive does this conversion, e.g.
-    # PdfObj.ParseValueRecursive('/pedal.*') == '/pedal.#2A'.
-
-    # Dict keys are numbers, which is not valid PDF, but ParseValueRecursive
-    # accepts it.
-    # TODO(pts): This ParseValueRecursive call is a bit slow, speed it up.
-    parsed_fonts = PdfObj.ParseValueRecursive(
-        '<<%s>>' % data, do_expect_postscript_name_input=True)
-    assert isinstance(parsed_fonts, dict)
-    LogInfo('parsed %s Type1C fonts' % len(parsed_fonts))
-    assert sorted(parsed_fonts) == sorted(objs), (
-        'Data object number list mismatch.')
+      if do_use_python_cff:
+        try:
+          parsed_fonts[obj_num] = cff.ParseType1CFont(
+              obj.GetUncompressedStream())
+          continue
+        except (ValueError, IndexError, KeyError, TypeError, struct.error,
+                cff.CffUnsupportedError, FilterNotImplementedError,
+                FilterError), e:
+          LogProportionalInfo(
+              'parsing Type1C font obj %d with Ghostscript: %s' %
+              (obj_num, e))
+      gs_objs[obj_num] = obj
+    if parsed_fonts:
+      LogInfo('parsed %s Type1C fonts in Python' % len(parsed_fonts))
+    if gs_objs:
+      parsed_fonts.update(cls._ParseType1CFontsWithGs(
+          gs_objs, ps_tmp_file_name, data_tmp_file_name))
 
     def MoveToPrivate(parsed_font, key):
       if key not in parsed_font:
@@ -6055,6 +8321,83 @@ class PdfData(object):
           (len(big_charstrings_obj_nums), big_charstrings_obj_nums))
     if not is_permissive and objs_size != len(objs):
       assert 0, 'Error (see warnings above) during Type1C font parsing.'
+    return parsed_fonts
+
+  @classmethod
+  def _ParseType1CFontsWithGs(cls, objs, ps_tmp_file_name,
+                              data_tmp_file_name):
+    """Runs Type1CParser (via Ghostscript) on /Subtype/Type1C objs.
+
+    Returns:
+      dict mapping obj_num to its parsed Type1C font dictionary (or an empty
+      dict if unparsable).
+    """
+    output = ['%!PS-Adobe-3.0\n',
+              '% Ghostscript helper parsing Type1C fonts\n',
+              '%% autogenerated by %s at %s\n' % ('pdfsizeopt', time.time())]
+    output.append(psproc.GENERIC)
+    output.append(psproc.TYPE1C_PARSER)
+    output_prefix_len = sum(map(len, output))
+    for obj_num in sorted(objs):
+      objs[obj_num].CopyStreamObj().AppendTo(output, obj_num)
+    # Closing _DataFile is needed by GsWorker, which doesn't exit.
+    output.append('_DataFile closefile\n'
+                  '(Type1CParser: all OK\\n) print flush\n%%EOF\n')
+    output_str = ''.join(output)
+    LogInfo(
+        'writing Type1CParser (%s font bytes) to: %s' %
+        (len(output_str) - output_prefix_len, ps_tmp_file_name))
+    f = open(ps_tmp_file_name, 'wb')
+    try:
+      f.write(output_str)
+    finally:
+      f.close()
+
+    EnsureRemoved(data_tmp_file_name)
+    gs_cmd = (
+        '%s -q -P- -dNOPAUSE -dBATCH -sDEVICE=nullpage '
+        '-sDataFile=%s -f %s'
+        % (GetGsCommand(), ShellQuoteFileName(data_tmp_file_name, is_gs=True),
+           ShellQuoteFileName(ps_tmp_file_name, is_gs=True)))
+    LogInfo(
+        'executing Type1CParser with Ghostscript: %s' % gs_cmd)
+    sys.stdout.flush()
+    job_result = RunGsJob(ps_tmp_file_name, {'DataFile': data_tmp_file_name})
+    if job_result is not None:
+      status, job_output = job_result
+      if NeedToolLogOutput():
+        sys.stderr.write(job_output)
+      job_output = None  # Save memory.
+    else:
+      romode = (None, False)[NeedToolLogOutput()]
+      status = os.system(RedirectOutput(gs_cmd, mode=romode))
+    if status:
+      LogFatal('Type1CParser failed, status=0x%x' % status)
+    if not os.path.isfile(data_tmp_file_name):
+      LogFatal('Type1CParser has not created output: %s' % data_tmp_file_name)
+    # ps_tmp_file_name is usually about 5 times as large as the input of
+    # Type1CParse (pdf_tmp_file_name)
+    os.remove(ps_tmp_file_name)
+    f = open(data_tmp_file_name, 'rb')
+    try:
+      data = f.read()
+    finally:
+      f.close()
+    # So far, `data' doesn't have names converted to hex (#AB), e.g.
+    # /pedal.* remains intact, and doesn't become /pedal.#2A .
+    # PdfObj.CompressValue called by
+    # PdfObj.ParseValueRecursive does this conversion, e.g.
+    # PdfObj.ParseValueRecursive('/pedal.*') == '/pedal.#2A'.
+
+    # Dict keys are numbers, which is not valid PDF, but ParseValueRecursive
+    # accepts it.
+    # TODO(pts): This ParseValueRecursive call is a bit slow, speed it up.
+    parsed_fonts = PdfObj.ParseValueRecursive(
+        '<<%s>>' % data, do_expect_postscript_name_input=True)
+    assert isinstance(parsed_fonts, dict)
+    LogInfo('parsed %s Type1C fonts' % len(parsed_fonts))
+    assert sorted(parsed_fonts) == sorted(objs), (
+        'Data object number list mismatch.')
     os.remove(data_tmp_file_name)
     return parsed_fonts
 
@@ -6179,6 +8522,106 @@ class PdfData(object):
         del private_dict[key]
     return private_dict
 
+  MIN_SHARED_CHARSTRING_SIZE = 16
+  """Minimum size of a charstring to unite font groups by in bytes.
+
+  Shorter glyphs (such as /space) are too often identical in unrelated fonts.
+  """
+
+  @classmethod
+  def UniteType1CFontGroupsByGlyphs(cls, parsed_fonts, font_groups, objs):
+    """Unites font groups which have an identical glyph in common.
+
+    Builds a cross-font index of glyphs, keyed by the glyph name, the
+    charstring (which should be normalized by cff.DesubroutinizeType1CFont)
+    and the font parameters which MergeTwoType1CFonts and
+    MergeTwoType1CFontDescriptors require to be equal. Font groups (e.g. the
+    same font embedded under different names) are united if they have a
+    glyph in common, and the glyphs of the united group don't conflict.
+
+    Args:
+      parsed_fonts: dict mapping /Type/FontDescriptor obj nums to parsed
+        Type1C font dictionaries.
+      font_groups: dict mapping font group names to lists of obj nums in
+        parsed_fonts. Will be modified in place.
+      objs: dict mapping obj nums to PdfObj, containing the
+        /Type/FontDescriptor objs.
+    Returns:
+      List of lists of font group names united.
+    """
+    min_size = (cls.MIN_SHARED_CHARSTRING_SIZE << 1) + 2  # Hex.
+    glyph_index = {}  # Maps glyph keys to the first font group with it.
+    parents = {}  # Union-find forest of font groups.
+    group_charstrings = {}  # Maps font group roots to merged /CharStrings.
+
+    def FindRoot(font_group):
+      root = font_group
+      while parents[root] != root:
+        root = parents[root]
+      while parents[font_group] != root:  # Path compression.
+        parents[font_group], font_group = root, parents[font_group]
+      return root
+
+    def Unite(root_a, root_b):
+      charstrings_a = group_charstrings[root_a]
+      charstrings_b = group_charstrings[root_b]
+      if len(charstrings_a) < len(charstrings_b):
+        charstrings_a, charstrings_b = charstrings_b, charstrings_a
+      for glyph_name in charstrings_b:
+        if charstrings_a.get(glyph_name, charstrings_b[glyph_name]) != (
+            charstrings_b[glyph_name]):
+          return False  # MergeTwoType1CFonts would fail.
+      if len(charstrings_a) + len(
+          [1 for glyph_name in charstrings_b
+           if glyph_name not in charstrings_a]) > 256:
+        return False
+      charstrings_a.update(charstrings_b)
+      if root_b < root_a:
+        root_a, root_b = root_b, root_a
+      parents[root_b] = root_a
+      group_charstrings[root_a] = charstrings_a
+      del group_charstrings[root_b]
+      return True
+
+    for font_group in sorted(font_groups):
+      parents[font_group] = font_group
+      charstrings = group_charstrings[font_group] = {}
+      for obj_num in font_groups[font_group]:
+        parsed_font = parsed_fonts[obj_num]
+        for glyph_name, charstring in parsed_font['CharStrings'].iteritems():
+          charstrings.setdefault(glyph_name, charstring)
+    for font_group in sorted(font_groups):
+      for obj_num in font_groups[font_group]:
+        parsed_font = parsed_fonts[obj_num]
+        private = cls.GetStrippedPrivate(parsed_font.get('Private')) or {}
+        context = repr((
+            objs[obj_num].Get('Flags'), objs[obj_num].Get('StemH'),
+            parsed_font['FontMatrix'], parsed_font['PaintType'],
+            sorted(private.iteritems())))
+        for glyph_name, charstring in parsed_font['CharStrings'].iteritems():
+          if glyph_name == '.notdef' or len(charstring) < min_size:
+            continue
+          key = (context, glyph_name, charstring)
+          other_font_group = glyph_index.get(key)
+          if other_font_group is None:
+            glyph_index[key] = font_group
+            continue
+          root_a = FindRoot(font_group)
+          root_b = FindRoot(other_font_group)
+          if root_a != root_b:
+            Unite(root_a, root_b)
+    del glyph_index
+
+    united_groups = {}
+    for font_group in sorted(font_groups):
+      root = FindRoot(font_group)
+      if root != font_group:
+        united_groups.setdefault(root, [root]).append(font_group)
+        font_groups[root].extend(font_groups.pop(font_group))
+    for root in united_groups:
+      font_groups[root].sort()
+    return [united_groups[root] for root in sorted(united_groups)]
+
   @classmethod
   def MergeTwoType1CFonts(cls, target_font, source_font):
     """Merge source_font to target_font, modifying the latter in place.
@@ -6385,11 +8828,92 @@ class PdfData(object):
 
   @classmethod
   def SerializeType1CFonts(cls, parsed_fonts, target_objs, objs,
-                           do_double_check_type1c_output):
+                           do_double_check_type1c_output,
+                           do_use_python_cff=True,
+                           do_subroutinize_fonts=False):
     """Generates PdfObj with Type1C font data.
 
-    Runs Type1CGenerator (via Ghostscript) in a batch with each object in
-    parsed_fonts, saves the result to target_objs.
+    If do_use_python_cff is true, serializes each font in parsed_fonts with
+    cff.SerializeType1CFont (subroutinizing it first with
+    cff.SubroutinizeType1CFont if do_subroutinize_fonts is true). Runs
+    Type1CGenerator (via Ghostscript) in a batch with the remaining fonts.
+    Saves the result to target_objs.
+    """
+    loaded_objs = {}
+    gs_fonts = {}
+    for obj_num in sorted(parsed_fonts):
+      if do_use_python_cff:
+        parsed_font = parsed_fonts[obj_num]
+        if do_subroutinize_fonts:
+          try:
+            parsed_font = cff.SubroutinizeType1CFont(parsed_font)
+          except (ValueError, cff.CffUnsupportedError), e:
+            LogProportionalInfo(
+                'not subroutinizing Type1C font obj %d: %s' % (obj_num, e))
+        try:
+          data = cff.SerializeType1CFont(parsed_font, 'F')
+        except (ValueError, cff.CffUnsupportedError), e:
+          LogProportionalInfo(
+              'generating Type1C font obj %d with Ghostscript: %s' %
+              (obj_num, e))
+        else:
+          loaded_obj = PdfObj(None)
+          loaded_obj.head = '<</Subtype/Type1C/Length %d>>' % len(data)
+          loaded_obj.stream = data
+          loaded_objs[obj_num] = loaded_obj
+          continue
+      gs_fonts[obj_num] = parsed_fonts[obj_num]
+    if loaded_objs:
+      LogInfo('generated %d Type1C fonts in Python' % len(loaded_objs))
+    if gs_fonts:
+      loaded_objs.update(cls._SerializeType1CFontsWithGs(gs_fonts))
+    for obj_num in sorted(parsed_fonts):
+      loaded_obj = loaded_objs[obj_num]
+      # TODO(pts): Cross-check /FontFile3 with pdf.GetFonts.
+      assert loaded_obj.Get('Subtype') == '/Type1C', (
+          'Cannot serialize font %s to Type1C' % obj_num)
+      target_obj = target_objs.get(obj_num)
+      if target_obj is None:
+        target_objs[obj_num] = target_obj = loaded_obj
+      else:
+        target_obj.head = loaded_obj.head
+        target_obj.stream = loaded_obj.stream
+
+    if do_double_check_type1c_output:
+      parsed2_fonts = cls.ParseType1CFonts(
+          objs=loaded_objs, ps_tmp_file_name=TMP_PREFIX + 'conv.parse2.tmp.ps',
+          data_tmp_file_name=TMP_PREFIX + 'conv.parse2data.tmp.ps',
+          do_use_python_cff=do_use_python_cff)
+      assert sorted(parsed_fonts) == sorted(parsed2_fonts), (
+          'Font object number list mismatch: serialized=%r checked=%r' %
+          (sorted(parsed_fonts), sorted(parsed2_fonts)))
+      # Typical differences:
+      # * /FontName is removed from parsed2_fonts. (Ghostscript does this,
+      #   not the Python code in pdfsizeopt.)
+      # * /FontBBox is added to parsed2_fonts with computed values.
+      # * /version is removed from parsed2_fonts.
+      # * /UnderlinePosition is reset to value 0 in parsed2_fonts.
+      # * /UnderlineThickness reset to value 0 in parsed2_fonts.
+      # * /Encoding (can be missing).
+      # * /.notdef is added to parsed2_fonts by cff.SerializeType1CFont.
+      for obj_num in sorted(loaded_objs):
+        parsed_font = parsed_fonts[obj_num]
+        parsed2_font = parsed2_fonts[obj_num]
+        cs = sorted(parsed_font['CharStrings'])
+        cs2 = sorted(parsed2_font['CharStrings'])
+        if '.notdef' not in cs:
+          cs2 = [glyph_name for glyph_name in cs2 if glyph_name != '.notdef']
+        assert not set(cs2).difference(cs)
+        assert cs == cs2, (
+            'missing glyphs from font %s: %r --> %r' %
+            (objs[obj_num].Get('FontName'), cs, cs2))
+
+  @classmethod
+  def _SerializeType1CFontsWithGs(cls, parsed_fonts):
+    """Runs Type1CGenerator (via Ghostscript) on parsed_fonts.
+
+    Returns:
+      dict mapping obj_num to the PdfObj containing the Type1C font data.
     """
 
     def AppendSerializedPs(value, output, pdf_to_ps_name=PdfObj.PdfToPsName):
@@ -6473,57 +8997,23 @@ class PdfData(object):
     assert sorted(loaded_objs) == sorted(parsed_fonts), (
         'Font object number list mismatch: loaded=%r parsed=%r' %
         (sorted(loaded_objs), sorted(parsed_fonts)))
-    for obj_num in sorted(parsed_fonts):
-      loaded_obj = loaded_objs[obj_num]
-      # TODO(pts): Cross-check /FontFile3 with pdf.GetFonts.
-      assert loaded_obj.Get('Subtype') == '/Type1C', (
-          'Cannot serialize font %s to Type1C' % obj_num)
-      target_obj = target_objs.get(obj_num)
-      if target_obj is None:
-        target_objs[obj_num] = target_obj = loaded_obj
-      else:
-        target_obj.head = loaded_obj.head
-        target_obj.stream = loaded_obj.stream
-
-    if do_double_check_type1c_output:
-      parsed2_fonts = cls.ParseType1CFonts(
-          objs=loaded_objs, ps_tmp_file_name=TMP_PREFIX + 'conv.parse2.tmp.ps',
-          data_tmp_file_name=TMP_PREFIX + 'conv.parse2data.tmp.ps')
-      assert sorted(parsed_fonts) == sorted(parsed2_fonts), (
-          'Font object number list mismatch: serialized=%r checked=%r' %
-          (sorted(parsed_fonts), sorted(parsed2_fonts)))
-      # Typical differences:
-      # * /FontName is removed from parsed2_fonts. (Ghostscript does this,
-      #   not the Python code in pdfsizeopt.)
-      # * /FontBBox is added to parsed2_fonts with computed values.
-      # * /version is removed from parsed2_fonts.
-      # * /UnderlinePosition is reset to value 0 in parsed2_fonts.
-      # * /UnderlineThickness reset to value 0 in parsed2_fonts.
-      # * /Encoding (can be missing).
-      for obj_num in sorted(loaded_objs):
-        parsed_font = parsed_fonts[obj_num]
-        parsed2_font = parsed2_fonts[obj_num]
-        cs = sorted(parsed_font['CharStrings'])
-        cs2 = sorted(parsed2_font['CharStrings'])
-        assert not set(cs2).difference(cs)
-        assert cs == cs2, (
-            'missing glyphs from font %s: %r --> %r' %
-            (objs[obj_num].Get('FontName'), cs, cs2))
-
     # TODO(pts): Don't remove if command-line flag.
     os.remove(ps_tmp_file_name)
     os.remove(pdf_tmp_file_name)
+    return loaded_objs
 
   def _ProcessType1CFonts(self, type1c_objs, do_unify_fonts,
                           do_regenerate_all_fonts,
                           do_double_check_type1c_output,
-                          do_keep_font_optionals):
+                          do_keep_font_optionals,
+                          do_use_python_cff=True,
+                          do_subroutinize_fonts=False):
     # ParseType1CFonts removes the tmp files it creates.
     # ParseType1CFonts removes unparsable fonts from type1c_objs.
     parsed_fonts = self.ParseType1CFonts(
         objs=type1c_objs, ps_tmp_file_name=TMP_PREFIX + 'conv.parse.tmp.ps',
         data_tmp_file_name=TMP_PREFIX + 'conv.parsedata.tmp.ps',
-        is_permissive=True)
+        is_permissive=True, do_use_python_cff=do_use_python_cff)
 
     # Maps from /Type/FontDescriptor obj_num to lists [encoding, obj_nums].
     # obj_nums is a list of /Type/Font obj_nums.
@@ -6596,6 +9086,19 @@ class PdfData(object):
       if not do_unify_fonts:
         continue
 
+      private = parsed_font.get('Private', ())
+      if (do_use_python_cff and do_subroutinize_fonts and
+          ('Subrs' in private or 'GlobalSubrs' in private)):
+        # The font will be subroutinized again by SerializeType1CFonts.
+        try:
+          parsed_font = parsed_fonts[obj_num] = (
+              cff.DesubroutinizeType1CFont(parsed_font))
+        except (ValueError, cff.CffUnsupportedError), exc:
+          LogProportionalInfo(
+              'could not inline subrs of Type1C font obj %d: %s' %
+              (obj_num, exc))
+      private = None
+
       if ('Subrs' in parsed_font.get('Private', ())):
         # for testing: pdfsizeopt_charts.pdf has this for /Subrs (list of hex
         # strings: # ['<abc42>', ...]).
@@ -6625,6 +9128,12 @@ class PdfData(object):
       else:
         font_groups[font_group] = [obj_num]
 
+    # Unite font groups of the same font embedded under different names.
+    for united_groups in self.UniteType1CFontGroupsByGlyphs(
+        parsed_fonts, font_groups, self.objs):
+      LogProportionalInfo(
+          'found identical glyphs in Type1C font groups %r' % united_groups)
+
     for font_group in sorted(font_groups):
       group_obj_nums = font_groups[font_group]
       if len(group_obj_nums) < 2:
@@ -6773,7 +9282,9 @@ class PdfData(object):
           parsed_fonts=parsed_fonts,
           target_objs=type1c_objs,
           objs=self.objs,
-          do_double_check_type1c_output=do_double_check_type1c_output)
+          do_double_check_type1c_output=do_double_check_type1c_output,
+          do_use_python_cff=do_use_python_cff,
+          do_subroutinize_fonts=do_subroutinize_fonts)
       # This is for proper saving of /Encoding, because SerializeType1CFonts
       # ruins the built-in encoding in the Type1C font data.
       for obj_num in sorted(parsed_fonts):
@@ -6799,7 +9310,9 @@ class PdfData(object):
   def OptimizeType1CFonts(self, do_keep_font_optionals,
                           do_double_check_type1c_output,
                           do_unify_fonts,
-                          do_regenerate_all_fonts):
+                          do_regenerate_all_fonts,
+                          do_use_python_cff=True,
+                          do_subroutinize_fonts=False):
     """Regenerate or unify different subsets of the same Type1C font.
 
     Returns:
@@ -6902,7 +9415,9 @@ class PdfData(object):
           do_unify_fonts=do_unify_fonts,
           do_regenerate_all_fonts=do_regenerate_all_fonts,
           do_double_check_type1c_output=do_double_check_type1c_output,
-          do_keep_font_optionals=do_keep_font_optionals)
+          do_keep_font_optionals=do_keep_font_optionals,
+          do_use_python_cff=do_use_python_cff,
+          do_subroutinize_fonts=do_subroutinize_fonts)
     for obj_num in sorted(type1c_objs):
       type1c_objs[obj_num].FixFontNameInType1C(objs=self.objs)
     new_type1c_size = 0
@@ -6920,9 +9435,16 @@ class PdfData(object):
   def ConvertImage(cls, sourcefn, targetfn, cmd_pattern, cmd_name,
                    do_just_read=False, return_none_if_status=None,
                    do_remove_targetfn_on_success=True, is_inverted=False,
-                   need_gray=False):
+                   need_gray=False, timeout=None, cache_hits=None):
     """Converts sourcefn to targetfn using cmd_pattern, returns
-    (cmd_name, image_data) pair."""
+    (cmd_name, image_data) pair.
+
+    Returns None if the converter has timed out (see timeout) or has exited
+    with return_none_if_status.
+
+    If cache_hits is not None, it must be a list, and True is appended to it
+    if the output was taken from IMAGE_CACHE instead of running the command.
+    """
     if not isinstance(sourcefn, str):
       raise TypeError
     if not isinstance(targetfn, str):
@@ -6971,11 +9493,54 @@ class PdfData(object):
     else:
       EnsureRemoved(targetfn)
 
-    LogProportionalInfo(
-        'executing image converter %s: %s' % (cmd_name, cmd))
-    sys.stdout.flush()
-    romode = (None, False)[NeedToolLogOutput()]
-    status = os.system(RedirectOutput(cmd, mode=romode))
+    image_cache = IMAGE_CACHE
+    cache_key = cached = None
+    if image_cache is not None:
+      cache_values_dict = dict(cmd_values_dict)
+      cache_values_dict['sourcefnq'] = (
+          'SOURCE' + os.path.splitext(sourcefn)[1])
+      cache_values_dict['targetfnq'] = (
+          'TARGET' + os.path.splitext(targetfn)[1])
+      cache_key = image_cache.GetKey(
+          sourcefn, cmd_pattern % cache_values_dict)
+      cached = image_cache.Get(cache_key)
+      if (cached is not None and cached[0] and
+          cached[0] != return_none_if_status):
+        cached = None
+    if cached is not None:
+      LogProportionalInfo(
+          'using cached output of image converter %s: %s' % (cmd_name, cmd))
+      if cache_hits is not None:
+        cache_hits.append(True)
+      status = cached[0]
+      if not status:
+        f = open(targetfn, 'wb')
+        try:
+          f.write(cached[1])
+        finally:
+          f.close()
+      cached = None  # Save memory.
+    else:
+      LogProportionalInfo(
+          'executing image converter %s: %s' % (cmd_name, cmd))
+      sys.stdout.flush()
+      romode = (None, False)[NeedToolLogOutput()]
+      status = SystemWithTimeout(RedirectOutput(cmd, mode=romode), timeout)
+      if status is None:
+        LogProportionalInfo(
+            'image converter %s timed out after %.1f seconds, ignoring' %
+            (cmd_name, timeout))
+        EnsureRemoved(targetfn)
+        return None
+      if cache_key is not None:
+        if status and status == return_none_if_status:
+          image_cache.Put(cache_key, status, '')
+        elif not status and os.path.isfile(targetfn):
+          f = open(targetfn, 'rb')
+          try:
+            image_cache.Put(cache_key, status, f.read())
+          finally:
+            f.close()
     if (return_none_if_status is not None and
         status == return_none_if_status):
       EnsureRemoved(targetfn)
@@ -7041,6 +9606,8 @@ class PdfData(object):
     uninline_count = 0
     uninline_bytes_saved = 0
     for obj_num in sorted(self.objs):
+      if obj_num in self.optimized_obj_nums:
+        continue
       obj = self.objs[obj_num]
       detect_ret = obj.DetectInlineImage(objs=self.objs)
       if not detect_ret:
@@ -7267,31 +9834,60 @@ class PdfData(object):
             'advpng' in cmd_name or 'pngwolf' in cmd_name)
 
   def _ConvertImageWithJbig2(self, image, cmd_name, cmd_pattern, obj_num,
-                             color_type):
-    """Converts with jbig2. Assumes image is saved to image.file_name."""
+                             color_type, timeout=None, cache_hits=None):
+    """Converts with jbig2. Assumes image is saved to image.file_name.
+
+    Returns None if jbig2 has timed out. See ConvertImage for cache_hits.
+    """
     old_image, image = image, ImageData(image)
     if color_type != 'gray':
       image.SavePng(  # Changes .file_name.
           file_name=TMP_PREFIX + 'img-%d.gray.png' % obj_num,
           do_force_gray=True)
-    image.idat = self.ConvertImage(
+    image_item = self.ConvertImage(
         sourcefn=image.file_name,
         is_inverted=image.is_inverted,
         targetfn=TMP_PREFIX + 'img-%d.jbig2' % obj_num,
         cmd_pattern=cmd_pattern,
         cmd_name=cmd_name,
-        do_just_read=True)[1]
+        do_just_read=True,
+        timeout=timeout,
+        cache_hits=cache_hits)
     if image.file_name != old_image.file_name:
       os.remove(image.file_name)
+    if image_item is None:
+      return None
+    image.idat = image_item[1]
     image.compression = 'jbig2'
     image.file_name = TMP_PREFIX + 'img-%d.jbig2' % obj_num
     return cmd_name, image
 
-  def OptimizeImages(self, img_cmd_patterns, do_fast_bilevel_images):
-    """Optimize image XObjects in the PDF."""
+  def OptimizeImages(self, img_cmd_patterns, do_fast_bilevel_images, jobs=1,
+                     image_time_budget=0, total_image_time_budget=0,
+                     image_stats=None, do_skip_losing_image_optimizers=False):
+    """Optimize image XObjects in the PDF.
+
+    Args:
+      img_cmd_patterns: List of image optimizer command patterns.
+      do_fast_bilevel_images: Whether to use jbig2 only for large bilevel
+        images.
+      jobs: Number of image optimizers to run concurrently (for different
+        images), 0 means the number of CPUs. The output doesn't depend on
+        this, unless there is a time budget.
+      image_time_budget: Maximum number of seconds the optional image
+        optimizers (i.e. not sam2p or imgdataopt) may run for a single
+        image, or 0 for unlimited. See ImageTimeBudget.
+      total_image_time_budget: Maximum number of seconds the optional image
+        optimizers may run for all images, or 0 for unlimited.
+      image_stats: None or an ImageOptimizerStats to record the outcome of
+        the optional image optimizers to.
+      do_skip_losing_image_optimizers: If true, skip the optional image
+        optimizers found losing by image_stats.
+    Returns:
+      self.
+    """
     if not isinstance(img_cmd_patterns, (list, tuple)):
       raise TypeError
-    # TODO(pts): Keep output of pngout between runs, to reduce time.
     # Dictionary mapping Ghostscript -sDEVICE= names to dictionaries mapping
     # PDF object numbers to PdfObj instances.
     # TODO(pts): Remove key PTEX.* from all dicts (trailer and form xobjects)
@@ -7305,6 +9901,8 @@ class PdfData(object):
     # Maps obj_nums (to be modified) to obj_nums (to be modified to).
     modify_obj_nums = {}
     force_grayscale_obj_nums = set()
+    # Object numbers of images for which some image optimizers were skipped.
+    unfinished_obj_nums = set()
     removed_entries = {}
     for obj_num in sorted(self.objs):
       obj = self.objs[obj_num]
@@ -7326,6 +9924,11 @@ class PdfData(object):
           # The target image of an /SMask must be /ColorSpace /DeviceGray.
           force_grayscale_obj_nums.add(int(match.group(1)))
 
+      # Checked after the /SMask above, because the /SMask target may still
+      # need optimization.
+      if obj_num in self.optimized_obj_nums:
+        continue
+
       if obj.Get('Type') is not None:
         # /Xobject is nonstandard, but some PDF files have it (see
         # /https://github.com/pts/pdfsizeopt/issues/133), and pdfimages
@@ -7542,7 +10145,7 @@ class PdfData(object):
         # We try to invert (do_try_invert=True) to get rid of `/Decode [1 0]',
         # thus saving a few bytes.
         image2 = ImageData(image1).CompressToZipPng(
-            do_try_invert=image1.is_inverted)
+            do_try_invert=image1.is_inverted, do_optimize_filters=True)
         # image2 won't be None here.
       except FormatUnsupported, e:
         #LogProportionalInfo('LoadPdfImageObj does not support obj: %s' % e)
@@ -7622,26 +10225,15 @@ class PdfData(object):
     by_image_tuple = {}
     # Maps image data tuples to an ImageData.
     by_rendered_tuple = {}
+    # Keys of by_image_tuple and by_rendered_tuple whose image is in
+    # unfinished_obj_nums.
+    unfinished_tuples = set()
+    # Maps obj_nums to (width, height) pairs.
+    image_sizes = {}
+    # Maps obj_nums to the image data tuple of the last rendered image.
+    rendered_tuples = {}
     for obj_num in sorted(images):
-      # !! TODO(pts): Don't load all images to memory (maximum 2).
       obj = self.objs[obj_num]
-      # Eventually obj_images will contain:
-      #
-      # * rendered_image: One or more images created by pdfsizeopt
-      #   (LoadPdfImageObj, possibly with CompressToZipPng) or Ghostscript.
-      #   Not optimized yet.
-      # * np_image: A 'zip'-compressed (no predictor), color_type-optimized,
-      #   bpc-optimized image, optimized by sam2p (file format: PDF) or
-      #   imgdataopt (file format: extended PNG) from the last rendered_image.
-      # * oi_image: A 'zip-png'-compressed (with predictor),
-      #   color_type-optimized, bpc-optimized image, file format: PNG,
-      #   created by sam2p (optimized) or imgdataopt (optimized) or
-      #   pdfsizeopt (CompressToZipPng + SavePng, not optimized) from
-      #   np_image.
-      # * cmd_image: An optimized image created by one of the image
-      #   optimizers (other than sam2p and imgdataopt) from oi_image. These
-      #   image optimizers are tried: img_cmd_patterns. It's essential that
-      #   each image optimizer can read PNG files, because oi_image is a PNG.
       obj_images = images[obj_num]
       obj_width = PdfObj.ResolveReferences(obj.Get('Width'), self.objs)
       obj_height = PdfObj.ResolveReferences(obj.Get('Height'), self.objs)
@@ -7652,24 +10244,27 @@ class PdfData(object):
       assert obj_images
       assert obj_images[-1][0] in ('parse', 'gs')
       obj_images[-1][1].MaybeConvertToGray1()
-      rendered_tuple = obj_images[-1][1].ToDataTuple()
-      target_image = by_rendered_tuple.get(rendered_tuple)
-      if target_image is not None:  # We have already rendered this image.
-        # For testing: pts2.zip.4timesb.pdf
-        # This is just a speed optimization so we don't have to run
-        # sam2p or imgdataopt again.
-        LogProportionalInfo(
-            'using already rendered image for obj %s' % obj_num)
-        assert obj_width == target_image.width
-        assert obj_height == target_image.height
-        obj_images.append(('#prev-rendered-best', target_image))
-        image_tuple = rendered_tuple
-        target_image = None  # Save memory.
-      elif (do_fast_bilevel_images and has_jbig2 and
-            obj_images[-1][1].bpc == 1 and
-            obj_images[-1][1].color_type in ('gray', 'indexed-rgb') and
-            obj_images[-1][1].CanCompressToZipPng() and
-            (obj_width * obj_height) >> 16):  # Shortcut to do jbig2 only.
+      image_sizes[obj_num] = (obj_width, obj_height)
+      rendered_tuples[obj_num] = obj_images[-1][1].ToDataTuple()
+
+    def RunImageOptimizersNp(obj_num):
+      """Runs sam2p_np (or only jbig2) on the rendered image of obj_num.
+
+      Appends the results to images[obj_num].
+
+      Returns:
+        None if the image doesn't need more optimizers (because only jbig2
+        was run), otherwise a tuple (image_tuple, oi_args), where
+        image_tuple is the data tuple of the sam2p_np image, and oi_args
+        is a tuple of args to be passed to RunImageOptimizersOi.
+      """
+      obj_images = images[obj_num]
+      obj_width, obj_height = image_sizes[obj_num]
+      if (do_fast_bilevel_images and has_jbig2 and
+          obj_images[-1][1].bpc == 1 and
+          obj_images[-1][1].color_type in ('gray', 'indexed-rgb') and
+          obj_images[-1][1].CanCompressToZipPng() and
+          (obj_width * obj_height) >> 16):  # Shortcut to do jbig2 only.
         oi_image = obj_images[-1][1]
         if not (oi_image.color_type == 'gray' and
                 oi_image.compression == 'zip-png' and
@@ -7690,160 +10285,328 @@ class PdfData(object):
         oi_image = None  # Save memory later.
         for _, old_image in obj_images[:obj_images_size]:
           os.remove(old_image.file_name)
-        old_image = None   # Save memory.
-        image_tuple = rendered_tuple  # No more caching, just pacity.
+        return None
+
+      rendered_image_file_name = obj_images[-1][1].file_name
+      rendered_image_is_inverted = obj_images[-1][1].is_inverted
+      assert rendered_image_file_name is not None
+      assert rendered_image_file_name.endswith('.png')
+      obj_images.append(self.ConvertImage(
+          sourcefn=rendered_image_file_name,
+          is_inverted=rendered_image_is_inverted,
+          need_gray=(obj_num in force_grayscale_obj_nums),
+          targetfn=TMP_PREFIX + 'img-%d.sam2p-np.pdf' % obj_num,
+          # We specify -s here to explicitly exclude SF_Opaque for
+          # single-color images.
+          # !! do we need /ImageMask parsing if we exclude SF_Mask here as
+          #    well?
+          # Original sam2p order: Opaque:Transparent:Gray1:Indexed1:Mask:
+          #   Gray2:Indexed2:Rgb1:Gray4:Indexed4:Rgb2:Gray8:Indexed8:Rgb4:
+          #   Rgb8:Transparent2:Transparent4:Transparent8
+          # !! reintroduce Opaque by hand (combine /FlateEncode and
+          #    /RLEEncode; or /FlateEncode twice (!) to reduce zeroes in
+          #    empty_page.pdf from !)
+          # * We specify `sam2p -j:quiet' unconditionally, because the
+          #   console output of sam2p is useless. (Ignored by imgdataopt.)
+          cmd_pattern=sam2p_np_pattern,
+          cmd_name='sam2p_np'))
+      for _, old_image in obj_images[:-2]:
+        if old_image.file_name is not None:
+          os.remove(old_image.file_name)
+      old_image = None   # Save memory.
+      np_image = obj_images[-1][1]
+      assert np_image.width == obj_width
+      assert np_image.height == obj_height
+      assert np_image.compression == 'zip'
+      assert not np_image.is_interlaced, (
+          'Unexpected interlaced sam2p_np image.')
+      # See force_grayscale_obj_nums why this image must be grayscale.
+      # Image optimizers such as optipng (in img_cmd_pattern) need
+      # grayscale input (in pr_image_file_name) to produce
+      # grayscale output.
+      assert (not (obj_num in force_grayscale_obj_nums) or
+              np_image.color_type == 'gray'), (
+          'Grayscale needed for image, got %s' %
+          np_image.color_type)
+      is_bilevel_image = (np_image.bpc == 1 and
+                          np_image.color_type in ('gray', 'indexed-rgb'))
+      do_save_oi_fast = False
+      obj_cmd_patterns = img_cmd_patterns
+      if (do_fast_bilevel_images and is_bilevel_image and has_jbig2 and
+          (obj_width * obj_height) >> 14):
+        if (obj_width * obj_height) >> 16:
+          do_save_oi_fast = True
+          obj_cmd_patterns = [cmd_pattern for cmd_pattern in img_cmd_patterns
+                              if 'jbig2' in GetCmdName(cmd_pattern)]
+        else:
+          do_save_oi_fast = False
+          obj_cmd_patterns = [
+              cmd_pattern for cmd_pattern in img_cmd_patterns
+              if not self._IsSlowCmdName(GetCmdName(cmd_pattern))]
+      return np_image.ToDataTuple(), (
+          rendered_image_file_name, rendered_image_is_inverted, np_image,
+          obj_cmd_patterns, do_save_oi_fast, is_bilevel_image)
+
+    def RunImageOptimizersOi(obj_num, oi_args):
+      """Runs sam2p_pr (or save_oi) and the other image optimizers.
+
+      Appends the results to images[obj_num].
+
+      Returns:
+        The number of images appended.
+      """
+      (rendered_image_file_name, rendered_image_is_inverted, np_image,
+       obj_cmd_patterns, do_save_oi_fast, is_bilevel_image) = oi_args
+      obj_images = images[obj_num]
+      obj_images_size = len(obj_images)
+      obj_width, obj_height = image_sizes[obj_num]
+      np_image_bpc = np_image.bpc
+      np_image_color_type = np_image.color_type
+      np_image_size = len(np_image.idat)
+      if sam2p_pr_pattern is None or do_save_oi_fast:
+        # No need for need_gray=..., sam2p_np has already done it.
+        # TODO(pts): Can we use rendered_image_file_name (a .png)
+        #            instead of np_image here, thus not having to save a
+        #            temporary .png?
+        obj_images.append(('save_oi', ImageData(np_image)
+            .CompressToZipPng(do_try_invert=np_image.is_inverted,
+                              effort=(9 - 6 * do_save_oi_fast),
+                              do_optimize_filters=not do_save_oi_fast)
+            .SavePng(file_name=TMP_PREFIX + 'img-%d.save-oi.png' % obj_num)
+            ))
+        np_image = None  # Save memory reference.
+      else:
+        np_image = None  # Save memory reference.
+        # We can't to use `sourcefn=np_image.file_name, because
+        # it's a .pdf if generated by sam2p (please note that imgdataopt
+        # generates a .png), and sam2p can't reliably read .pdf files,
+        # because it runs `gs -sDEVICE=pnmraw', to which some
+        # Ghostscript versions report `Unknown device: pnmraw'.
+        obj_images.append(self.ConvertImage(
+            sourcefn=rendered_image_file_name,
+            is_inverted=rendered_image_is_inverted,
+            need_gray=(obj_num in force_grayscale_obj_nums),
+            targetfn=TMP_PREFIX + 'img-%d.sam2p-pr.png' % obj_num,
+            cmd_pattern=sam2p_pr_pattern,
+            cmd_name='sam2p_pr',
+            do_remove_targetfn_on_success=False))  # Will remove manually.
+      os.remove(rendered_image_file_name)
+      oi_image = obj_images[-1][1]
+      assert oi_image.width == obj_width
+      assert oi_image.height == obj_height
+      assert oi_image.compression == 'zip-png'
+      assert not oi_image.is_interlaced
+      # These may not match: e.g. oi_image (sam2p_pr) is Indexed4,
+      # np_image is Rgb1 (non-standard PNG activated by -pdf:2).
+      if oi_image.color_type == np_image_color_type:
+        assert oi_image.bpc == np_image_bpc, (oi_image.bpc, np_image_bpc)
+
+      # !! add /FlateEncode again to all obj_images to find the smallest
+      #    (maybe to UpdatePdfObj)
+      cmd_names_used = set()
+      cmd_items = []  # (cmd_name, cmd_pattern) pairs.
+      for cmd_pattern in obj_cmd_patterns:
+        cmd_name = GetCmdName(cmd_pattern)
+        if not cmd_name or cmd_name in ('sam2p_pr', 'sam2p_np'):
+          continue
+        if cmd_name in cmd_names_used:
+          i = 2
+          while 1:
+            cmd_name2 = '%s%d' % (cmd_name, i)
+            if cmd_name2 not in cmd_names_used:
+              cmd_name = cmd_name2
+              break
+            i += 1
+        cmd_names_used.add(cmd_name)
+        if 'jbig2' not in cmd_name or is_bilevel_image:
+          cmd_items.append((cmd_name, cmd_pattern))
+      deadline = None
+      if time_budget is not None:
+        bit_count = (oi_image.width * oi_image.height *
+                     oi_image.samples_per_pixel * oi_image.bpc)
+        cmd_items = time_budget.SortCmdItems(cmd_items, bit_count)
+        deadline = time_budget.GetImageDeadline()
+      if image_stats is not None:
+        image_class = image_stats.GetImageClass(oi_image)
+      cmd_results = []  # (cmd_name, size, seconds) tuples for image_stats.
+      for cmd_name, cmd_pattern in cmd_items:
+        if (do_skip_losing_image_optimizers and image_stats is not None and
+            image_stats.IsLosing(image_class, cmd_name)):
+          LogProportionalInfo(
+              'skipping image optimizer %s for obj %d: it has never won '
+              'for %s images' % (cmd_name, obj_num, image_class))
+          unfinished_obj_nums.add(obj_num)
+          continue
+        start_time = time.time()
+        timeout = None
+        if deadline is not None:
+          timeout = deadline - start_time
+          predicted_time = time_budget.Predict(cmd_name, bit_count)
+          if predicted_time > timeout:
+            LogProportionalInfo(
+                'skipping image optimizer %s for obj %d: predicted %.1f '
+                'seconds, %.1f seconds left' %
+                (cmd_name, obj_num, predicted_time, max(timeout, 0)))
+            unfinished_obj_nums.add(obj_num)
+            continue
+        cache_hits = []
+        if 'jbig2' in cmd_name:
+          image_item = self._ConvertImageWithJbig2(
+              oi_image, cmd_name, cmd_pattern, obj_num,
+              oi_image.color_type, timeout=timeout, cache_hits=cache_hits)
+        else:
+          return_none_if_status = None
+          if 'pngout' in cmd_name:
+            # New pngout if: 'Unable to compress further: copying
+            # original file'
+            return_none_if_status = 0x200
+          image_item = self.ConvertImage(
+              sourcefn=oi_image.file_name,
+              is_inverted=oi_image.is_inverted,
+              need_gray=(obj_num in force_grayscale_obj_nums),
+              targetfn=TMP_PREFIX + 'img-%d.%s.png' % (obj_num, cmd_name),
+              cmd_pattern=cmd_pattern,
+              cmd_name=cmd_name,
+              return_none_if_status=return_none_if_status,
+              timeout=timeout,
+              cache_hits=cache_hits)
+        run_seconds = time.time() - start_time
+        # The timing of a result from IMAGE_CACHE is meaningless (almost 0),
+        # and its outcome was recorded when the optimizer actually ran.
+        if not cache_hits:
+          if deadline is not None:
+            time_budget.Record(cmd_name, bit_count, run_seconds)
+          if image_item is None:
+            cmd_results.append((cmd_name, None, run_seconds))
+          else:
+            cmd_results.append(
+                (cmd_name, len(image_item[1].idat), run_seconds))
+        if image_item is not None:
+          obj_images.append(image_item)
+          image_item = None
+      if image_stats is not None and cmd_results:
+        image_stats.RecordImage(
+            image_class, np_image_size, [len(oi_image.idat)], cmd_results)
+      cmd_results = None  # Save memory.
+
+      # No need for the file oi_image.filename on disk anymore, we've
+      # loaded it to obj_images with cmd_name='sam2p_pr', and we've used
+      # it as an input for img_cmd_patterns.
+      os.remove(oi_image.file_name)
+      oi_image = None  # Save memory later.
+
+      return len(obj_images) - obj_images_size
+
+    time_budget = None
+    if image_time_budget or total_image_time_budget:
+      time_budget = ImageTimeBudget(image_budget=image_time_budget or None,
+                                    doc_budget=total_image_time_budget or None)
+
+    np_results = {}  # Maps obj_nums to return values of RunImageOptimizersNp.
+    oi_results = {}  # Maps obj_nums to return values of RunImageOptimizersOi.
+    jobs = GetThreadCount(jobs)
+    if jobs > 1:
+      # Run the image optimizers in parallel for those images for which the
+      # serial loop below would run them. Then the serial loop uses these
+      # results, and it makes the same decisions (e.g. about reusing the
+      # result of an identical image) as without parallel processing, so
+      # the output doesn't depend on the number of jobs.
+      seen_tuples = set()
+      obj_nums = []
+      for obj_num in sorted(images):
+        if rendered_tuples[obj_num] not in seen_tuples:
+          seen_tuples.add(rendered_tuples[obj_num])
+          obj_nums.append(obj_num)
+      LogInfo('running image optimizers for %d images with %d jobs' %
+              (len(obj_nums), jobs))
+      np_results = dict(zip(obj_nums, RunInThreads(
+          [lambda obj_num=obj_num: RunImageOptimizersNp(obj_num)
+           for obj_num in obj_nums], jobs)))
+      # seen_tuples now contains all keys by_image_tuple can get before
+      # the respective image, assuming that sam2p_np is deterministic.
+      oi_items = []
+      for obj_num in sorted(images):
+        np_result = np_results.get(obj_num)
+        if np_result is not None:
+          if np_result[0] not in seen_tuples:
+            oi_items.append((obj_num, np_result[1]))
+          seen_tuples.add(np_result[0])
+      oi_results = dict(zip([item[0] for item in oi_items], RunInThreads(
+          [lambda item=item: RunImageOptimizersOi(*item)
+           for item in oi_items], jobs)))
+      oi_items = None  # Save memory.
+      seen_tuples = None  # Save memory.
+
+    for obj_num in sorted(images):
+      # !! TODO(pts): Don't load all images to memory (maximum 2).
+      obj = self.objs[obj_num]
+      # Eventually obj_images will contain:
+      #
+      # * rendered_image: One or more images created by pdfsizeopt
+      #   (LoadPdfImageObj, possibly with CompressToZipPng) or Ghostscript.
+      #   Not optimized yet.
+      # * np_image: A 'zip'-compressed (no predictor), color_type-optimized,
+      #   bpc-optimized image, optimized by sam2p (file format: PDF) or
+      #   imgdataopt (file format: extended PNG) from the last rendered_image.
+      # * oi_image: A 'zip-png'-compressed (with predictor),
+      #   color_type-optimized, bpc-optimized image, file format: PNG,
+      #   created by sam2p (optimized) or imgdataopt (optimized) or
+      #   pdfsizeopt (CompressToZipPng + SavePng, not optimized) from
+      #   np_image.
+      # * cmd_image: An optimized image created by one of the image
+      #   optimizers (other than sam2p and imgdataopt) from oi_image. These
+      #   image optimizers are tried: img_cmd_patterns. It's essential that
+      #   each image optimizer can read PNG files, because oi_image is a PNG.
+      obj_images = images[obj_num]
+      obj_width, obj_height = image_sizes[obj_num]
+      rendered_tuple = rendered_tuples[obj_num]
+      target_image = by_rendered_tuple.get(rendered_tuple)
+      if target_image is not None:  # We have already rendered this image.
+        # For testing: pts2.zip.4timesb.pdf
+        # This is just a speed optimization so we don't have to run
+        # sam2p or imgdataopt again.
+        LogProportionalInfo(
+            'using already rendered image for obj %s' % obj_num)
+        assert obj_width == target_image.width
+        assert obj_height == target_image.height
+        obj_images.append(('#prev-rendered-best', target_image))
+        if rendered_tuple in unfinished_tuples:
+          unfinished_obj_nums.add(obj_num)
+        image_tuple = rendered_tuple
+        target_image = None  # Save memory.
       else:
-        rendered_image_file_name = obj_images[-1][1].file_name
-        rendered_image_is_inverted = obj_images[-1][1].is_inverted
-        assert rendered_image_file_name is not None
-        assert rendered_image_file_name.endswith('.png')
-        obj_images.append(self.ConvertImage(
-            sourcefn=rendered_image_file_name,
-            is_inverted=rendered_image_is_inverted,
-            need_gray=(obj_num in force_grayscale_obj_nums),
-            targetfn=TMP_PREFIX + 'img-%d.sam2p-np.pdf' % obj_num,
-            # We specify -s here to explicitly exclude SF_Opaque for
-            # single-color images.
-            # !! do we need /ImageMask parsing if we exclude SF_Mask here as
-            #    well?
-            # Original sam2p order: Opaque:Transparent:Gray1:Indexed1:Mask:
-            #   Gray2:Indexed2:Rgb1:Gray4:Indexed4:Rgb2:Gray8:Indexed8:Rgb4:
-            #   Rgb8:Transparent2:Transparent4:Transparent8
-            # !! reintroduce Opaque by hand (combine /FlateEncode and
-            #    /RLEEncode; or /FlateEncode twice (!) to reduce zeroes in
-            #    empty_page.pdf from !)
-            # * We specify `sam2p -j:quiet' unconditionally, because the
-            #   console output of sam2p is useless. (Ignored by imgdataopt.)
-            cmd_pattern=sam2p_np_pattern,
-            cmd_name='sam2p_np'))
-        for _, old_image in obj_images[:-2]:
-          if old_image.file_name is not None:
-            os.remove(old_image.file_name)
-        old_image = None   # Save memory.
-        np_image = obj_images[-1][1]
-        assert np_image.width == obj_width
-        assert np_image.height == obj_height
-        assert np_image.compression == 'zip'
-        assert not np_image.is_interlaced, (
-            'Unexpected interlaced sam2p_np image.')
-        # See force_grayscale_obj_nums why this image must be grayscale.
-        # Image optimizers such as optipng (in img_cmd_pattern) need
-        # grayscale input (in pr_image_file_name) to produce
-        # grayscale output.
-        assert (not (obj_num in force_grayscale_obj_nums) or
-                np_image.color_type == 'gray'), (
-            'Grayscale needed for image, got %s' %
-            np_image.color_type)
-        is_bilevel_image = (np_image.bpc == 1 and
-                            np_image.color_type in ('gray', 'indexed-rgb'))
-        do_save_oi_fast = False
-        if (do_fast_bilevel_images and is_bilevel_image and has_jbig2 and
-            (obj_width * obj_height) >> 14):
-          if (obj_width * obj_height) >> 16:
-            do_save_oi_fast = True
-            img_cmd_patterns = [cmd_pattern for cmd_pattern in img_cmd_patterns
-                                if 'jbig2' in GetCmdName(cmd_pattern)]
-          else:
-            do_save_oi_fast = False
-            img_cmd_patterns = [
-                cmd_pattern for cmd_pattern in img_cmd_patterns
-                if not self._IsSlowCmdName(GetCmdName(cmd_pattern))]
-        image_tuple = np_image.ToDataTuple()
-        target_image = by_image_tuple.get(image_tuple)
-        if target_image is not None:  # We have already optimized this image.
-          # For testing: pts2.ziplzw.pdf
-          # The latest sam2p and imgdataopt are deterministic, so the bytes
-          # of the file produced by them depend only on the RGB image data.
-          LogProportionalInfo(
-              'using already processed image for obj %s' % obj_num)
-          obj_images.append(('#prev-processed-best', target_image))
-          target_image = None  # Save memory.
+        if obj_num in np_results:
+          np_result = np_results.pop(obj_num)
         else:
-          np_image_bpc = np_image.bpc
-          np_image_color_type = np_image.color_type
-          if sam2p_pr_pattern is None or do_save_oi_fast:
-            # No need for need_gray=..., sam2p_np has already done it.
-            # TODO(pts): Can we use rendered_image_file_name (a .png)
-            #            instead of np_image here, thus not having to save a
-            #            temporary .png?
-            obj_images.append(('save_oi', ImageData(np_image)
-                .CompressToZipPng(do_try_invert=np_image.is_inverted,
-                                  effort=(9 - 6 * do_save_oi_fast))
-                .SavePng(file_name=TMP_PREFIX + 'img-%d.save-oi.png' % obj_num)
-                ))
-            np_image = None  # Save memory reference.
+          np_result = RunImageOptimizersNp(obj_num)
+        if np_result is None:  # Only jbig2 was run.
+          image_tuple = rendered_tuple  # No more caching, just pacity.
+        else:
+          image_tuple, oi_args = np_result
+          np_result = None  # Save memory.
+          target_image = by_image_tuple.get(image_tuple)
+          if target_image is not None:  # We have already optimized this image.
+            # For testing: pts2.ziplzw.pdf
+            # The latest sam2p and imgdataopt are deterministic, so the bytes
+            # of the file produced by them depend only on the RGB image data.
+            LogProportionalInfo(
+                'using already processed image for obj %s' % obj_num)
+            unfinished_obj_nums.discard(obj_num)
+            if image_tuple in unfinished_tuples:
+              unfinished_obj_nums.add(obj_num)
+            if obj_num in oi_results:  # Discard the parallel results.
+              for _ in xrange(oi_results.pop(obj_num)):
+                old_image = obj_images.pop()[1]
+                if old_image.file_name is not None:
+                  EnsureRemoved(old_image.file_name)
+              old_image = None  # Save memory.
+            obj_images.append(('#prev-processed-best', target_image))
+            target_image = None  # Save memory.
+          elif obj_num in oi_results:
+            del oi_results[obj_num]
           else:
-            np_image = None  # Save memory reference.
-            # We can't to use `sourcefn=np_image.file_name, because
-            # it's a .pdf if generated by sam2p (please note that imgdataopt
-            # generates a .png), and sam2p can't reliably read .pdf files,
-            # because it runs `gs -sDEVICE=pnmraw', to which some
-            # Ghostscript versions report `Unknown device: pnmraw'.
-            obj_images.append(self.ConvertImage(
-                sourcefn=rendered_image_file_name,
-                is_inverted=rendered_image_is_inverted,
-                need_gray=(obj_num in force_grayscale_obj_nums),
-                targetfn=TMP_PREFIX + 'img-%d.sam2p-pr.png' % obj_num,
-                cmd_pattern=sam2p_pr_pattern,
-                cmd_name='sam2p_pr',
-                do_remove_targetfn_on_success=False))  # Will remove manually.
-          os.remove(rendered_image_file_name)
-          oi_image = obj_images[-1][1]
-          assert oi_image.width == obj_width
-          assert oi_image.height == obj_height
-          assert oi_image.compression == 'zip-png'
-          assert not oi_image.is_interlaced
-          # These may not match: e.g. oi_image (sam2p_pr) is Indexed4,
-          # np_image is Rgb1 (non-standard PNG activated by -pdf:2).
-          if oi_image.color_type == np_image_color_type:
-            assert oi_image.bpc == np_image_bpc, (oi_image.bpc, np_image_bpc)
-
-          # !! add /FlateEncode again to all obj_images to find the smallest
-          #    (maybe to UpdatePdfObj)
-          cmd_names_used = set()
-          for cmd_pattern in img_cmd_patterns:
-            cmd_name = GetCmdName(cmd_pattern)
-            if not cmd_name or cmd_name in ('sam2p_pr', 'sam2p_np'):
-              continue
-            if cmd_name in cmd_names_used:
-              i = 2
-              while 1:
-                cmd_name2 = '%s%d' % (cmd_name, i)
-                if cmd_name2 not in cmd_names_used:
-                  cmd_name = cmd_name2
-                  break
-                i += 1
-            cmd_names_used.add(cmd_name)
-            if 'jbig2' in cmd_name:
-              if is_bilevel_image:
-                obj_images.append(self._ConvertImageWithJbig2(
-                    oi_image, cmd_name, cmd_pattern, obj_num,
-                    oi_image.color_type))
-              continue
-            return_none_if_status = None
-            if 'pngout' in cmd_name:
-              # New pngout if: 'Unable to compress further: copying
-              # original file'
-              return_none_if_status = 0x200
-            image_item = self.ConvertImage(
-                sourcefn=oi_image.file_name,
-                is_inverted=oi_image.is_inverted,
-                need_gray=(obj_num in force_grayscale_obj_nums),
-                targetfn=TMP_PREFIX + 'img-%d.%s.png' % (obj_num, cmd_name),
-                cmd_pattern=cmd_pattern,
-                cmd_name=cmd_name,
-                return_none_if_status=return_none_if_status)
-            if image_item is not None:
-              obj_images.append(image_item)
-              image_item = None
-
-          # No need for the file oi_image.filename on disk anymore, we've
-          # loaded it to obj_images with cmd_name='sam2p_pr', and we've used
-          # it as an input for img_cmd_patterns.
-          os.remove(oi_image.file_name)
-          oi_image = None  # Save memory later.
-
-          # TODO(pts): For very small (10x10) images, try uncompressed too.
+            RunImageOptimizersOi(obj_num, oi_args)
+          oi_args = None  # Save memory.
 
       obj_infos = [(obj.size, '#orig', '', obj, None)]
       # Populate obj_infos from obj_images.
@@ -7935,6 +10698,9 @@ class PdfData(object):
       if obj_infos[0][4] is not None:
         by_rendered_tuple[rendered_tuple] = by_image_tuple[image_tuple] = (
             obj_infos[0][4])
+        if obj_num in unfinished_obj_nums:
+          unfinished_tuples.add(rendered_tuple)
+          unfinished_tuples.add(image_tuple)
         # TODO(pts): !! Cache something if obj_infos[0][4] is None, seperate
         # case for len(obj_info) == 1.
         # TODO(pts): Investigate why the original image can be the smallest.
@@ -7946,6 +10712,9 @@ class PdfData(object):
 
     for obj_num in modify_obj_nums:
       self.objs[obj_num] = PdfObj(self.objs[modify_obj_nums[obj_num]])
+      if modify_obj_nums[obj_num] in unfinished_obj_nums:
+        unfinished_obj_nums.add(obj_num)
+    self.unfinished_obj_nums.update(unfinished_obj_nums)
     for obj_num in removed_entries:
       obj = self.objs[obj_num]
       for name, value in removed_entries[obj_num].iteritems():
@@ -7962,9 +10731,10 @@ class PdfData(object):
     # We may also wan to convert 612. to 612 elsewhere, to save 1 byte.
     for obj_num in sorted(self.objs):
       obj = self.objs[obj_num]
-      if (obj.head.startswith('<<') and
+      head = obj.Peek().head  # Keep lazy stubs lazy, except for forms.
+      if (head.startswith('<<') and
           # !!! TODO(pts): Do proper PDF token sequence parsing.
-          re.search(r'/Subtype[\0\t\n\r\f ]*/Form\b', obj.head) and
+          re.search(r'/Subtype[\0\t\n\r\f ]*/Form\b', head) and
           obj.Get('Subtype') == '/Form'):
         matrix = obj.Get('Matrix')
         if isinstance(matrix, str):
@@ -7992,8 +10762,10 @@ class PdfData(object):
           if obj_num not in reached_obj_nums:
             obj = objs.get(obj_num)
             if obj:
-              reached_obj_nums.add(obj_num)
-              todo2.append(obj.head)
+              head = obj.Peek().head  # Keep lazy stubs lazy.
+              if not obj.IsUnparsable():  # Like a missing obj.
+                reached_obj_nums.add(obj_num)
+                todo2.append(head)
       todo = todo2
     unused_count = 0
     for obj_num in sorted(objs):
@@ -8005,7 +10777,8 @@ class PdfData(object):
 
   @classmethod
   def FindEqclasses(cls, objs, do_remove_unused=False, do_renumber=False,
-                    do_unify_pages=True):
+                    do_unify_pages=True, do_canonicalize_dicts=False,
+                    obj_num_map_out=None):
     """Find equivalence classes in objs, return new objs.
 
     Args:
@@ -8015,12 +10788,22 @@ class PdfData(object):
         not reachable from 'trailer' etc.
       do_renumber: A boolean indicating whether to renumber all objects,
         ordered by decreasing number of referrers.
+      do_unify_pages: A boolean indicating whether to unify equivalent
+        /Type/Page objects.
+      do_canonicalize_dicts: A boolean indicating whether to compare object
+        heads with the keys of their dicts sorted, so that dicts differing
+        only in key order get unified. The returned objs keep the original
+        key order of the eqclass leader.
+      obj_num_map_out: None or a dict to which a mapping from each object
+        number in objs to its object number in the returned dict is added.
+        Removed unused objs are not added.
     Returns:
       A new dict mapping object numbers to PdfObj instances.
     """
     # List of list of desc ([obj_num, head_minus, stream, refs_to,
-    # inrefs_count]). Each list of eqclasses is an eqiuvalence class of
-    # object descs.
+    # inrefs_count, output_form]). Each list of eqclasses is an eqiuvalence
+    # class of object descs. output_form is None or (head_minus, refs_to) to
+    # be used in the returned obj instead of the canonical ones.
     eqclasses = []
     # Maps object numbers to an element of eqclasses.
     eqclass_of = {}
@@ -8032,13 +10815,30 @@ class PdfData(object):
     for obj_num in sorted(objs):
       refs_to = []  # List of object numbers obj_num refers to).
       head = objs[obj_num].head
-      # !! TODO(pts): reorder dicts to canonical order
       # CompressValue changes all generational refs to generation 0.
       head_minus = PdfObj.CompressValue(
           head, obj_num_map='0', old_obj_nums_ret=refs_to,
           do_emit_strings_as_hex=True)
+      output_form = None
+      if do_canonicalize_dicts:
+        # Only the eqclass key is canonical: sorted keys in the output would
+        # make the object stream compress worse.
+        canonical_head = PdfObj.CompressValue(
+            head, do_emit_strings_as_hex=True)
+        try:
+          canonical_head = PdfObj.CanonicalizeDictOrder(canonical_head)
+        except PdfTokenParseError:
+          pass  # Keep the original order, e.g. for {...} PostScript code.
+        canonical_refs_to = []
+        for match in PdfObj.PDF_SIMPLE2_REF_RE.finditer(canonical_head):
+          canonical_refs_to.append(int(match.group(1)))
+        canonical_head = PdfObj.PDF_SIMPLE2_REF_RE.sub(
+            '0 0 R', canonical_head)
+        if canonical_head != head_minus:
+          output_form = (head_minus, refs_to)
+          head_minus, refs_to = canonical_head, canonical_refs_to
       stream = objs[obj_num].stream
-      desc = [obj_num, head_minus, stream, refs_to, 0]
+      desc = [obj_num, head_minus, stream, refs_to, 0, output_form]
       if isinstance(obj_num, str):  # for 'trailer'
         eqclasses.append([desc])
         eqclass_of[obj_num] = eqclasses[-1]
@@ -8071,34 +10871,7 @@ class PdfData(object):
     #    print desc
     #  print
 
-    had_split = True
-    while had_split:
-      had_split = False
-      for eqclass in eqclasses:
-        assert eqclass
-        if len(eqclass) > 1:
-          desc = eqclass[0]
-          refs_to = desc[3]
-          eqlist = [desc]
-          nelist = []
-          for i in xrange(1, len(eqclass)):
-            descb = eqclass[i]
-            refs_tob = descb[3]
-            j = 0
-            while (j < len(refs_to) and
-                   eqclass_of.get(refs_to[j]) is eqclass_of.get(refs_tob[j])):
-              j += 1
-            if j == len(refs_to):
-              eqlist.append(descb)
-            else:
-              nelist.append(descb)
-          if nelist:  # everybody in eqclass is equivalent to desc
-            had_split = True
-            eqclasses.append(nelist)
-            for descb in nelist:
-              assert eqclass_of[descb[0]] is eqclass
-              eqclass_of[descb[0]] = nelist
-            eqclass[:] = eqlist
+    cls.RefineEqclasses(eqclasses, eqclass_of)
 
     eliminated_count = len(objs) - len(eqclasses)
     assert eliminated_count >= 0
@@ -8148,7 +10921,9 @@ class PdfData(object):
 
     objs_ret = {}
     for eqclass in eqclasses:
-      obj_num, head_minus, stream, refs_to, _ = eqclass[0]
+      obj_num, head_minus, stream, refs_to, _, output_form = eqclass[0]
+      if output_form is not None:
+        head_minus, refs_to = output_form
       if obj_num in unused_obj_nums:
         continue
 
@@ -8184,23 +10959,267 @@ class PdfData(object):
       obj.head = head
       obj.stream = stream
       objs_ret[obj_num_map.get(obj_num, obj_num)] = obj
+      if obj_num_map_out is not None:
+        for desc in eqclass:
+          obj_num_map_out[desc[0]] = obj_num_map.get(obj_num, obj_num)
 
     return objs_ret
 
-  def OptimizeStreams(self, do_decompress_only=False):
+  @classmethod
+  def RefineEqclasses(cls, eqclasses, eqclass_of):
+    """Splits eqclasses until members refer to the same eqclasses.
+
+    Two descs remain in the same eqclass iff their refs_to lists refer to the
+    same eqclasses pointwise (refs to missing objs are all equal). The result
+    is the coarsest such refinement (like bisimulation), computed by
+    Hopcroft-style partition refinement: when some descs are moved to a new
+    eqclass, only the descs referring to them are reexamined, and when an
+    eqclass is split, its largest part stays, so each desc is moved at most
+    O(log(len(eqclasses))) times. The naive algorithm (rescanning all descs
+    until there is no split) is quadratic for long reference chains.
+
+    Args:
+      eqclasses: List of eqclasses, each eqclass is a list of descs
+        ([obj_num, head_minus, stream, refs_to, inrefs_count]). Will be
+        modified in place (new eqclasses appended), the order of descs within
+        an eqclass is kept.
+      eqclass_of: dict mapping obj_num to its eqclass in eqclasses. Will be
+        updated in place.
+    """
+    # Maps obj_num to the index of its eqclass in members_of.
+    index_of = {}
+    # members_of[i] is a dict mapping obj_num to desc in eqclass i.
+    members_of = []
+    # Maps obj_num to the list of descs (in multi-desc eqclasses) referring
+    # to it.
+    referrers = {}
+    # Maps the index of an eqclass to be reexamined to a dict mapping obj_num
+    # to desc of the descs to be reexamined, or to None for all descs.
+    touched_of = {}
+    todo = []
+    for i in xrange(len(eqclasses)):
+      eqclass = eqclasses[i]
+      members = {}
+      for desc in eqclass:
+        index_of[desc[0]] = i
+        members[desc[0]] = desc
+      members_of.append(members)
+      if len(eqclass) > 1:
+        touched_of[i] = None
+        todo.append(i)
+        for desc in eqclass:
+          for obj_num in desc[3]:
+            if obj_num in referrers:
+              referrers[obj_num].append(desc)
+            else:
+              referrers[obj_num] = [desc]
+    todo.reverse()
+    index_of_get = index_of.get
+
+    def MoveToNewEqclass(members, part):
+      j = len(members_of)
+      new_members = {}
+      members_of.append(new_members)
+      for desc in part:
+        obj_num = desc[0]
+        del members[obj_num]
+        new_members[obj_num] = desc
+        index_of[obj_num] = j
+
+    def TouchReferrers(parts):
+      for part in parts:
+        for desc in part:
+          for referrer in referrers.get(desc[0], ()):
+            k = index_of[referrer[0]]
+            if len(members_of[k]) > 1:
+              if k not in touched_of:
+                touched_of[k] = {referrer[0]: referrer}
+                todo.append(k)
+              elif touched_of[k] is not None:
+                touched_of[k][referrer[0]] = referrer
+
+    while todo:
+      i = todo.pop()
+      members = members_of[i]
+      touched = touched_of.pop(i)
+      if touched is not None:
+        # Some descs in touched may have been moved away since touching.
+        touched = [desc for desc in touched.itervalues()
+                   if index_of[desc[0]] == i]
+        if len(touched) >= len(members):
+          touched = None
+      if touched is None:
+        descs = members.itervalues()
+        rest_key = None
+        rest_size = 0
+      else:
+        touched_obj_nums = set([desc[0] for desc in touched])
+        for obj_num in members:  # Find an untouched desc.
+          if obj_num not in touched_obj_nums:
+            break
+        descs = touched
+        rest_key = tuple([index_of_get(obj_num2, -1)
+                          for obj_num2 in members[obj_num][3]])
+        rest_size = len(members) - len(touched)
+      parts = {}
+      for desc in descs:
+        key = tuple([index_of_get(obj_num, -1) for obj_num in desc[3]])
+        if key == rest_key:
+          rest_size += 1
+        elif key in parts:
+          parts[key].append(desc)
+        else:
+          parts[key] = [desc]
+      parts = parts.values()
+      if len(parts) + (rest_size > 0) <= 1:
+        continue
+      largest_part = None
+      largest_size = rest_size
+      for part in parts:
+        if len(part) > largest_size:
+          largest_part = part
+          largest_size = len(part)
+      moved_parts = [part for part in parts if part is not largest_part]
+      for part in moved_parts:
+        MoveToNewEqclass(members, part)
+      if largest_part is not None and rest_size:
+        largest_obj_nums = set([desc[0] for desc in largest_part])
+        moved_parts.append([desc for desc in members.itervalues()
+                            if desc[0] not in largest_obj_nums])
+        MoveToNewEqclass(members, moved_parts[-1])
+      # Touch only after all moves, so that touched descs don't move away.
+      TouchReferrers(moved_parts)
+
+    # Build the eqclass lists, keeping the order of descs.
+    new_eqclasses = [[] for members in members_of]
+    for eqclass in eqclasses:
+      for desc in eqclass:
+        new_eqclasses[index_of[desc[0]]].append(desc)
+    for i in xrange(len(eqclasses)):
+      eqclasses[i][:] = new_eqclasses[i]
+      new_eqclasses[i] = eqclasses[i]  # Keep the identity of the list.
+    eqclasses.extend(new_eqclasses[len(eqclasses):])
+    for eqclass in new_eqclasses:
+      for desc in eqclass:
+        eqclass_of[desc[0]] = eqclass
+
+  MAX_PREFETCH_BATCH_SIZE = 16 << 20
+  """Maximum total compressed size of streams decompressed in a batch."""
+
+  def YieldPrefetchedStreams(self, obj_nums, prefetch_obj_nums):
+    """Yields obj_nums, decompressing streams needing Ghostscript in batches.
+
+    Args:
+      obj_nums: Iterable of object numbers (in self.objs) to yield.
+      prefetch_obj_nums: Set (or dict) of object numbers whose stream will be
+        decompressed by the caller. Streams which need Ghostscript for that
+        will be decompressed in a batch before they are yielded.
+    Yields:
+      (obj_num, prefetched) pairs, in the order of obj_nums, where prefetched
+      is None or a value to be passed to GetUncompressedStream as
+      prefetched=...
+    """
+    objs = self.objs
+    max_batch_size = self.MAX_PREFETCH_BATCH_SIZE
+    obj_nums = iter(obj_nums)
+    while 1:
+      batch = []
+      obj_items = []
+      batch_size = 0
+      for obj_num in obj_nums:
+        batch.append(obj_num)
+        if obj_num in prefetch_obj_nums:
+          obj = objs[obj_num]
+          obj_items.append((obj_num, obj))
+          batch_size += len(obj.stream)
+          if batch_size >= max_batch_size:
+            break
+      if not batch:
+        break
+      prefetched_streams = PdfObj.PrefetchUncompressedStreams(
+          obj_items, objs)
+      obj_items = None  # Save memory.
+      for obj_num in batch:
+        yield obj_num, prefetched_streams.pop(obj_num, None)
+
+  MAX_RECOMPRESS_BATCH_SIZE = 32 << 20
+  """Maximum total uncompressed size of streams recompressed in a batch."""
+
+  def OptimizeStreams(self, do_decompress_only=False, jobs=1):
     """Recompress all non-image streams, keep the smallest.
 
+    The streams are decompressed serially, and then recompressed in batches
+    (of at most MAX_RECOMPRESS_BATCH_SIZE bytes of uncompressed data), with
+    the streams in a batch compressed concurrently in jobs threads. This
+    helps, because zlib releases the GIL while compressing. The results are
+    applied in object number order, so the output doesn't depend on jobs.
+
+    The sizes of the candidates are computed without making copies of the
+    objs, and a stream isn't recompressed at all if even the lower bound of
+    its recompressed size (see PdfObj.GetMinFlateSize) isn't smaller than its
+    current size.
+
     Args:
       do_decompress_only: Decompress all non-image streams, don't attempt to
         compress them.
+      jobs: Number of threads to compress with, 0 means the number of CPUs.
     """
     # TODO(pts): Merge much of the code from here to SetStreamAndCompress.
 
     counts = {}
     skipped_count = 0
-    for obj_num in sorted(self.objs):
+    jobs = GetThreadCount(jobs)
+    # List of (obj_num, obj, data, obj_infos, get_stream_size) tuples to be
+    # compressed in the next batch.
+    batch = []
+    batch_sizes = [0]
+
+    def ApplyBest(obj_num, obj, obj_infos):
+      # Pick the smallest.
+      obj_infos.sort()
+      size, method, stream, filter_value = obj_infos[0]
+      if method != '#orig':
+        obj = PdfObj(obj)
+        obj.stream = stream
+        obj.Set('Length', len(stream))
+        obj.Set('Filter', filter_value)
+        obj.Set('DecodeParms', None)
+      self.objs[obj_num] = obj
+      counts[method] = counts.get(method, 0) + 1
+
+    def CompressBatch():
+      outputs = RunInThreads(
+          [lambda data=data: FlateCompress(data)
+           for obj_num, obj, data, obj_infos, get_stream_size in batch], jobs)
+      for i in xrange(len(batch)):
+        obj_num, obj, data, obj_infos, get_stream_size = batch[i]
+        # Try flate with maximum effort.
+        obj_infos.append((get_stream_size(len(outputs[i]), '/FlateDecode'),
+                          'zip', outputs[i], '/FlateDecode'))
+
+        # TODO(pts): Additionally, try flate with predictors, like in
+        #            SetStreamAndCompress.
+
+        ApplyBest(obj_num, obj, obj_infos)
+        outputs[i] = batch[i] = None  # Save memory.
+      del batch[:]
+      batch_sizes[0] = 0
+
+    # Object numbers of the streams to be decompressed below.
+    decompress_obj_nums = set()
+    for obj_num, obj in self.objs.iteritems():
+      if obj_num in self.optimized_obj_nums:
+        continue
+      if (obj.stream is not None and not obj.HasUncompressedStream() and
+          not ('/Subtype' in obj.head and '/Image' in obj.head and
+               obj.Get('Subtype') == '/Image')):
+        filter_value = str(obj.Get('Filter'))
+        if not ('/DCTDecode' in filter_value or '/JPXDecode' in filter_value):
+          decompress_obj_nums.add(obj_num)
+    for obj_num, prefetched in self.YieldPrefetchedStreams(
+        sorted(self.objs), decompress_obj_nums):
       obj = self.objs[obj_num]
-      if obj.stream is None:
+      if obj.stream is None or obj_num in self.optimized_obj_nums:
         skipped_count += 1
         continue
       if ('/Subtype' in obj.head and '/Image' in obj.head and
@@ -8214,13 +11233,16 @@ class PdfData(object):
         #print obj.head
         continue
 
+      # List of (size, method, stream, filter_value) tuples. For method
+      # '#orig', obj is kept unchanged.
       obj_infos = []
       if obj.HasUncompressedStream():
         data, filter_value = obj.stream, None
         obj.Set('Filter', None)
         obj.Set('DecodeParms', None)
         # '#' has a small ASCII code, so prefer '#orig' to 'zip'.
-        obj_infos.append((obj.size, '#orig', obj))
+        obj_infos.append((obj.size, '#orig', None, None))
+        get_stream_size = obj.GetStreamSizeFunc()
       else:
         filter_value = str(obj.Get('Filter'))
         # Keep objects with lossy filters untouched.
@@ -8228,42 +11250,35 @@ class PdfData(object):
           skipped_count += 1
           continue
         try:
-          data = obj.GetUncompressedStream(self.objs)
+          data = obj.GetUncompressedStream(self.objs, prefetched=prefetched)
         except (FilterNotImplementedError, FilterError), e:
           LogWarning(
               'error decompressing obj %d: %s' %
               (obj_num, e))
           counts['#dec-error'] = counts.get('#dec-error', 0) + 1
+          self.unfinished_obj_nums.add(obj_num)
           continue
-        obj_infos.append((obj.size, '#orig', obj))
-        obj2 = PdfObj(obj)
-        obj2.stream = data
-        obj2.Set('Filter', None)
-        obj2.Set('DecodeParms', None)
-        obj2.Set('Length', len(obj2.stream))
-        obj_infos.append((obj2.size, 'uncompressed', obj2))
-        del obj2  # Save memory.
+        obj_infos.append((obj.size, '#orig', None, None))
+        get_stream_size = obj.GetStreamSizeFunc()
+        obj_infos.append(
+            (get_stream_size(len(data)), 'uncompressed', data, None))
 
       if do_decompress_only:
         del obj_infos[:-1]  # Keep only the last, uncompressed stream.
+        ApplyBest(obj_num, obj, obj_infos)
+      elif (get_stream_size(PdfObj.GetMinFlateSize(len(data)),
+                            '/FlateDecode') >= min(obj_infos)[0]):
+        # Even the best possible 'zip' wouldn't be smaller (ties are won by
+        # the other methods because of their names), don't compress.
+        ApplyBest(obj_num, obj, obj_infos)
       else:
-        # Try flate with maximum effort.
-        obj2 = PdfObj(obj)
-        obj2.stream = zlib.compress(data, 9)
-        obj2.Set('Length', len(obj2.stream))
-        obj2.Set('Filter', '/FlateDecode')
-        obj2.Set('DecodeParms', None)
-        obj_infos.append((obj2.size, 'zip', obj2))
-        del obj2  # Save memory.
-
-        # TODO(pts): Additionally, try advzip etc., or flate with
-        #            predictors, like in SetStreamAndCompress.
-
-        obj_infos.sort()
-
-      self.objs[obj_num] = obj_infos[0][2]  # Pick the smallest.
-      counts[obj_infos[0][1]] = counts.get(obj_infos[0][1], 0) + 1
-      del obj_infos  # Save memory.
+        batch.append((obj_num, obj, data, obj_infos, get_stream_size))
+        batch_sizes[0] += len(data)
+        if batch_sizes[0] >= self.MAX_RECOMPRESS_BATCH_SIZE:
+          CompressBatch()
+      del obj_infos, data  # Save memory.
+    if batch:
+      CompressBatch()
 
     if do_decompress_only:
       what = 'decompressed'
@@ -8296,7 +11311,9 @@ class PdfData(object):
     else:
       substring = ''
       msg_word = 'streams'
-    for pdf_obj in self.objs.itervalues():
+    # Object numbers of the streams to be decompressed below.
+    decompress_obj_nums = []
+    for obj_num, pdf_obj in self.objs.iteritems():
       if pdf_obj.head.startswith('<<') and substring in pdf_obj.head:
         filter_value = pdf_obj.Get('Filter')
         if isinstance(filter_value, str):  # Should always be true (except None).
@@ -8308,11 +11325,17 @@ class PdfData(object):
                 '/DCTDecode' not in filter_value and
                 '/JPXDecode' not in filter_value)
           if do_decompress:
-            pdf_obj.stream = pdf_obj.GetUncompressedStream(self.objs)
-            pdf_obj.Set('Filter', None)
-            pdf_obj.Set('DecodeParms', None)
-            pdf_obj.Set('Length', len(pdf_obj.stream))
-            uncompress_count += 1
+            decompress_obj_nums.append(obj_num)
+    decompress_obj_nums.sort()
+    for obj_num, prefetched in self.YieldPrefetchedStreams(
+        decompress_obj_nums, set(decompress_obj_nums)):
+      pdf_obj = self.objs[obj_num]
+      pdf_obj.stream = pdf_obj.GetUncompressedStream(
+          self.objs, prefetched=prefetched)
+      pdf_obj.Set('Filter', None)
+      pdf_obj.Set('DecodeParms', None)
+      pdf_obj.Set('Length', len(pdf_obj.stream))
+      uncompress_count += 1
     LogInfo('decompressed %d %s' % (uncompress_count, msg_word))
 
   def CompressUncompressedStreams(self):
@@ -8335,7 +11358,7 @@ class PdfData(object):
         'compressed %d streams, kept %d of them uncompressed' %
         (compress_count, uncompressed_count))
 
-  def OptimizeObjs(self, do_unify_pages):
+  def OptimizeObjs(self, do_unify_pages, do_canonicalize_dicts=False):
     """Optimize PDF objects.
 
     This method does the following:
@@ -8353,17 +11376,27 @@ class PdfData(object):
 
     Args:
       do_unify_pages: Unify equivalent /Type/Page objects to a single object.
+      do_canonicalize_dicts: Compare object heads with the keys of their
+        dicts sorted, so that dicts differing only in key order are unified.
     Returns:
       self.
     """
     # TODO(pts): Inline ``obj null endobj'' and ``obj<<>>endobj'' etc.
     self.objs['trailer'] = self.trailer
+    obj_num_map = {}
     new_objs = self.FindEqclasses(
         self.objs, do_remove_unused=True, do_renumber=True,
-        do_unify_pages=do_unify_pages)
+        do_unify_pages=do_unify_pages,
+        do_canonicalize_dicts=do_canonicalize_dicts,
+        obj_num_map_out=obj_num_map)
     self.trailer = new_objs.pop('trailer')
     self.objs.clear()
     self.objs.update(new_objs)
+    self.optimized_obj_nums.clear()  # The objs have been renumbered.
+    # If any obj in an eqclass is unfinished, so is the unified obj.
+    self.unfinished_obj_nums = set([
+        obj_num_map[obj_num] for obj_num in self.unfinished_obj_nums
+        if obj_num in obj_num_map])
     return self
 
   def ParseSequentially(self, data, file_name=None, offsets_out=None,
@@ -9214,17 +12247,14 @@ class PdfData(object):
         '', in_pdf_tmp_file_name) + '-o.pdf'
 
     LogInfo('writing Multivalent input PDF: %s' % in_pdf_tmp_file_name)
-    tmp_output = []
-    in_data_size = self.AppendSerializedPdf(
-        output=tmp_output, do_hide_images=do_escape_images,
-        do_generate_xref_stream=True,
-        do_generate_object_stream=True)
     f = open(in_pdf_tmp_file_name, 'wb')
     try:
-      f.write(''.join(tmp_output))
+      in_data_size = self.AppendSerializedPdf(
+          output=f, do_hide_images=do_escape_images,
+          do_generate_xref_stream=True,
+          do_generate_object_stream=True)
     finally:
       f.close()
-    del tmp_output  # Save memory.
     LogInfo(
         'written %s bytes to Multivalent input PDF: %s' %
         (in_data_size, in_pdf_tmp_file_name))
@@ -9332,6 +12362,20 @@ class PdfData(object):
       tmp_files_to_remove = ()
       multivalent_output_data = None
 
+    if len(jobs) == 1 and not multivalent_compress_command:
+      # Write the objs directly to the file, without building the entire
+      # output in memory.
+      f = open(file_name, 'wb')
+      try:
+        output_size = self.AppendSerializedPdf(output=f, **jobs[0][0])
+      finally:
+        f.close()
+      self._LogSaved(output_size, with_multivalent_msg)
+      if do_update_file_meta:
+        self.file_size = output_size
+        self.file_name = file_name
+      return
+
     for job in jobs:
       output = []
       if multivalent_compress_command:
@@ -9364,12 +12408,7 @@ class PdfData(object):
       del jobs[1:]  # Save memory.
 
     output_size = len(jobs[0][3])
-    LogInfo(
-        'generated %d bytes %s(%s)' %
-        (output_size, with_multivalent_msg,
-         FormatPercent(output_size, self.file_size)))
-    if output_size > self.file_size:
-      LogWarning('optimized PDF larger than original')
+    self._LogSaved(output_size, with_multivalent_msg)
     f = open(file_name, 'wb')
     try:
       f.write(jobs[0][3])
@@ -9379,6 +12418,14 @@ class PdfData(object):
       self.file_size = output_size
       self.file_name = file_name
 
+  def _LogSaved(self, output_size, with_multivalent_msg):
+    LogInfo(
+        'generated %d bytes %s(%s)' %
+        (output_size, with_multivalent_msg,
+         FormatPercent(output_size, self.file_size)))
+    if output_size > self.file_size:
+      LogWarning('optimized PDF larger than original')
+
 
 BOOL_VALUES = {
     'on': True,
@@ -9526,6 +12573,9 @@ def DisplayHelp(mode, argv0):
   LogInfo(
       'usage for size optimization: %s [<flag>...] '
       '<input.pdf> [<output.pdf>]' % argv0)
+  LogInfo(
+      'usage for batch size optimization: %s [<flag>...] '
+      '--batch=<list.txt>' % argv0)
   if mode == 'helpshort':
     LogInfo('specify --help to get help on each flag')
   else:
@@ -9550,6 +12600,19 @@ class Flags(object):
     f.args = []
     f.verbosity = 190
     f.tmp_dir = None
+    f.parse_cache_dir = None
+    f.image_cache_dir = None
+    f.image_cache_max_size = 256
+    f.image_time_budget = f.total_image_time_budget = 0
+    f.image_stats_file = None
+    f.fingerprints_file = None
+    f.batch_file = None
+    f.jobs = 1
+    f.batch_jobs = 1
+    f.gs_job_timeout = 0
+    f.flate_effort = 1
+    f.flate_min_size = 4096
+    f.flate_backends = None
 
   def SetDefaultsFromHelp(self, help_text):
     _BOOL_FLAG_WITH_DEFAULT_RE = self.BOOL_FLAG_WITH_DEFAULT_RE
@@ -9605,18 +12668,298 @@ class Flags(object):
         f.do_double_check_type1c_output = ParseBoolFlag(key, value)
       elif flag_name == 'v':
         f.verbosity = ParseUintFlag(key, value)
+      elif flag_name in ('jobs', 'batch_jobs'):
+        setattr(f, flag_name, ParseUintFlag(key, value))
+      elif flag_name == 'gs_job_timeout':
+        f.gs_job_timeout = ParseUintFlag(key, value)
+      elif flag_name in ('image_cache_max_size', 'image_time_budget',
+                         'total_image_time_budget', 'flate_effort',
+                         'flate_min_size'):
+        setattr(f, flag_name, ParseUintFlag(key, value))
       elif flag_name == 'quiet':
         f.verbosity = 20
-      elif flag_name == 'tmp_dir':
+      elif flag_name == 'flate_backends':
+        f.flate_backends = filter(None, value.split(','))
+      elif flag_name in ('tmp_dir', 'parse_cache_dir', 'image_cache_dir',
+                         'image_stats_file', 'fingerprints_file'):
         setattr(f, flag_name, value)
+      elif flag_name == 'batch':
+        f.batch_file = value
       elif flag_name in f.bool_flag_names:
         setattr(f, flag_name, ParseBoolFlag(key, value))
       else:
         assert False, 'unknown flag %s' % key  # Can't happen, getopt output.
 
 
+def GetDefaultOutputFileName(file_name, use_multivalent):
+  """Returns the output filename if not specified in the command-line."""
+  if file_name[-4:].lower() == '.pdf':
+    output_file_name = file_name[:-4]
+  else:
+    output_file_name = file_name
+  if use_multivalent:
+    return output_file_name + '.psom.pdf'
+  else:
+    return output_file_name + '.pso.pdf'
+
+
+def ReadBatchFile(batch_file_name, use_multivalent):
+  """Reads the list of input and output PDF filenames for --batch=...
+
+  Args:
+    batch_file_name: Name of the file to read, or '-' for stdin.
+    use_multivalent: Value of the --use-multivalent=... flag, for the
+      default output filenames.
+  Returns:
+    A list of (file_name, output_file_name) pairs.
+  Raises:
+    IOError: If the file cannot be read.
+    ValueError: On a syntax error in the file.
+  """
+  if batch_file_name == '-':
+    lines = sys.stdin.readlines()
+  else:
+    f = open(batch_file_name, 'rb')
+    try:
+      lines = f.readlines()
+    finally:
+      f.close()
+  file_pairs = []
+  for line in lines:
+    line = line.rstrip('\r\n')
+    if not line or line.startswith('#'):
+      continue
+    items = line.split('\t')
+    if len(items) == 1:
+      items.append(GetDefaultOutputFileName(items[0], use_multivalent))
+    if len(items) != 2 or not items[0] or not items[1]:
+      raise ValueError('bad batch line: %r' % line)
+    file_pairs.append(tuple(items))
+  return file_pairs
+
+
+# None or a tuple of args of OptimizeFile. Set by OptimizeBatch for the
+# worker processes.
+BATCH_WORKER_ARGS = None
+
+# Number of PDFs after which an OptimizeBatch worker process is replaced by
+# a new one, to free the state (e.g. caches, idle Ghostscript workers) it
+# has built up.
+BATCH_MAX_PDFS_PER_WORKER = 50
+
+
+def OptimizeFileInWorker(i):
+  """Optimizes PDF i of the batch.
+
+  Runs in the process of OptimizeBatch or in a worker process forked by it.
+  The other args are taken from BATCH_WORKER_ARGS.
+
+  Returns:
+    A tuple (is_ok, cache_hit_count, cache_miss_count), where is_ok is a bool
+    indicating success, and the counts are those of IMAGE_CACHE for this PDF.
+  """
+  f, file_pairs, img_cmd_patterns, multivalent_compress_command = (
+      BATCH_WORKER_ARGS)
+  file_name, output_file_name = file_pairs[i]
+  LogInfo('optimizing PDF %d of %d: %s' % (i + 1, len(file_pairs), file_name))
+  SetupTmpPrefix(output_file_name, f.tmp_dir)
+  try:
+    OptimizeFile(f, file_name, output_file_name, img_cmd_patterns,
+                 multivalent_compress_command)
+  except KeyboardInterrupt:
+    raise
+  except:  # Including FatalError (a SystemExit) from LogFatal.
+    exc_info = sys.exc_info()
+    if isinstance(exc_info[1], FatalError):
+      reason = exc_info[1].msg
+    else:
+      reason = '%s.%s: %s' % (
+          exc_info[0].__module__, exc_info[0].__name__, exc_info[1])
+    exc_info = None  # Break the reference cycle.
+    LogError('cannot optimize %s: %s' % (file_name, reason))
+    if os.path.exists(output_file_name + '.tmp'):
+      os.remove(output_file_name + '.tmp')
+    is_ok = False
+  else:
+    is_ok = True
+  if IMAGE_CACHE is None:
+    return is_ok, 0, 0
+  return is_ok, IMAGE_CACHE.hit_count, IMAGE_CACHE.miss_count
+
+
+def OptimizeBatch(f, file_pairs, img_cmd_patterns,
+                  multivalent_compress_command):
+  """Optimizes the PDF files in file_pairs, as in --batch=...
+
+  Args:
+    f: The Flags object.
+    file_pairs: List of (file_name, output_file_name) pairs.
+    img_cmd_patterns: As in OptimizeFile.
+    multivalent_compress_command: As in OptimizeFile.
+  Returns:
+    The number of PDF files which failed.
+  """
+  global BATCH_WORKER_ARGS
+  jobs = min(GetJobCount(f.batch_jobs), len(file_pairs))
+  if jobs > 1:
+    # Worker processes can't fork their own workers.
+    f.jobs = 1
+  BATCH_WORKER_ARGS = (
+      f, file_pairs, img_cmd_patterns, multivalent_compress_command)
+  try:
+    if jobs > 1:
+      LogInfo('optimizing %d PDFs with %d jobs' % (len(file_pairs), jobs))
+      if sys.version_info >= (2, 7):
+        pool = multiprocessing.Pool(  # Forks now, inherits the args.
+            jobs, maxtasksperchild=BATCH_MAX_PDFS_PER_WORKER)
+      else:  # maxtasksperchild is not supported in Python 2.6.
+        pool = multiprocessing.Pool(jobs)
+      try:
+        results = list(pool.imap_unordered(
+            OptimizeFileInWorker, xrange(len(file_pairs))))
+        pool.close()
+      finally:
+        pool.terminate()
+        pool.join()
+    else:
+      results = map(OptimizeFileInWorker, xrange(len(file_pairs)))
+  finally:
+    BATCH_WORKER_ARGS = None
+  failed_count = len([1 for result in results if not result[0]])
+  LogInfo('optimized %d of %d PDFs' %
+          (len(file_pairs) - failed_count, len(file_pairs)))
+  if IMAGE_CACHE is not None:
+    LogInfo('image cache in %d PDFs: %d hits, %d misses' %
+            (len(file_pairs), sum([result[1] for result in results]),
+             sum([result[2] for result in results])))
+  return failed_count
+
+
+def GetFingerprintFlagsKey(f, img_cmd_patterns):
+  """Returns a str identifying the optimizations OptimizeFile does.
+
+  Args:
+    f: The Flags object.
+    img_cmd_patterns: List of image optimizer command patterns found.
+  Returns:
+    A str to be used as ObjFingerprints.flags_key.
+  """
+  cmd_names = [GetCmdName(cmd_pattern) for cmd_pattern in img_cmd_patterns]
+  cmd_names.sort()
+  return repr((
+      bool(f.do_optimize_fonts), bool(f.do_keep_font_optionals),
+      bool(f.do_subroutinize_fonts), bool(f.do_optimize_images),
+      bool(f.do_fast_bilevel_images), cmd_names,
+      bool(f.do_optimize_streams), bool(f.do_decompress_most_streams)))
+
+
+def OptimizeFile(f, file_name, output_file_name, img_cmd_patterns,
+                 multivalent_compress_command):
+  """Optimizes a single PDF file.
+
+  Args:
+    f: The Flags object.
+    file_name: Name of the input PDF file.
+    output_file_name: Name of the output PDF file to create.
+    img_cmd_patterns: List of image optimizer command patterns found.
+    multivalent_compress_command: None or the Multivalent command prefix.
+  """
+  if IMAGE_CACHE is not None:  # Count the hits and misses of this PDF only.
+    IMAGE_CACHE.hit_count = IMAGE_CACHE.miss_count = 0
+  # It's OK that file_name == output_file_name: we don't read and write them
+  # at the same time.
+  pdf = PdfData(
+      do_ignore_generation_numbers=f.do_ignore_generation_numbers,
+      ).Load(file_name, do_mmap=f.do_mmap_input, do_lazy=f.do_lazy_load,
+             jobs=f.jobs, parse_cache_dir=f.parse_cache_dir)
+  pdf.RemoveUnusedObjs()
+  pdf.FixAllBadNumbers()
+  fingerprints = None
+  if f.fingerprints_file:
+    if hashlib is None:
+      LogWarning('fingerprints file needs hashlib (Python 2.5), not using it')
+    else:
+      fingerprints = ObjFingerprints(
+          f.fingerprints_file,
+          GetFingerprintFlagsKey(f, img_cmd_patterns)).Load()
+      pdf.FindOptimizedObjs(fingerprints)
+  if f.do_optimize_fonts:
+    pdf.ConvertType1FontsToType1C()
+    pdf.OptimizeType1CFonts(
+        do_keep_font_optionals=f.do_keep_font_optionals,
+        do_double_check_type1c_output=f.do_double_check_type1c_output,
+        do_unify_fonts=f.do_unify_fonts,
+        do_regenerate_all_fonts=f.do_regenerate_all_fonts,
+        do_use_python_cff=f.do_use_python_cff,
+        do_subroutinize_fonts=f.do_subroutinize_fonts)
+  if f.do_optimize_images:
+    image_stats = None
+    if f.image_stats_file:
+      image_stats = ImageOptimizerStats(f.image_stats_file).Load()
+    pdf.ConvertInlineImagesToXObjects()
+    pdf.OptimizeImages(
+        img_cmd_patterns=img_cmd_patterns,
+        do_fast_bilevel_images=f.do_fast_bilevel_images,
+        jobs=f.jobs,
+        image_time_budget=f.image_time_budget,
+        total_image_time_budget=f.total_image_time_budget,
+        image_stats=image_stats,
+        do_skip_losing_image_optimizers=f.do_skip_losing_image_optimizers)
+    if image_stats is not None:
+      image_stats.Save()
+    if IMAGE_CACHE is not None:
+      LogInfo('image cache: %d hits, %d misses' %
+              (IMAGE_CACHE.hit_count, IMAGE_CACHE.miss_count))
+  if f.do_optimize_streams:
+    # We call this before pdf.OptimizeObjs, so pdf.OptimizeObjs can found
+    # more duplicate objs (in case the same stream data was compressed
+    # differently).
+    pdf.OptimizeStreams(do_decompress_only=f.do_decompress_most_streams,
+                        jobs=f.jobs)
+  if f.do_optimize_objs or f.do_remove_generational_objs:
+    # TODO(pts): Do only a simpler optimization with renumbering if
+    # f.do_optimize_objs is false and f.do_remove_generational_objs is true.
+    pdf.OptimizeObjs(do_unify_pages=f.do_unify_pages,
+                     do_canonicalize_dicts=f.do_canonicalize_dicts)
+  elif f.do_optimize_obj_heads:
+    pdf.trailer.head = PdfObj.CompressValue(pdf.trailer.head)
+    for obj in pdf.objs.itervalues():
+      obj.head = PdfObj.CompressValue(obj.head)
+  if f.do_decompress_most_streams:
+    # TODO(pts): Also decompress in Multivalent output.
+    pdf.DecompressStreams(is_flate_only=False)
+  elif f.do_decompress_flate:
+    # TODO(pts): Also decompress in Multivalent output.
+    pdf.DecompressStreams(is_flate_only=True)
+  # TODO(pts): Better handle which of f.do_compress_uncompressed_streams
+  #            and f.do_decompress_most_streams takes precedence. Maybe
+  #            that which is specified on the command-line (?).
+  if (f.do_compress_uncompressed_streams and
+      not f.do_decompress_most_streams and
+      multivalent_compress_command is None):
+    pdf.CompressUncompressedStreams()
+  pdf.Save(
+      output_file_name + '.tmp',
+      display_file_name=output_file_name,
+      multivalent_compress_command=multivalent_compress_command,
+      do_update_file_meta=True,
+      do_escape_images_from_multivalent=f.do_escape_images_from_multivalent,
+      do_generate_xref_stream=f.do_generate_xref_stream,
+      do_generate_object_stream=f.do_generate_object_stream,
+      is_flate_ok=(f.do_compress_uncompressed_streams and
+                   not f.do_decompress_most_streams))
+  Rename(output_file_name + '.tmp', output_file_name)
+  if fingerprints is not None:
+    if multivalent_compress_command is None:
+      pdf.RecordOptimizedObjs(fingerprints)
+      fingerprints.Save()
+    else:
+      # Multivalent has rewritten the objs, pdf.objs are not in the output.
+      LogWarning('not recording fingerprints of Multivalent output')
+
+
 def main(argv, script_dir=None, zip_file=None):
-  global VERBOSITY
+  global VERBOSITY, GS_WORKER_POOL, IMAGE_CACHE, FLATE_COMPRESSOR
   welcome_msg = 'This is %s.' % GetVersionSpec(zip_file)
   try:
     if not argv:
@@ -9634,20 +12977,19 @@ def main(argv, script_dir=None, zip_file=None):
       elif len(f.args) > 1:
         raise getopt.GetoptError('too many arguments')
     elif f.mode == 'optimize':
-      if not f.args:
+      if f.batch_file:
+        if f.args:
+          raise getopt.GetoptError(
+              'filenames in command-line not allowed with --batch')
+        output_file_name = file_name = None
+      elif not f.args:
         if not f.do_debug_gs and not f.do_debug_image_optimizers:
           raise getopt.GetoptError('missing input filename in command-line')
         output_file_name = file_name = None
       elif len(f.args) == 1:
         file_name = f.args[0]
-        if file_name[-4:].lower() == '.pdf':
-          output_file_name = file_name[:-4]
-        else:
-          output_file_name = file_name
-        if f.use_multivalent:
-          output_file_name += '.psom.pdf'
-        else:
-          output_file_name += '.pso.pdf'
+        output_file_name = GetDefaultOutputFileName(
+            file_name, f.use_multivalent)
       elif len(f.args) == 2:
         file_name = f.args[0]
         output_file_name = f.args[1]
@@ -9686,6 +13028,13 @@ def main(argv, script_dir=None, zip_file=None):
       if f.do_generate_object_stream and not f.do_generate_xref_stream:
         raise getopt.GetoptError('--do-generate-object-stream=yes requires '
                                  '--do-generate-xref-stream=yes')
+      try:
+        flate_compressor = deflate.FlateCompressor(
+            effort=f.flate_effort, min_size=f.flate_min_size,
+            backend_names=f.flate_backends)
+      except deflate.UnknownBackendError, exc:
+        raise getopt.GetoptError('%s; available: %s' % (
+            exc, ', '.join(deflate.GetBackendNames())))
 
   except getopt.GetoptError, exc:
     LogFatal(
@@ -9709,6 +13058,15 @@ def main(argv, script_dir=None, zip_file=None):
     return
   assert f.mode == 'optimize'  # Implemented below.
 
+  file_pairs = None
+  if f.batch_file:
+    try:
+      file_pairs = ReadBatchFile(f.batch_file, f.use_multivalent)
+    except (IOError, OSError, ValueError), e:
+      LogFatal('cannot read batch file %s: %s' % (f.batch_file, e), 1)
+    if file_pairs:
+      output_file_name = file_pairs[0][1]
+
   used_script_dir = GetUsedScriptDir(script_dir, zip_file)
   libexec_dir = GetLibexecDir(used_script_dir)
   if libexec_dir is not None:
@@ -9719,6 +13077,18 @@ def main(argv, script_dir=None, zip_file=None):
 
   # Call it before the first call to GetGsCommand(...).
   SetupTmpPrefix(output_file_name, f.tmp_dir)
+  if f.do_use_gs_worker and GsWorkerPool.IsSupported():
+    GS_WORKER_POOL = GsWorkerPool(timeout=f.gs_job_timeout or None)
+  if f.image_cache_dir and f.do_optimize_images:
+    if hashlib is None:
+      LogWarning('image cache needs hashlib (Python 2.5), not using it')
+    else:
+      IMAGE_CACHE = ImageCache(f.image_cache_dir,
+                               f.image_cache_max_size << 20)
+  if f.flate_effort >= 3 and deflate.zopfli is None:
+    LogWarning('zopfli Python module not found, using only zlib for '
+               '--flate-effort=%d' % f.flate_effort)
+  FLATE_COMPRESSOR = flate_compressor
 
   if f.do_debug_gs:
     LogInfo('PATH: %s' % os.getenv('PATH', ''))
@@ -9761,62 +13131,21 @@ def main(argv, script_dir=None, zip_file=None):
         'ignore with --do-require-image-optimizers=no', 3)
   img_cmd_patterns = img_cmd_patterns_good
 
-  if output_file_name is None:  # Just --do-debug-gs=yes.
+  if file_pairs is not None:
+    failed_count = OptimizeBatch(
+        f, file_pairs, img_cmd_patterns, multivalent_compress_command)
+  elif output_file_name is None:  # Just --do-debug-gs=yes.
     return
-
-  # It's OK that file_name == output_file_name: we don't read and write them
-  # at the same time.
-  pdf = PdfData(
-      do_ignore_generation_numbers=f.do_ignore_generation_numbers,
-      ).Load(file_name)
-  pdf.RemoveUnusedObjs()
-  pdf.FixAllBadNumbers()
-  if f.do_optimize_fonts:
-    pdf.ConvertType1FontsToType1C()
-    pdf.OptimizeType1CFonts(
-        do_keep_font_optionals=f.do_keep_font_optionals,
-        do_double_check_type1c_output=f.do_double_check_type1c_output,
-        do_unify_fonts=f.do_unify_fonts,
-        do_regenerate_all_fonts=f.do_regenerate_all_fonts)
-  if f.do_optimize_images:
-    pdf.ConvertInlineImagesToXObjects()
-    pdf.OptimizeImages(
-        img_cmd_patterns=img_cmd_patterns,
-        do_fast_bilevel_images=f.do_fast_bilevel_images)
-  if f.do_optimize_streams:
-    # We call this before pdf.OptimizeObjs, so pdf.OptimizeObjs can found
-    # more duplicate objs (in case the same stream data was compressed
-    # differently).
-    pdf.OptimizeStreams(do_decompress_only=f.do_decompress_most_streams)
-  if f.do_optimize_objs or f.do_remove_generational_objs:
-    # TODO(pts): Do only a simpler optimization with renumbering if
-    # f.do_optimize_objs is false and f.do_remove_generational_objs is true.
-    pdf.OptimizeObjs(do_unify_pages=f.do_unify_pages)
-  elif f.do_optimize_obj_heads:
-    pdf.trailer.head = PdfObj.CompressValue(pdf.trailer.head)
-    for obj in pdf.objs.itervalues():
-      obj.head = PdfObj.CompressValue(obj.head)
-  if f.do_decompress_most_streams:
-    # TODO(pts): Also decompress in Multivalent output.
-    pdf.DecompressStreams(is_flate_only=False)
-  elif f.do_decompress_flate:
-    # TODO(pts): Also decompress in Multivalent output.
-    pdf.DecompressStreams(is_flate_only=True)
-  # TODO(pts): Better handle which of f.do_compress_uncompressed_streams
-  #            and f.do_decompress_most_streams takes precedence. Maybe
-  #            that which is specified on the command-line (?).
-  if (f.do_compress_uncompressed_streams and
-      not f.do_decompress_most_streams and
-      multivalent_compress_command is None):
-    pdf.CompressUncompressedStreams()
-  pdf.Save(
-      output_file_name + '.tmp',
-      display_file_name=output_file_name,
-      multivalent_compress_command=multivalent_compress_command,
-      do_update_file_meta=True,
-      do_escape_images_from_multivalent=f.do_escape_images_from_multivalent,
-      do_generate_xref_stream=f.do_generate_xref_stream,
-      do_generate_object_stream=f.do_generate_object_stream,
-      is_flate_ok=(f.do_compress_uncompressed_streams and
-                   not f.do_decompress_most_streams))
-  Rename(output_file_name + '.tmp', output_file_name)
+  else:
+    OptimizeFile(
+        f, file_name, output_file_name, img_cmd_patterns,
+        multivalent_compress_command)
+    failed_count = 0
+  if IMAGE_CACHE is not None:
+    # Only once per run, not for each PDF in the batch.
+    LogInfo('image cache: removed %d old entries' % IMAGE_CACHE.Prune())
+  if GS_WORKER_POOL is not None:
+    GS_WORKER_POOL.Close()
+  if failed_count:
+    LogFatal('failed to optimize %d of %d PDFs' %
+             (failed_count, len(file_pairs)))
@@ -665,3 +665,48 @@ IMAGE_RENDERER = r'''
 % </ProcSet>
 
 '''
+GS_WORKER = r'''
+% <ProcSet>
+% PostScript procset of a long-lived Ghostscript worker, running jobs read
+% from stdin. Needs GENERIC, which is thus available to all jobs.
+%
+% Each job is a single line on stdin: <nonce> <ps-file-name> /Key1 <value1> ...
+% where the nonce, the file name and the values are hex strings. The job runs
+% the PostScript file with the keys defined in userdict, between save and
+% restore. When the job is done, this procset writes
+% \n:GsJobDone:<nonce>:<status>\n to stdout, where the status is 0 on success,
+% and 1 on a PostScript error.
+
+/_JobIn (%stdin) (r) file def
+/_JobOut (%stdout) (w) file def
+/_JobLine 65535 string def
+
+/_RunJob {  % <line> _RunJob -
+  % At the end of the line, token pushes only false, so no pop is needed.
+  mark exch {token not {exit} if exch} loop
+  counttomark array astore exch pop /_Job exch def
+  save /_JobSave exch def
+  2 2 _Job length 1 sub {
+    _Job exch 2 getinterval aload pop userdict 3 1 roll put
+  } for
+  {_Job 1 get run} stopped
+  % Keep only the bool on the operand stack, restore would fail otherwise.
+  count 1 roll count 1 sub {pop} repeat
+  $error /newerror false put
+  cleardictstack
+  _JobSave restore
+  {(1)} {(0)} ifelse
+  _JobOut (\n:GsJobDone:) writestring
+  _JobOut _Job 0 get writestring
+  _JobOut (:) writestring
+  _JobOut exch writestring
+  _JobOut (\n) writestring
+  _JobOut flushfile
+} bind def
+
+_JobOut (\n:GsWorkerReady:\n) writestring _JobOut flushfile
+{_JobIn _JobLine readline not {exit} if _RunJob} loop
+quit
+% </ProcSet>
+
+'''
@@ -260,6 +260,8 @@ def main(argv):
         # 'pdfsizeopt/pdfsizeopt_pargparse.py',  # Not needed.
         'pdfsizeopt/__init__.py',
         'pdfsizeopt/cff.py',
+        'pdfsizeopt/deflate.py',
+        'pdfsizeopt/filters.py',
         'pdfsizeopt/float_util.py',
         'pdfsizeopt/main.py'):
       code_orig = open('lib/' + file_name, 'rb').read()
@@ -37,11 +37,15 @@ if os.path.isfile(os.path.join(
 
 # ---
 
+import StringIO
 import sys
+import tempfile
 import zlib
 import unittest
 
 from pdfsizeopt import cff
+from pdfsizeopt import deflate
+from pdfsizeopt import filters
 from pdfsizeopt import float_util
 from pdfsizeopt import main
 
@@ -481,6 +485,17 @@ class PdfSizeOptTest(unittest.TestCase):
     self.assertEqual(['[ ]', '[\t[\f]]', '<<\t [\f[ >>', True, False, None],
                      e('[[ ] [\t[\f]] <<\t [\f[ >> true%\nfalse\fnull]'))
 
+  def testCanonicalizeDictOrder(self):
+    e = main.PdfObj.CanonicalizeDictOrder
+    self.assertEqual('[/b/a 1 0 R]', e('[/b/a 1 0 R]'))
+    self.assertEqual('<</A 5/B 4 0 R>>', e('<</B 4 0 R/A 5>>'))
+    self.assertEqual('<</A[<</X<6f>/Y 1 0 R>>]/B true>>',
+                     e('<</B true/A[<</Y 1 0 R/X<6f>>>]>>'))
+    self.assertEqual('[<</A 1 2 R/B/c>>1]', e('[<</B/c/A 1 2 R>>1]'))
+    self.assertEqual('<</B 1/A 2/B 3>>', e('<</B 1/A 2/B 3>>'))
+    self.assertRaises(main.PdfTokenParseError, e, '<</A 1]')
+    self.assertRaises(main.PdfTokenParseError, e, '<</A{1}>>')
+
   def testParseValueRecursive(self):
     e = main.PdfObj.ParseValueRecursive
     self.assertEqual(None, e('null'))
@@ -1248,6 +1263,24 @@ class PdfSizeOptTest(unittest.TestCase):
         {1: ('<</S(q)/P 2 0 R>>', None),
          2: ('<</P 1 0 R/S(q)>>', None)}, new_objs)
 
+  def testFindEqclassesCanonicalizeDicts(self):
+    pdf = main.PdfData()
+    pdf.trailer = main.PdfObj('0 0 obj<<>>endobj')
+    pdf.objs[1] = main.PdfObj('0 0 obj<</S(q)/P 2 0 R>>endobj')
+    pdf.objs[2] = main.PdfObj('0 0 obj<</P 1 0 R/S(q)>>endobj')
+    pdf.objs[3] = main.PdfObj('0 0 obj<</S(q)/P 4 0 R>>endobj')
+    pdf.objs[4] = main.PdfObj('0 0 obj<</P 3 0 R  /S<71>>>endobj')
+    pdf.objs[5] = main.PdfObj('0 0 obj<</S(r)/P 6 0 R>>endobj')
+    pdf.objs[6] = main.PdfObj('0 0 obj<</P 5 0 R/S(q)>>endobj')
+    new_objs = main.PdfData.FindEqclasses(
+        pdf.objs, do_canonicalize_dicts=True)
+    for obj_num in new_objs:
+      new_objs[obj_num] = (new_objs[obj_num].head, new_objs[obj_num].stream)
+    self.assertEqual(
+        {1: ('<</S(q)/P 1 0 R>>', None),
+         5: ('<</S(r)/P 6 0 R>>', None),
+         6: ('<</P 5 0 R/S(q)>>', None)}, new_objs)
+
   def testFindEqclassesTwoGroupsByStream(self):
     pdf = main.PdfData()
     pdf.trailer = main.PdfObj('0 0 obj<<>>endobj')
@@ -1281,6 +1314,26 @@ class PdfSizeOptTest(unittest.TestCase):
          3: ('<</S(q)/P 4 0 R>>', None), 4: ('<</S(q)/P 3 0 R>>', 'fox')},
         new_objs)
 
+  def testFindEqclassesSplitPropagatesAlongChains(self):
+    pdf = main.PdfData()
+    pdf.objs['trailer'] = main.PdfObj(
+        '0 0 obj<</A[1 0 R 5 0 R 9 0 R]>>endobj')
+    for first_obj_num, value in ((1, 0), (5, 1), (9, 0)):
+      for obj_num in xrange(first_obj_num, first_obj_num + 3):
+        pdf.objs[obj_num] = main.PdfObj(
+            '0 0 obj<</N %d 0 R>>endobj' % (obj_num + 1))
+      pdf.objs[first_obj_num + 3] = main.PdfObj(
+          '0 0 obj<</V %d>>endobj' % value)
+    new_objs = main.PdfData.FindEqclasses(pdf.objs)
+    for obj_num in new_objs:
+      new_objs[obj_num] = (new_objs[obj_num].head, new_objs[obj_num].stream)
+    self.assertEqual(
+        {'trailer': ('<</A[1 0 R 5 0 R 1 0 R]>>', None),
+         1: ('<</N 2 0 R>>', None), 2: ('<</N 3 0 R>>', None),
+         3: ('<</N 4 0 R>>', None), 4: ('<</V 0>>', None),
+         5: ('<</N 6 0 R>>', None), 6: ('<</N 7 0 R>>', None),
+         7: ('<</N 8 0 R>>', None), 8: ('<</V 1>>', None)}, new_objs)
+
   def testFindEqclassesTwoGroupsWithTrailer(self):
     pdf = main.PdfData()
     pdf.trailer = main.PdfObj(
@@ -1543,6 +1596,874 @@ class PdfSizeOptTest(unittest.TestCase):
     zdata2 += zc.flush(zlib.Z_SYNC_FLUSH)
     self.assertEqual(e(zdata2), data)
 
+  def testLoadMmap(self):
+    header = '%PDF-1.4\n'
+    obj_datas = [
+        '1 0 obj\n<</Type/Catalog/Pages 2 0 R>>\nendobj\n',
+        '2 0 obj\n<</Type/Pages/Kids[]/Count 0>>\nendobj\n',
+        '3 0 obj\n<</Length 5>>stream\nHello\nendstream\nendobj\n']
+    output = [header]
+    xref = ['xref\n0 4\n0000000000 65535 f \n']
+    for obj_data in obj_datas:
+      xref.append('%010d 00000 n \n' % len(''.join(output)))
+      output.append(obj_data)
+    xref_ofs = len(''.join(output))
+    output.extend(xref)
+    output.append('trailer\n<</Size 4/Root 1 0 R>>\nstartxref\n%d\n%%%%EOF\n' %
+                  xref_ofs)
+    fd, file_name = tempfile.mkstemp(suffix='.pdf')
+    try:
+      os.write(fd, 'junk\n' + ''.join(output))  # Junk is ignored.
+      os.close(fd)
+      old_verbosity = main.VERBOSITY
+      main.VERBOSITY = 20
+      try:
+        pdf_read = main.PdfData().Load(file_name, do_mmap=False)
+        pdf_mapped = main.PdfData().Load(file_name, do_mmap=True)
+        pdf_lazy = main.PdfData().Load(file_name, do_mmap=True, do_lazy=True)
+        output_lazy = []
+        pdf_lazy.AppendSerializedPdf(output_lazy)
+        self.assertEqual(None, pdf_lazy.objs[3]._stream)  # Still lazy.
+        output_read = []
+        pdf_read.AppendSerializedPdf(output_read)
+        self.assertEqual(''.join(output_read), ''.join(output_lazy))
+      finally:
+        main.VERBOSITY = old_verbosity
+    finally:
+      os.remove(file_name)
+    for pdf in (pdf_read, pdf_mapped, pdf_lazy):
+      self.assertEqual([1, 2, 3], sorted(pdf.objs))
+      self.assertEqual('<</Type/Catalog/Pages 2 0 R>>', pdf.objs[1].head)
+      self.assertEqual('<</Length 5>>', pdf.objs[3].head)
+      self.assertEqual(str, type(pdf.objs[3].stream))
+      self.assertEqual('Hello', pdf.objs[3].stream)
+      self.assertEqual('<</Size 4/Root 1 0 R>>', pdf.trailer.head)
+
+  def testAppendSerializedPdfObjStmLayout(self):
+    pdf = main.PdfData()
+    pdf.version = '1.5'
+    for i in xrange(20):
+      pdf.objs[10 + 3 * i] = main.PdfObj(
+          '0 0 obj<</Type/Font/Subtype/Type1/BaseFont/F%d/FirstChar 32'
+          '/Encoding/WinAnsiEncoding>>endobj' % (i % 3))
+      pdf.objs[11 + 3 * i] = main.PdfObj(
+          '0 0 obj<</Type/Annot/Subtype/Link/Rect[%d 0 9 9]'
+          '/Border[0 0 0]>>endobj' % i)
+      pdf.objs[12 + 3 * i] = main.PdfObj(
+          '0 0 obj<</Type/Page/Parent 2 0 R/Annots[%d 0 R]/Resources'
+          '<</Font<</F1 %d 0 R>>>>>>endobj' % (11 + 3 * i, 10 + 3 * i))
+    pdf.objs[1] = main.PdfObj('0 0 obj<</Type/Catalog/Pages 2 0 R>>endobj')
+    pdf.objs[2] = main.PdfObj('0 0 obj<</Type/Pages/Count 0>>endobj')
+    pdf.objs[3] = main.PdfObj('0 0 obj<</Length 2>>stream\nHi\nendstream '
+                              'endobj')
+    pdf.trailer = main.PdfObj('0 0 obj<</Size 70/Root 1 0 R>>endobj')
+    old_verbosity = main.VERBOSITY
+    main.VERBOSITY = 20
+    try:
+      objstm_items = [(obj_num, pdf.objs[obj_num].head)
+                      for obj_num in sorted(pdf.objs) if obj_num != 3]
+      objstms = main.PdfData.LayOutObjStms(objstm_items)
+      self.assertEqual(
+          [obj_num for obj_num, _ in objstm_items],
+          sorted([obj_num for objstm_obj, objstm_obj_numbers in objstms
+                  for obj_num in objstm_obj_numbers]))
+      self.assertEqual([], main.PdfData.LayOutObjStms([(5, '42')]))
+      output = []
+      pdf.AppendSerializedPdf(output)
+      fd, file_name = tempfile.mkstemp(suffix='.pdf')
+      try:
+        os.write(fd, ''.join(output))
+        os.close(fd)
+        pdf2 = main.PdfData().Load(file_name)
+      finally:
+        os.remove(file_name)
+    finally:
+      main.VERBOSITY = old_verbosity
+    self.assertEqual(sorted(pdf.objs), sorted(pdf2.objs))
+    for obj_num in sorted(pdf.objs):
+      self.assertEqual(
+          (obj_num, pdf.objs[obj_num].head, pdf.objs[obj_num].stream),
+          (obj_num, pdf2.objs[obj_num].head, pdf2.objs[obj_num].stream))
+
+  def testOptimizeStreamsParallel(self):
+    def BuildPdf():
+      pdf = main.PdfData()
+      for obj_num in xrange(1, 21):
+        data = ''.join(['%d %d m\n' % (i * obj_num % 97, i)
+                        for i in xrange(obj_num * 30)])
+        if obj_num & 1:
+          data = zlib.compress(data, 1)
+          head = '<</Filter/FlateDecode/Length %d>>' % len(data)
+        else:
+          head = '<</Length %d>>' % len(data)
+        obj = main.PdfObj(None)
+        obj.head, obj.stream = head, data
+        pdf.objs[obj_num] = obj
+      return pdf
+
+    old_verbosity = main.VERBOSITY
+    old_batch_size = main.PdfData.MAX_RECOMPRESS_BATCH_SIZE
+    main.VERBOSITY = 20
+    try:
+      pdf1 = BuildPdf()
+      pdf1.OptimizeStreams(jobs=1)
+      main.PdfData.MAX_RECOMPRESS_BATCH_SIZE = 2000
+      pdf3 = BuildPdf()
+      pdf3.OptimizeStreams(jobs=3)
+    finally:
+      main.VERBOSITY = old_verbosity
+      main.PdfData.MAX_RECOMPRESS_BATCH_SIZE = old_batch_size
+    self.assertEqual(sorted(pdf1.objs), sorted(pdf3.objs))
+    for obj_num in sorted(pdf1.objs):
+      self.assertEqual((pdf1.objs[obj_num].head, pdf1.objs[obj_num].stream),
+                       (pdf3.objs[obj_num].head, pdf3.objs[obj_num].stream))
+    self.assertEqual('/FlateDecode', pdf3.objs[20].Get('Filter'))
+
+  def testGetStreamSizeFunc(self):
+    for head in ('<</Length 3>>', '<< /Length 3 /Filter /FlateDecode >>',
+                 '<</Type/XObject/Length 3/Filter[/FlateDecode]/DecodeParms'
+                 '<</Predictor 12 /Columns 4>>/Name (a\\)b)>>'):
+      obj = main.PdfObj(None)
+      obj.head, obj.stream = head, 'foo'
+      get_stream_size = obj.GetStreamSizeFunc()
+      for stream_size, filter_value, decodeparms in (
+          (3, None, None), (3, '/FlateDecode', None),
+          (3, '[/FlateDecode]', '<</Predictor 12 /Columns 4>>'),
+          (42, '/FlateDecode', '<</Predictor 2/Colors 3/Columns 5>>')):
+        obj2 = main.PdfObj(obj)
+        obj2.stream = 'x' * stream_size
+        obj2.Set('Length', stream_size)
+        obj2.Set('Filter', filter_value)
+        obj2.Set('DecodeParms', decodeparms)
+        self.assertEqual(
+            (head, stream_size, filter_value, obj2.size),
+            (head, stream_size, filter_value,
+             get_stream_size(stream_size, filter_value, decodeparms)))
+      self.assertEqual(head, obj.head)
+
+  def testSetStreamAndCompressSkipsHopelessFlate(self):
+    compressed = []
+    def FlateCompress(data):
+      compressed.append(data)
+      return zlib.compress(data, 9)
+    old_flate_compress = main.FlateCompress
+    main.FlateCompress = FlateCompress
+    try:
+      obj = main.PdfObj(None)
+      obj.head, obj.stream = '<</Length 2>>', 'ab'
+      obj.SetStreamAndCompress('abcd', predictor_width=2)
+      self.assertEqual([], compressed)
+      self.assertEqual(('<</Length 4>>', 'abcd'), (obj.head, obj.stream))
+      data = 'abcd' * 1000
+      obj.SetStreamAndCompress(data, predictor_width=4)
+      # The predictors can't beat the very short 'zip', so they are skipped.
+      self.assertEqual([data], compressed)
+      self.assertEqual(data, zlib.decompress(obj.stream))
+      self.assertEqual(None, obj.Get('DecodeParms'))
+      del compressed[:]
+      obj.SetStreamAndCompress(data, predictor_width=4, may_keep_old=True)
+      self.assertEqual([data], compressed)
+      del compressed[:]
+      obj.stream = zlib.compress(data, 9)[:10]
+      obj.Set('Length', 10)
+      obj.SetStreamAndCompress(data, predictor_width=4, may_keep_old=True)
+      self.assertEqual([], compressed)
+      self.assertEqual(10, len(obj.stream))
+    finally:
+      main.FlateCompress = old_flate_compress
+
+  def testLoadParallel(self):
+    if main.GetJobCount(2) < 2:
+      return  # No parallel processing on this system.
+    output = ['%PDF-1.4\n']
+    obj_ofs = []
+    for obj_num in xrange(1, 41):
+      obj_ofs.append(len(''.join(output)))
+      if obj_num == 1:
+        output.append('1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n')
+      elif obj_num == 7:
+        output.append('7 0 obj<</Bad(endobj\n')
+      elif obj_num & 1:  # Indirect /Length, needs the second pass.
+        output.append(
+            '%d 0 obj<</Length %d 0 R>>stream\nHi%d\nendstream endobj\n' %
+            (obj_num, obj_num + 1, obj_num))
+      else:
+        output.append('%d 0 obj %d endobj\n' % (obj_num, 3 + (obj_num > 10)))
+    xref_ofs = len(''.join(output))
+    output.append('xref\n0 41\n0000000000 65535 f \n')
+    output.extend(['%010d 00000 n \n' % ofs for ofs in obj_ofs])
+    output.append(
+        'trailer\n<</Size 41/Root 1 0 R>>\nstartxref\n%d\n%%%%EOF\n' %
+        xref_ofs)
+    fd, file_name = tempfile.mkstemp(suffix='.pdf')
+    old_min_count = main.PdfData.MIN_PARALLEL_PARSE_OBJ_COUNT
+    old_verbosity = main.VERBOSITY
+    try:
+      os.write(fd, ''.join(output))
+      os.close(fd)
+      main.VERBOSITY = 20
+      main.PdfData.MIN_PARALLEL_PARSE_OBJ_COUNT = 1
+      pdf_parallel = main.PdfData().Load(file_name, jobs=3)
+      pdf_sequential = main.PdfData().Load(file_name, jobs=1)
+      self.assertRaises(main.PdfTokenParseError, main.PdfData().Load,
+                        file_name, is_parse_error_ok=False, jobs=3)
+    finally:
+      main.PdfData.MIN_PARALLEL_PARSE_OBJ_COUNT = old_min_count
+      main.VERBOSITY = old_verbosity
+      os.remove(file_name)
+    self.assertEqual(39, len(pdf_parallel.objs))
+    self.assertFalse(7 in pdf_parallel.objs)
+    self.assertEqual('<</Length 3>>', pdf_parallel.objs[3].head)
+    self.assertEqual('Hi3', pdf_parallel.objs[3].stream)
+    self.assertEqual('Hi13', pdf_parallel.objs[13].stream)
+    self.assertEqual(sorted(pdf_sequential.objs), sorted(pdf_parallel.objs))
+    for obj_num in pdf_sequential.objs:
+      obj1 = pdf_sequential.objs[obj_num]
+      obj2 = pdf_parallel.objs[obj_num]
+      self.assertEqual((obj1.head, obj1.stream), (obj2.head, obj2.stream))
+
+  def testLoadParseCache(self):
+    if main.hashlib is None:
+      return  # No parse cache in Python 2.4.
+    output = ['%PDF-1.4\n']
+    obj_ofs = []
+    for obj_data in (
+        '1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n',
+        '2 0 obj<</Type/Pages/Kids[]/Count 0/Foo 3 0 R>>endobj\n',
+        '3 0 obj<</Length 4 0 R>>stream\nHello\nendstream endobj\n',
+        '4 0 obj 5 endobj\n'):
+      obj_ofs.append(len(''.join(output)))
+      output.append(obj_data)
+    xref_ofs = len(''.join(output))
+    output.append('xref\n0 5\n0000000000 65535 f \n')
+    output.extend(['%010d 00000 n \n' % ofs for ofs in obj_ofs])
+    output.append('trailer\n<</Size 5/Root 1 0 R>>\nstartxref\n%d\n%%%%EOF\n' %
+                  xref_ofs)
+    fd, file_name = tempfile.mkstemp(suffix='.pdf')
+    cache_dir = file_name + '.cache'
+    old_verbosity = main.VERBOSITY
+    old_load_parse_cache = main.PdfData._LoadParseCache
+    old_get_parse_code_digest = main.GetParseCodeDigest
+    load_results = []
+
+    def LoadParseCache(pdf, file_name, data):
+      result = old_load_parse_cache(pdf, file_name, data)
+      load_results.append(result)
+      return result
+
+    try:
+      os.write(fd, ''.join(output))
+      os.close(fd)
+      main.VERBOSITY = 20
+      main.PdfData._LoadParseCache = LoadParseCache
+      pdf1 = main.PdfData().Load(file_name, parse_cache_dir=cache_dir)
+      cache_file_names = os.listdir(cache_dir)
+      self.assertEqual(1, len(cache_file_names))
+      pdf2 = main.PdfData().Load(file_name, parse_cache_dir=cache_dir)
+      self.assertEqual(cache_file_names, os.listdir(cache_dir))
+      self.assertEqual([False, True], load_results)
+      self.assertNotEqual(
+          cache_file_names[0].split('.')[0],
+          main.PdfData(do_ignore_generation_numbers=True).GetParseCacheKey(
+              ''.join(output)))
+      # Simulate a pdfsizeopt upgrade.
+      main.GetParseCodeDigest = lambda: '\1' * 32
+      pdf3 = main.PdfData().Load(file_name, parse_cache_dir=cache_dir)
+      self.assertEqual([False, True, False], load_results)
+      self.assertEqual(2, len(os.listdir(cache_dir)))
+      pdf4 = main.PdfData().Load(file_name, parse_cache_dir=cache_dir)
+      self.assertEqual([False, True, False, True], load_results)
+    finally:
+      main.VERBOSITY = old_verbosity
+      main.PdfData._LoadParseCache = old_load_parse_cache
+      main.GetParseCodeDigest = old_get_parse_code_digest
+      os.remove(file_name)
+      if os.path.isdir(cache_dir):
+        for cache_file_name in os.listdir(cache_dir):
+          os.remove(os.path.join(cache_dir, cache_file_name))
+        os.rmdir(cache_dir)
+    for pdf in (pdf1, pdf2, pdf3, pdf4):
+      self.assertEqual([1, 2, 3, 4], sorted(pdf.objs))
+      self.assertEqual('<</Length 5>>', pdf.objs[3].head)
+      self.assertEqual('Hello', pdf.objs[3].stream)
+      self.assertEqual('<</Size 5/Root 1 0 R>>', pdf.trailer.head)
+      self.assertEqual('1.4', pdf.version)
+
+  def testImageCache(self):
+    if main.hashlib is None:
+      return  # No image cache in Python 2.4.
+    if sys.platform.startswith('win'):
+      return  # The commands below need a Unix shell.
+    tmp_dir = tempfile.mkdtemp()
+    cache_dir = os.path.join(tmp_dir, 'cache')
+    source_file_name = os.path.join(tmp_dir, 'source.png')
+    count_file_name = os.path.join(tmp_dir, 'count')
+    old_verbosity = main.VERBOSITY
+    old_image_cache = main.IMAGE_CACHE
+    try:
+      main.VERBOSITY = 20
+      main.IMAGE_CACHE = image_cache = main.ImageCache(cache_dir, 1 << 20)
+      f = open(source_file_name, 'wb')
+      try:
+        f.write('Hello')
+      finally:
+        f.close()
+      cmd_pattern = 'echo >>%s && cp %%(sourcefnq)s %%(targetfnq)s' % (
+          main.ShellQuoteFileName(count_file_name))
+      cache_hits_list = []
+      for _ in xrange(2):
+        cache_hits = []
+        self.assertEqual(('cp', 'Hello'), main.PdfData.ConvertImage(
+            sourcefn=source_file_name,
+            targetfn=os.path.join(tmp_dir, 'target.png'),
+            cmd_pattern=cmd_pattern, cmd_name='cp', do_just_read=True,
+            cache_hits=cache_hits))
+        cache_hits_list.append(cache_hits)
+      self.assertEqual([[], [True]], cache_hits_list)
+      self.assertEqual((1, 1), (image_cache.hit_count, image_cache.miss_count))
+      self.assertEqual(1, len(open(count_file_name).read().split('\n')) - 1)
+      self.assertEqual(None, main.PdfData.ConvertImage(
+          sourcefn=source_file_name,
+          targetfn=os.path.join(tmp_dir, 'target.jbig2'),
+          cmd_pattern='false %(targetfnq)s', cmd_name='false',
+          return_none_if_status=0x100))
+      self.assertEqual((0x100, ''), image_cache.Get(image_cache.GetKey(
+          source_file_name, 'false TARGET.jbig2')))
+      self.assertEqual(2, len(os.listdir(cache_dir)))
+      self.assertEqual(0, image_cache.Prune())
+      image_cache.max_size = 1
+      self.assertEqual(2, image_cache.Prune())
+      self.assertEqual([], os.listdir(cache_dir))
+    finally:
+      main.VERBOSITY = old_verbosity
+      main.IMAGE_CACHE = old_image_cache
+      for dir_name in (cache_dir, tmp_dir):
+        if os.path.isdir(dir_name):
+          for file_name in os.listdir(dir_name):
+            if not os.path.isdir(os.path.join(dir_name, file_name)):
+              os.remove(os.path.join(dir_name, file_name))
+          os.rmdir(dir_name)
+
+  def testImageTimeBudget(self):
+    budget = main.ImageTimeBudget(image_budget=10)
+    self.assertEqual(None, budget.doc_deadline)
+    self.assertEqual('pngout', budget.GetToolName('pngout2'))
+    self.assertEqual(None, budget.GetToolName('foo'))
+    self.assertAlmostEqual(4.0, budget.Predict('pngout', 2e6))
+    budget.Record('pngout', 2e6, 8.0)
+    self.assertAlmostEqual(8.0, budget.Predict('pngout2', 2e6))
+    budget.Record('pngout', 2e6, 4.0)
+    self.assertAlmostEqual(6.0, budget.Predict('pngout', 2e6))
+    self.assertAlmostEqual(1.0, budget.Predict('foo', 2e6))
+    cmd_items = [('pngout', 'pngout'), ('optipng', 'optipng'),
+                 ('foo', 'foo'), ('jbig2', 'jbig2')]
+    self.assertEqual(['jbig2', 'foo', 'optipng', 'pngout'],
+                     [item[0] for item in budget.SortCmdItems(cmd_items, 2e6)])
+    budget = main.ImageTimeBudget(image_budget=100, doc_budget=10)
+    self.assertTrue(budget.GetImageDeadline() <= budget.doc_deadline)
+
+  def testImageOptimizerStats(self):
+    image = main.ImageData()
+    image.width, image.height, image.color_type, image.bpc = 3, 5, 'gray', 8
+    self.assertEqual('gray-8-1', main.ImageOptimizerStats.GetImageClass(image))
+    image.width = 4
+    self.assertEqual('gray-8-2', main.ImageOptimizerStats.GetImageClass(image))
+    fd, file_name = tempfile.mkstemp(suffix='.stats')
+    os.close(fd)
+    os.remove(file_name)
+    try:
+      stats = main.ImageOptimizerStats(file_name).Load()
+      for _ in xrange(main.ImageOptimizerStats.MIN_RUN_COUNT):
+        self.assertEqual(False, stats.IsLosing('gray-8-2', 'pngout'))
+        stats.RecordImage('gray-8-2', 100, [90], [
+            ('zopflipng', 80, 2.0), ('pngout', 85, 1.0),
+            ('optipng', None, 0.5)])
+      self.assertEqual(True, stats.IsLosing('gray-8-2', 'pngout'))
+      self.assertEqual(True, stats.IsLosing('gray-8-2', 'optipng'))
+      self.assertEqual(False, stats.IsLosing('gray-8-2', 'zopflipng'))
+      self.assertEqual(False, stats.IsLosing('rgb-8-2', 'pngout'))
+      retry_period = main.ImageOptimizerStats.RETRY_PERIOD
+      self.assertEqual(
+          [True] * (retry_period - 2) + [False, True],
+          [stats.IsLosing('gray-8-2', 'pngout') for _ in xrange(retry_period)])
+      stats.RecordImage('gray-8-2', 100, [], [('pngout', 75, 1.0)])
+      self.assertEqual(False, stats.IsLosing('gray-8-2', 'pngout'))
+      stats.Save()
+      if main.fcntl is not None:
+        self.assertEqual(True, os.path.exists(file_name + '.lock'))
+      stats.Save()  # Doesn't record the runs again.
+      stats2 = main.ImageOptimizerStats(file_name).Load()
+      self.assertEqual([10, 10, 200, 20.0],
+                       stats2.GetCounts('gray-8-2', 'zopflipng'))
+      self.assertEqual([11, 1, 175, 11.0],
+                       stats2.GetCounts('gray-8-2', 'pngout'))
+    finally:
+      for file_name2 in (file_name, file_name + '.lock'):
+        if os.path.exists(file_name2):
+          os.remove(file_name2)
+
+  def testObjFingerprints(self):
+    if main.hashlib is None:
+      return
+    def BuildPdf(data2):
+      pdf = main.PdfData()
+      for obj_num, head, stream in (
+          (1, '<</Length 9/Foo 2 0 R>>', 'q Q q Q q'),
+          (2, '<</Length %d>>' % len(data2), data2),
+          (3, '<</Length 250>>', 'BT/A ' * 50),
+      ):
+        obj = main.PdfObj(None)
+        obj.head, obj.stream = head, stream
+        pdf.objs[obj_num] = obj
+      obj = main.PdfObj(None)
+      obj.head = '<</Type/Catalog>>'
+      pdf.objs[4] = obj
+      return pdf
+
+    data = 'q Q ' * 100
+    fd, file_name = tempfile.mkstemp(suffix='.fingerprints')
+    os.close(fd)
+    os.remove(file_name)
+    old_verbosity = main.VERBOSITY
+    main.VERBOSITY = 20
+    try:
+      fingerprints = main.ObjFingerprints(file_name).Load()
+      pdf = BuildPdf(data)
+      other_fingerprints = main.ObjFingerprints(file_name).Load()
+      pdf.RecordOptimizedObjs(fingerprints)
+      fingerprints.Save()
+      if main.fcntl is not None:
+        self.assertEqual(True, os.path.exists(file_name + '.lock'))
+      # Saving a concurrently loaded instance keeps the other fingerprints.
+      other_fingerprints.AddObj(BuildPdf('Q').objs[2])
+      other_fingerprints.Save()
+      pdf2 = BuildPdf(data + 'q Q ')
+      # Renumbering and reordering don't change the fingerprint.
+      obj = main.PdfObj(pdf2.objs.pop(1))
+      obj.head = '<< /Foo 42 0 R /Length 9 >>'
+      pdf2.objs[5] = obj
+      pdf2.FindOptimizedObjs(main.ObjFingerprints(file_name).Load())
+      self.assertEqual([3, 5], sorted(pdf2.optimized_obj_nums))
+      pdf2.OptimizeStreams()
+      self.assertEqual(None, pdf2.objs[3].Get('Filter'))  # Skipped.
+      self.assertEqual('/FlateDecode', pdf2.objs[2].Get('Filter'))
+      # Fingerprints recorded with other optimization flags don't match.
+      pdf3 = BuildPdf(data)
+      pdf3.FindOptimizedObjs(main.ObjFingerprints(file_name, 'x').Load())
+      self.assertEqual([], sorted(pdf3.optimized_obj_nums))
+      # Unfinished objs are renumbered by OptimizeObjs, and not recorded.
+      pdf3.trailer = main.PdfObj(
+          '0 0 obj<</Root 4 0 R/X[3 0 R 2 0 R 1 0 R]>>endobj')
+      pdf3.unfinished_obj_nums.add(2)
+      pdf3.OptimizeObjs(do_unify_pages=True)
+      new_obj_nums = dict((obj.stream, obj_num) for obj_num, obj
+                          in pdf3.objs.iteritems() if obj.stream is not None)
+      self.assertEqual([new_obj_nums[data]],
+                       sorted(pdf3.unfinished_obj_nums))
+      fingerprints3 = main.ObjFingerprints(file_name)
+      pdf3.RecordOptimizedObjs(fingerprints3)
+      self.assertEqual(True, fingerprints3.HasObj(
+          pdf3.objs[new_obj_nums['BT/A ' * 50]]))
+      self.assertEqual(False, fingerprints3.HasObj(
+          pdf3.objs[new_obj_nums[data]]))
+    finally:
+      main.VERBOSITY = old_verbosity
+      for file_name2 in (file_name, file_name + '.lock'):
+        if os.path.exists(file_name2):
+          os.remove(file_name2)
+
+  def testOptimizeFileInWorkerReportsFatalMessage(self):
+    file_name = os.path.join(tempfile.gettempdir(), 'pso-missing-%d.pdf' %
+                             os.getpid())
+    f = main.Flags()
+    f.tmp_dir = tempfile.gettempdir()
+    old_stderr, old_verbosity, old_tmp_prefix = (
+        sys.stderr, main.VERBOSITY, main.TMP_PREFIX)
+    sys.stderr = StringIO.StringIO()
+    main.VERBOSITY = 20
+    main.BATCH_WORKER_ARGS = (f, [(file_name, file_name + '.out')], [], None)
+    try:
+      self.assertEqual(False, main.OptimizeFileInWorker(0)[0])
+      output = sys.stderr.getvalue()
+    finally:
+      main.BATCH_WORKER_ARGS = None
+      sys.stderr, main.VERBOSITY, main.TMP_PREFIX = (
+          old_stderr, old_verbosity, old_tmp_prefix)
+    self.assertTrue(
+        '\nerror: cannot optimize %s: error opening PDF (' % file_name
+        in output, output)
+    self.assertTrue('SystemExit' not in output, output)
+
+  def testReadBatchFile(self):
+    fd, file_name = tempfile.mkstemp(suffix='.txt')
+    try:
+      os.write(fd, '# comment\r\na.pdf\n\nb c.PDF\tout/b.pdf\r\nd\n')
+      os.close(fd)
+      self.assertEqual(
+          [('a.pdf', 'a.pso.pdf'), ('b c.PDF', 'out/b.pdf'),
+           ('d', 'd.pso.pdf')],
+          main.ReadBatchFile(file_name, False))
+      self.assertEqual('a.psom.pdf',
+                       main.GetDefaultOutputFileName('a.pdf', True))
+      f = open(file_name, 'wb')
+      try:
+        f.write('a.pdf\tb.pdf\tc.pdf\n')
+      finally:
+        f.close()
+      self.assertRaises(ValueError, main.ReadBatchFile, file_name, False)
+    finally:
+      os.remove(file_name)
+
+  def testSystemWithTimeout(self):
+    if not main.GsWorkerPool.IsSupported():
+      return  # No process groups.
+    self.assertEqual(0, main.SystemWithTimeout('true', 10))
+    self.assertEqual(0x300, main.SystemWithTimeout('exit 3', 10))
+    self.assertEqual(None, main.SystemWithTimeout('sleep 5', 0.05))
+
+  def testAppendSerializedPdfToFile(self):
+    pdf = main.PdfData()
+    pdf.version = '1.4'
+    pdf.trailer = main.PdfObj('0 0 obj<</Size 4/Root 1 0 R>>endobj')
+    pdf.objs[1] = main.PdfObj('1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj')
+    pdf.objs[2] = main.PdfObj('2 0 obj<</Type/Pages/Kids[]/Count 0>>endobj')
+    pdf.objs[3] = main.PdfObj(
+        '3 0 obj<</Length 5>>stream\nHello\nendstream endobj')
+    old_verbosity = main.VERBOSITY
+    main.VERBOSITY = 20
+    try:
+      for do_generate_object_stream in (False, True):
+        output = []
+        output_size = pdf.AppendSerializedPdf(
+            output, do_generate_xref_stream=do_generate_object_stream,
+            do_generate_object_stream=do_generate_object_stream)
+        f = StringIO.StringIO()
+        self.assertEqual(output_size, pdf.AppendSerializedPdf(
+            f, do_generate_xref_stream=do_generate_object_stream,
+            do_generate_object_stream=do_generate_object_stream))
+        self.assertEqual(''.join(output), f.getvalue())
+        self.assertEqual(output_size, len(f.getvalue()))
+    finally:
+      main.VERBOSITY = old_verbosity
+    self.assertRaises(TypeError, pdf.AppendSerializedPdf, 'foo')
+
+  def testPdfObjNewLazy(self):
+    objs = {}
+    obj = main.PdfObj.NewLazy(
+        buffer('junk 4 0 obj<</Length 5 0 R>>stream\nHello\nendstream endobj',
+               5), 4, objs)
+    objs[5] = main.PdfObj.NewLazy('5 0 obj 5 endobj', 5, objs)
+    self.assertEqual('<</Length 5>>', obj.Peek().head)
+    self.assertEqual(None, obj._head)  # Peek keeps obj lazy.
+    self.assertEqual(5, obj.Get('Length'))
+    self.assertEqual('Hello', obj.stream)
+    self.assertEqual(None, obj._lazy)
+    obj = main.PdfObj.NewLazy('6 0 obj endobj', 6, objs,
+                              is_parse_error_ok=False)
+    self.assertRaises(main.PdfTokenParseError, lambda: obj.head)
+    obj = main.PdfObj.NewLazy('6 0 obj endobj', 6, objs)
+    old_verbosity = main.VERBOSITY
+    main.VERBOSITY = 20
+    try:
+      self.assertEqual(False, obj.IsUnparsable())
+      self.assertEqual('null', obj.Peek().head)
+      self.assertEqual(True, obj.IsUnparsable())
+      self.assertEqual('null', obj.head)
+    finally:
+      main.VERBOSITY = old_verbosity
+    self.assertEqual(None, obj.stream)
+
+  def testLazyRemoveUnusedObjsAndFixAllBadNumbers(self):
+    pdf = main.PdfData()
+    for obj_num, data in (
+        (1, '1 0 obj<</Type/Catalog/Pages 2 0 R/Foo 6 0 R>>endobj'),
+        (2, '2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj'),
+        (3, '3 0 obj<</Type/Page/Resources<</XObject<</X 4 0 R>>>>>>endobj'),
+        (4, '4 0 obj<</Subtype/Form/BBox[. . 9. 9.]/Length 0>>stream\n\n'
+            'endstream endobj'),
+        (5, '5 0 obj<</Unused true>>endobj'),
+        (6, '6 0 obj endobj')):  # Unparsable, removed as in eager mode.
+      pdf.objs[obj_num] = main.PdfObj.NewLazy(data, obj_num, pdf.objs)
+    pdf.trailer = main.PdfObj('0 0 obj<</Size 7/Root 1 0 R>>endobj')
+    old_verbosity = main.VERBOSITY
+    main.VERBOSITY = 20
+    try:
+      pdf.RemoveUnusedObjs()
+      pdf.FixAllBadNumbers()
+    finally:
+      main.VERBOSITY = old_verbosity
+    self.assertEqual([1, 2, 3, 4], sorted(pdf.objs))
+    # Only the form has been parsed (and fixed).
+    self.assertEqual([False, False, False, True],
+                     [pdf.objs[i]._lazy is None for i in (1, 2, 3, 4)])
+    self.assertEqual('[0 0 9. 9.]', pdf.objs[4].Get('BBox'))
+
+  def testParseGsFramedOutput(self):
+    results = main.PdfObj.ParseGsFramedOutput(
+        'C5\nHelloC2\n\n!E\nF\nE\n',
+        ['/LZWDecode', '/ASCII85Decode', '/RunLengthDecode'])
+    self.assertEqual(3, len(results))
+    self.assertEqual('Hello\n!', results[0])
+    self.assertTrue(isinstance(results[1], main.FilterError))
+    self.assertEqual('', results[2])
+    results = main.PdfObj.ParseGsFramedOutput(
+        'C3\nfooE\nC9\nbar', ['/A', '/B', '/C'], status=256)
+    self.assertEqual('foo', results[0])
+    self.assertTrue(isinstance(results[1], main.FilterError))
+    self.assertTrue('status=0x100' in str(results[1]))
+    self.assertTrue(isinstance(results[2], main.FilterError))
+
+  def testPrefetchUncompressedStreams(self):
+    obj1 = main.PdfObj('1 0 obj<</Length 5>>stream\nHello\nendstream endobj')
+    obj2 = main.PdfObj(None)
+    obj2.head = '<</Filter/FlateDecode>>'
+    obj2.stream = zlib.compress('World')
+    obj3 = main.PdfObj(None)
+    obj3.head = '<</Filter/CCITTFaxDecode>>'
+    obj3.stream = ''
+    # Only obj3 needs Ghostscript, and it's empty, so Ghostscript isn't run.
+    prefetched = main.PdfObj.PrefetchUncompressedStreams(
+        ((1, obj1), (2, obj2), (3, obj3)))
+    self.assertEqual({3: ''}, prefetched)
+    self.assertEqual('Hello', obj1.GetUncompressedStream())
+    self.assertEqual('World', obj2.GetUncompressedStream())
+    self.assertEqual('', obj3.GetUncompressedStream(prefetched=prefetched[3]))
+    self.assertRaises(main.FilterError, lambda: obj3.GetUncompressedStream(
+        prefetched=main.FilterError('bad')))
+    self.assertEqual([], main.PdfObj.DecodeWithGs(()))
+
+  def testFlateCompressor(self):
+    data = ''.join(['%d 0 0 %d re f\n' % (i * 7 % 100, i * 13 % 50)
+                    for i in xrange(500)])
+    output1 = deflate.FlateCompressor(effort=1).Compress(data)
+    self.assertEqual(zlib.compress(data, 9), output1)
+    output2 = deflate.FlateCompressor(effort=2).Compress(data)
+    self.assertEqual(data, zlib.decompress(output2))
+    self.assertTrue(len(output2) <= len(output1))
+    self.assertEqual(output1, deflate.FlateCompressor(
+        effort=2, min_size=len(data) + 1).Compress(data))
+    self.assertRaises(deflate.UnknownBackendError, deflate.FlateCompressor,
+                      backend_names=('no-such-backend',))
+    old_backends = deflate.BACKENDS[:]
+    try:
+      deflate.RegisterBackend('stored', lambda data, effort: (
+          effort >= 2 and zlib.compress(data, 0) or None))
+      self.assertEqual(zlib.compress(data, 0), deflate.FlateCompressor(
+          effort=2, backend_names=('stored',)).Compress(data))
+      self.assertEqual(output1, deflate.FlateCompressor(
+          effort=1, backend_names=('stored',)).Compress(data))
+    finally:
+      deflate.BACKENDS[:] = old_backends
+
+  def testDecodeSimpleFilters(self):
+    # Example from section 7.4.4.2 of the PDF 1.7 reference.
+    self.assertEqual('-----A---B', filters.DecodeLzw(
+        '\x80\x0b\x60\x50\x22\x0c\x0c\x85\x01'))
+    self.assertEqual('Hello World!', filters.DecodeAscii85(
+        '87cURD]i,\n"Ebo80~>'))
+    self.assertEqual('\0\0\0\0Hello, world', filters.DecodeAscii85(
+        'z87cURD_*#TDfTZ)~>'))
+    self.assertRaises(filters.FilterDecodeError, filters.DecodeAscii85, 'v')
+    self.assertEqual('Hell`', filters.DecodeAsciiHex('48 65 6c\n6c6>ff'))
+    self.assertRaises(filters.FilterDecodeError, filters.DecodeAsciiHex, 'xy')
+    self.assertEqual('abcccccX', filters.DecodeRunLength(
+        '\x01ab\xfcc\x00X\x80\x00Y'))
+
+  def testUnpredict(self):
+    # Rows of 2 pixels, 2 colors each: None, Sub, Up, Average, Paeth.
+    self.assertEqual(
+        '\1\2\3\4' '\5\6\7\x08' '\6\x08\x0a\x0c' '\x03\x04\x0e\x10'
+        '\x04\x05\x0f\x12',
+        filters.UnpredictPng(
+            '\0\1\2\3\4' '\1\5\6\2\2' '\2\1\2\3\4' '\3\0\0\x08\x08'
+            '\4\1\1\1\2', 2, 2))
+    # Truncated last row.
+    self.assertEqual('\1\2\3\4\2\4', filters.UnpredictPng(
+        '\0\1\2\3\4\2\1\2', 2, 2))
+    self.assertEqual('\1\2\1\2\xff\x01\1\0', filters.UnpredictTiff(
+        '\1\2\0\0\xff\x01\1\xff', 2, 1, 16))
+    self.assertEqual('\1\3\6\x09\x08', filters.UnpredictTiff(
+        '\1\2\3\3\xff', 5))
+    self.assertEqual(True, filters.IsPredictorSupported(
+        {'Predictor': 12, 'Columns': 5}))
+    self.assertEqual(False, filters.IsPredictorSupported(
+        {'Predictor': 2, 'BitsPerComponent': 4}))
+
+  def testPredict(self):
+    data = '\1\2\3\4' '\5\6\7\x08' '\6\x08\x0a\x0c' '\x03\x04\x0e\x10'
+    # Rows of 2 pixels, 2 colors each.
+    self.assertEqual(
+        '\0\1\2\3\4' '\0\5\6\7\x08' '\0\6\x08\x0a\x0c'
+        '\0\x03\x04\x0e\x10', filters.PredictPng(data, 2, 2, 8, 0))
+    self.assertEqual(
+        '\1\1\2\2\2' '\1\5\6\2\2' '\1\6\x08\4\4' '\1\3\4\x0b\x0c',
+        filters.PredictPng(data, 2, 2, 8, 1))
+    self.assertEqual(
+        '\2\1\2\3\4' '\2\4\4\4\4' '\2\1\2\3\4' '\2\xfd\xfc\4\4',
+        filters.PredictPng(data, 2, 2, 8, 2))
+    self.assertEqual(
+        '\3\1\2\3\3' '\3\5\5\3\3' '\3\4\5\4\4' '\3\0\0\x08\x08',
+        filters.PredictPng(data, 2, 2, 8, 3))
+    self.assertEqual(
+        '\4\1\2\2\2' '\4\4\4\2\2' '\4\1\2\3\4' '\4\xfd\xfc\x08\x08',
+        filters.PredictPng(data, 2, 2, 8, 4))
+    for filter_type in (0, 1, 2, 3, 4, None):
+      for colors, bpc in ((2, 8), (1, 16), (3, 2)):
+        self.assertEqual(data, filters.UnpredictPng(filters.PredictPng(
+            data, 2, colors, bpc, filter_type), 2, colors, bpc))
+        # Truncated last row.
+        self.assertEqual(data[:-3], filters.UnpredictPng(filters.PredictPng(
+            data[:-3], 2, colors, bpc, filter_type), 2, colors, bpc))
+    # Adaptive, by MSAD: Sub, Paeth, Up (tie with Paeth), Up.
+    self.assertEqual('\1\4\2\2', filters.PredictPng(data, 2, 2)[::5])
+    self.assertEqual('\1\1\0\0\xff\x01\1\xff', filters.PredictTiff(
+        '\1\1\1\1\xff\x01\1\0', 2, 1, 16))
+    self.assertEqual('\1\2\3\3\xff', filters.PredictTiff(
+        '\1\3\6\x09\x08', 5))
+
+  def testCompressToZipPngOptimizeFilters(self):
+    image = main.ImageData()
+    image.width, image.height, image.color_type, image.bpc = 64, 48, 'rgb', 8
+    image.is_inverted, image.is_interlaced = False, False
+    image.compression = 'none'
+    image.idat = ''.join([chr((x * 7 + y * 13 + c * 50) & 255)
+                          for y in xrange(48) for x in xrange(64)
+                          for c in xrange(3)])
+    image1 = main.ImageData(image).CompressToZipPng()
+    image2 = main.ImageData(image).CompressToZipPng(do_optimize_filters=True)
+    self.assertEqual(('zip-png', 'zip-png'),
+                     (image1.compression, image2.compression))
+    self.assertTrue(len(image2.idat) < len(image1.idat))
+    for image3 in (image1, image2):
+      self.assertEqual(image.idat, filters.UnpredictPng(
+          zlib.decompress(image3.idat), 64, 3, 8))
+    self.assertEqual('\0' * 48, zlib.decompress(image1.idat)[::193])
+
+  def testDecodeInProcess(self):
+    data = '\2\1\2\2\3\4'
+    compressed = zlib.compress(data).encode('hex')
+    self.assertEqual(
+        '\1\2\4\6', main.PdfObj.DecodeInProcess(
+            compressed, '[/ASCIIHexDecode /FlateDecode]',
+            '[null <</Predictor 12/Columns 2>>]'))
+    self.assertEqual(True, main.PdfObj.IsDecodableInProcess(
+        '/LZWDecode', '<</EarlyChange 0>>'))
+    self.assertEqual(False, main.PdfObj.IsDecodableInProcess(
+        '/CCITTFaxDecode', ''))
+    self.assertEqual(False, main.PdfObj.IsDecodableInProcess(
+        '[/FlateDecode /DCTDecode]', ''))
+    self.assertRaises(main.FilterError, main.PdfObj.DecodeInProcess,
+                      'xy', '/AHx', '')
+
+  def testGsWorkerReadUntil(self):
+    if not main.GsWorkerPool.IsSupported():
+      return
+    import subprocess
+    worker = main.GsWorker.__new__(main.GsWorker)
+    worker._proc = subprocess.Popen(
+        'printf "foo\\n:Done:x:0\\n"', shell=True, stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, preexec_fn=os.setsid)
+    self.assertEqual(('foo', '0\n'), worker._ReadUntil('\n:Done:x:', 2, 10))
+    self.assertRaises(main.GsWorkerError, worker._ReadUntil, 'bar', 0, None)
+    self.assertEqual(False, worker.IsRunning())
+    self.assertEqual(None, main.RunGsJob('job.ps', {}))  # No GS_WORKER_POOL.
+
+    class FailingPool(object):
+      def __init__(self, error):
+        self.error = error
+
+      def RunJob(self, ps_file_name, params):
+        raise self.error
+
+    old_gs_worker_pool = main.GS_WORKER_POOL
+    old_verbosity = main.VERBOSITY
+    try:
+      main.VERBOSITY = 0
+      main.GS_WORKER_POOL = FailingPool(main.GsWorkerError('crashed'))
+      # The caller retries the job without a worker.
+      self.assertEqual(None, main.RunGsJob('job.ps', {}))
+      main.GS_WORKER_POOL = FailingPool(main.GsJobTimeoutError('slow'))
+      self.assertEqual((2, ''), main.RunGsJob('job.ps', {}))
+    finally:
+      main.GS_WORKER_POOL = old_gs_worker_pool
+      main.VERBOSITY = old_verbosity
+
+  def testGsWorkerRunJob(self):
+    if not main.GsWorkerPool.IsSupported() or not main.FindExeOnPath('gs'):
+      return
+    tmp_dir = tempfile.mkdtemp()
+    ps_file_name = os.path.join(tmp_dir, 'job.ps')
+    old_tmp_prefix = main.TMP_PREFIX
+    old_verbosity = main.VERBOSITY
+    worker = None
+    try:
+      main.TMP_PREFIX = os.path.join(tmp_dir, 'psotmp.')
+      main.VERBOSITY = 0
+      f = open(ps_file_name, 'wb')
+      try:
+        f.write('FOO print (:) print BAR print flush\n')
+      finally:
+        f.close()
+      worker = main.GsWorker(timeout=30)
+      # BAR is the last param, it must not be dropped.
+      self.assertEqual((0, 'foo:bar'), worker.RunJob(
+          ps_file_name, {'FOO': 'foo', 'BAR': 'bar'}, timeout=30))
+      self.assertEqual((1, 'x:'), worker.RunJob(
+          ps_file_name, {'FOO': 'x'}, timeout=30))  # BAR is undefined.
+      self.assertEqual(True, worker.IsRunning())
+      self.assertEqual((0, 'x:y'), worker.RunJob(
+          ps_file_name, {'FOO': 'x', 'BAR': 'y'}, timeout=30))
+    finally:
+      if worker is not None:
+        worker.Close()
+      main.TMP_PREFIX = old_tmp_prefix
+      main.VERBOSITY = old_verbosity
+      if os.path.exists(ps_file_name):
+        os.remove(ps_file_name)
+      os.rmdir(tmp_dir)
+
+  def testGetThreadCount(self):
+    self.assertEqual(3, main.GetThreadCount(3))
+    self.assertEqual(main.GetCpuCount(), main.GetThreadCount(0))
+    self.assertTrue(main.GetCpuCount() >= 1)
+    old_multiprocessing = main.multiprocessing
+    try:
+      main.multiprocessing = None  # Like Python 2.5.
+      self.assertEqual(1, main.GetJobCount(3))
+      # Threads don't need multiprocessing.
+      self.assertEqual(3, main.GetThreadCount(3))
+      self.assertTrue(main.GetThreadCount(0) >= 1)
+    finally:
+      main.multiprocessing = old_multiprocessing
+
+  def testRunInThreads(self):
+    funcs = [lambda i=i: i * i for i in xrange(10)]
+    self.assertEqual([i * i for i in xrange(10)], main.RunInThreads(funcs, 1))
+    self.assertEqual([i * i for i in xrange(10)], main.RunInThreads(funcs, 3))
+    self.assertEqual([], main.RunInThreads([], 3))
+    calls = []
+
+    def Fail(i):
+      calls.append(i)
+      if i in (2, 3):
+        sys.exit(i)  # Like LogFatal.
+      return i
+
+    funcs = [lambda i=i: Fail(i) for i in xrange(5)]
+    try:
+      main.RunInThreads(funcs, 1)
+      self.fail('SystemExit not raised')
+    except SystemExit, e:
+      self.assertEqual(2, e.code)
+    self.assertEqual([0, 1, 2], calls)
+    try:
+      main.RunInThreads(funcs, 2)
+      self.fail('SystemExit not raised')
+    except SystemExit, e:
+      self.assertEqual(2, e.code)
+    self.assertRaises(ZeroDivisionError, main.RunInThreads,
+                      [lambda: 1, lambda: 1 / 0], 2)
+
   def testResolveReferencesChanged(self):
     def NewObj(head, stream=None, do_compress=False):
       obj = main.PdfObj(None)
@@ -2149,6 +3070,144 @@ class PdfSizeOptTest(unittest.TestCase):
     Check('B' * 260, [251, 254])
     Check('B' * 100000, [99991, 100007])
 
+  def testSerializeType1CFont(self):
+    parsed_font = {
+        'FontType': 2,
+        'PaintType': 0,
+        'FontMatrix': ['0.001', 0, 0, '0.001', 0, 0],
+        'FontInfo': {'Notice': '<48656c6c6f>', 'isFixedPitch': True,
+                     'UnderlinePosition': -120},
+        'UniqueID': 42,
+        'Private': {
+            'BlueValues': [-20, 0, 450, 470], 'StdHW': [33],
+            'BlueScale': '.0526316', 'Subrs': ['<0b>', '<8b0b>'],
+            'GlobalSubrs': ['<8c0b>']},
+        'CharStrings': {'A': '<8b0e>', 'B': '<8c0e>', 'pedal.#2A': '<8d0e>',
+                        'zzz': '<0e>'},
+        'FontName': '/X',
+    }
+    data = cff.SerializeType1CFont(parsed_font, 'F')
+    self.assertEqual('F', cff.ParseCffHeader(data)[1])
+    parsed2_font = cff.ParseType1CFont(data)
+    self.assertEqual(256, len(parsed2_font.pop('Encoding')))
+    expected_font = dict(parsed_font)
+    del expected_font['FontName']
+    expected_font['CharStrings'] = dict(
+        parsed_font['CharStrings'], **{'.notdef': '<0e>'})
+    # ParseCffOp returns numbers (type 'n') as float strings.
+    expected_font['FontInfo'] = dict(
+        parsed_font['FontInfo'], UnderlinePosition='-120.')
+    expected_font['Private'] = dict(parsed_font['Private'], StdHW=['33.'])
+    self.assertEqual(expected_font, parsed2_font)
+    self.assertEqual(data, cff.SerializeType1CFont(parsed2_font, 'F'))
+    # Custom glyph names get their SIDs first.
+    self.assertEqual(['pedal.*', 'zzz', 'Hello'],
+                     map(str, cff.ParseCffHeader(data)[3]))
+    font_obj = main.PdfObj('1 0 obj<</Subtype/Type1C>>endobj')
+    font_obj.stream = data
+    parsed_fonts = main.PdfData.ParseType1CFonts(
+        objs={1: font_obj}, ps_tmp_file_name=None, data_tmp_file_name=None)
+    self.assertEqual([1], sorted(parsed_fonts))
+    self.assertEqual(parsed2_font['CharStrings'],
+                     parsed_fonts[1]['CharStrings'])
+    self.assertRaises(cff.CffUnsupportedError, cff.SerializeType1CFont,
+                      dict(parsed_font, CharStrings={'A': '(x)'}), 'F')
+    self.assertRaises(ValueError, cff.SerializeType1CFont,
+                      dict(parsed_font, CharStrings={'A': '<>'}), 'F')
+    # A wrong operand count is a ValueError (not a TypeError from the
+    # message formatting), so ParseType1CFonts can fall back to Ghostscript.
+    self.assertRaises(ValueError, cff.ParseCffOp,
+                      5, [0, 0, 9], 'FontBBox', 'x', None)
+    self.assertRaises(ValueError, cff.ParseCffOp,
+                      12007, [1, 0, 0], 'FontMatrix', 'm', None)
+    self.assertRaises(ValueError, cff.ParseCffOp,
+                      13, [1, 2], 'UniqueID', 'i', None)
+    self.assertRaises(ValueError, cff.ParseCffOp,
+                      12001, [], 'isFixedPitch', 'b', None)
+
+  def testSplitCharString(self):
+    # 2 hstem hints, hintmask with implicit vstem (1 byte mask), rmoveto,
+    # callsubr (subr 0, biased by -107), endchar, ignored trailing byte.
+    charstring = '\x8b\x8c\x8d\x8e\x01\x8f\x90\x13\xc0\x20\x0a\x0e\x05'
+    subr = '\x8b\x8b\x15\x0b'
+    self.assertEqual(
+        ['\x8b\x8c\x8d\x8e\x01', '\x8f\x90\x13\xc0', '\x8b\x8b\x15',
+         '\x0e'],
+        cff.SplitCharString(charstring, [subr]))
+    self.assertRaises(ValueError, cff.SplitCharString, charstring, [])
+    self.assertRaises(ValueError, cff.SplitCharString, '\x8b\x0b')
+    self.assertRaises(cff.CffUnsupportedError, cff.SplitCharString,
+                      '\x8b\x8b\x0c\x0a\x0e')  # add.
+    for value in (0, 107, -107, 108, -108, 1131, -1131, 1132, -32768, 32767):
+      self.assertEqual(value, cff.DecodeCharStringNumber(
+          cff.EncodeCharStringNumber(value)))
+
+  def testSubroutinizeCharStrings(self):
+    common = ['\xa0\xa1\x05', '\xa2\xa3\x05', '\xa4\xa5\x05',
+              '\xa6\xa7\x05']
+    glyph_commands = [
+        ['\xf8\x00\x8b\x15'] + common + ['\x0e'],
+        ['\x8b\x8b\x15'] + common + common[:2] + ['\x0e'],
+        ['\x8c\x8b\x15'] + common + ['\x0e'],
+        ['\x0e'],
+    ]
+    charstring_bufs, subr_bufs = cff.SubroutinizeCharStrings(glyph_commands)
+    self.assertEqual(len(glyph_commands), len(charstring_bufs))
+    self.assertTrue(subr_bufs)
+    for commands, charstring in zip(glyph_commands, charstring_bufs):
+      self.assertEqual(''.join(commands),
+                       ''.join(cff.SplitCharString(charstring, subr_bufs)))
+    self.assertTrue(sum(map(len, charstring_bufs)) + sum(map(len, subr_bufs)) <
+                    sum(len(''.join(commands)) for commands in glyph_commands))
+    self.assertEqual((['\x0e'], []),
+                     cff.SubroutinizeCharStrings([['\x0e']]))
+
+  def testDesubroutinizeType1CFont(self):
+    parsed_font = {
+        'FontType': 2, 'PaintType': 0,
+        'Private': {'Subrs': ['<8b8b150b>'], 'GlobalSubrs': ['<0e>'],
+                    'BlueValues': [0, 10]},
+        'CharStrings': {'A': '<200a201d>', '.notdef': '<0e>'}}
+    self.assertEqual(
+        {'FontType': 2, 'PaintType': 0, 'Private': {'BlueValues': [0, 10]},
+         'CharStrings': {'A': '<8b8b150e>', '.notdef': '<0e>'}},
+        cff.DesubroutinizeType1CFont(parsed_font))
+    self.assertEqual(['<8b8b150b>'], parsed_font['Private']['Subrs'])
+
+  def testUniteType1CFontGroupsByGlyphs(self):
+    glyph_a = '<%s>' % ('8b' * 20 + '0e')
+    glyph_b = '<%s>' % ('8c' * 20 + '0e')
+    glyph_c = '<%s>' % ('8d' * 20 + '0e')
+    def Font(charstrings, blue_values=(0, 10)):
+      return {'FontMatrix': ['0.001', 0, 0, '0.001', 0, 0], 'PaintType': 0,
+              'Private': {'BlueValues': list(blue_values), 'StdHW': [33]},
+              'CharStrings': charstrings}
+    parsed_fonts = {
+        1: Font({'A': glyph_a, 'B': glyph_b}),
+        2: Font({'A': glyph_a, 'C': glyph_c, 'space': '<8b0e>'}),
+        3: Font({'B': glyph_b}, blue_values=(0, 20)),  # Different /Private.
+        4: Font({'C': glyph_c, 'B': glyph_c}),  # Conflicting /B.
+        5: Font({'space': '<8b0e>'}),  # Too short to match.
+        6: Font({'A': glyph_a}),
+    }
+    objs = {}
+    for obj_num in parsed_fonts:
+      objs[obj_num] = main.PdfObj(
+          '%d 0 obj<</Type/FontDescriptor/Flags 4>>endobj' % obj_num)
+    font_groups = {'Foo': [1], 'Bar': [2, 6], 'Baz': [3], 'Quux': [4],
+                   'Space': [5]}
+    self.assertEqual(
+        [['Bar', 'Foo']],
+        main.PdfData.UniteType1CFontGroupsByGlyphs(
+            parsed_fonts, font_groups, objs))
+    self.assertEqual(
+        {'Bar': [1, 2, 6], 'Baz': [3], 'Quux': [4], 'Space': [5]},
+        font_groups)
+    objs[6].Set('Flags', 32)
+    font_groups = {'Foo': [1], 'Bar': [6]}
+    self.assertEqual([], main.PdfData.UniteType1CFontGroupsByGlyphs(
+        parsed_fonts, font_groups, objs))
+
   def testFormatFloatShort(self):
     for f, expected in (
         (float('inf'), 'inf'),